@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+
+# =================================================================
+# BATCH CLIENT CHECKS
+# =================================================================
+# Drives client.py's batch mode (BatchRunner) against fake_runpod.py and
+# checks each scenario end to end: a fresh submit-and-poll run, a warm
+# worker that lost the inputs the client only sent by hash
+# (missing_inputs), resuming from a state file with jobs already done or
+# in flight, and the /stream endpoint. Exits 1 when a check fails.
+#
+#   python bench_client.py --entries 20
+#   python bench_client.py --formats envelope --concurrency 4
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Client settings must be in place before client.py is imported
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+PORT = free_port()
+os.environ["RUNPOD_BASE_URL"] = f"http://127.0.0.1:{PORT}"
+
+# =================================================================
+# FIXTURES
+# =================================================================
+WORKFLOW = {
+    "10": {"class_type": "LoadImage", "inputs": {"image": "input.png"}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat"}},
+    "3": {"class_type": "KSampler", "inputs": {"seed": 1, "steps": 4}},
+    "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0]}}
+}
+
+def write_manifest(workdir, n_entries, image_kb):
+    """A manifest of `n_entries` jobs, each with its own input image."""
+    workflow_path = os.path.join(workdir, "workflow_api.json")
+    with open(workflow_path, "w") as f:
+        json.dump(WORKFLOW, f)
+    entries = []
+    for i in range(n_entries):
+        image_path = os.path.join(workdir, f"input_{i}.png")
+        with open(image_path, "wb") as f:
+            f.write(os.urandom(image_kb * 1024))
+        entries.append({"key": f"e{i}", "workflow": workflow_path, "images": [image_path], "prompt": f"cat {i}", "seed": i})
+    manifest_path = os.path.join(workdir, "manifest.jsonl")
+    with open(manifest_path, "w") as f:
+        f.write("\n".join(json.dumps(entry) for entry in entries))
+    return manifest_path, entries
+
+def make_args(manifest_path, workdir, fmt, concurrency, stream=False):
+    argv = [
+        "--manifest", manifest_path, "--out_dir", os.path.join(workdir, "out"), "--format", fmt,
+        "--concurrency", str(concurrency), "--min_poll", "0.01", "--max_poll", "0.1"
+    ]
+    return client.build_parser().parse_args(argv + (["--stream"] if stream else []))
+
+# =================================================================
+# SCENARIOS
+# =================================================================
+def run_batch(fake, args, entries):
+    """Runs the batch; returns (wall seconds, state, jobs submitted, polls)."""
+    submitted, polls = fake.submitted, fake.polls
+    runner = client.BatchRunner(args)
+    started = time.perf_counter()
+    asyncio.run(runner.run(entries))
+    wall = time.perf_counter() - started
+    return wall, client.load_state(runner.state_path), fake.submitted - submitted, fake.polls - polls
+
+def check_outputs(args, entries, state, problems):
+    for entry in entries:
+        key = entry["key"]
+        if state.get(key, {}).get("status") != "done":
+            problems.append(f"{key} is {state.get(key, {}).get('status')!r}, not done")
+        elif not os.path.exists(os.path.join(args.out_dir, key, "ComfyUI_00001_.png")):
+            problems.append(f"{key} has no saved output")
+
+def scenario_submit(fake, args, entries):
+    wall, state, submitted, polls = run_batch(fake, args, entries)
+    problems = []
+    check_outputs(args, entries, state, problems)
+    if submitted != len(entries):
+        problems.append(f"{submitted} jobs submitted for {len(entries)} entries")
+    return wall, submitted, polls, problems
+
+def scenario_missing_inputs(fake, args, entries):
+    # The client's hints say every input was sent, but this worker is cold
+    digests = {hashlib.sha256(client.read_image(e["images"][0])).hexdigest() for e in entries}
+    client.save_input_hints({digest: time.time() for digest in digests})
+    fake.inputs.clear()
+    missing = fake.missing_answers
+    wall, state, submitted, polls = run_batch(fake, args, entries)
+    problems = []
+    check_outputs(args, entries, state, problems)
+    if fake.missing_answers - missing != len(entries):
+        problems.append(f"{fake.missing_answers - missing} missing_inputs answers for {len(entries)} entries")
+    if submitted != 2 * len(entries):
+        problems.append(f"{submitted} jobs submitted, expected one resend per entry ({2 * len(entries)})")
+    return wall, submitted, polls, problems
+
+def scenario_resume(fake, args, entries):
+    # An earlier run finished half the entries and submitted one more
+    half = len(entries) // 2
+    state = {entry["key"]: {"status": "done"} for entry in entries[:half]}
+    in_flight = entries[half]["key"]
+    workflow_json, images = client.prepare_entry(entries[half], {}, None)
+    payload = client.build_payload(workflow_json, images, {}, True, args.format)
+    state[in_flight] = {"job_id": fake.submit(payload["input"]), "status": "submitted"}
+    client.save_state(args.state or f"{args.manifest}.state.json", state)
+
+    wall, state, submitted, polls = run_batch(fake, args, entries)
+    problems = []
+    for entry in entries[half:]:
+        if state.get(entry["key"], {}).get("status") != "done":
+            problems.append(f"{entry['key']} was not finished on resume")
+    expected = len(entries) - half - 1
+    if submitted != expected:
+        problems.append(f"{submitted} jobs submitted on resume, expected {expected}")
+    return wall, submitted, polls, problems
+
+SCENARIOS = {
+    "submit": (scenario_submit, False),
+    "missing_inputs": (scenario_missing_inputs, False),
+    "resume": (scenario_resume, False),
+    "stream": (scenario_submit, True),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check client.py batch mode against a fake RunPod API")
+    parser.add_argument("--entries", type=int, default=12, help="Manifest entries per scenario")
+    parser.add_argument("--formats", default="fernet,envelope")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--image_kb", type=int, default=64, help="Size of each input image")
+    parser.add_argument("--json", help="Write results here")
+    parser.add_argument("--verbose", action="store_true", help="Show the client's own log lines")
+    args = parser.parse_args()
+
+    # The table goes to the real stdout; client logs are dropped unless --verbose
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    fake = FakeRunPod()
+    httpd = fake.serve(port=PORT)
+    results = []
+    try:
+        print(f"{'scenario':<28}{'jobs':>7}{'polls':>7}{'wall s':>9}{'jobs/s':>9}  result", file=out)
+        for fmt in args.formats.split(","):
+            for name in args.scenarios.split(","):
+                scenario, stream = SCENARIOS[name]
+                workdir = tempfile.mkdtemp(prefix="bench_client_")
+                try:
+                    client.INPUT_HINTS_FILE = os.path.join(workdir, "sent_inputs.json")
+                    manifest_path, entries = write_manifest(workdir, args.entries, args.image_kb)
+                    batch_args = make_args(manifest_path, workdir, fmt, args.concurrency, stream)
+                    wall, submitted, polls, problems = scenario(fake, batch_args, entries)
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                r = {
+                    "scenario": f"{fmt}/{name}",
+                    "submitted": submitted,
+                    "polls": polls,
+                    "wall_s": round(wall, 3),
+                    "throughput_jobs_s": round(len(entries) / wall, 2),
+                    "problems": problems
+                }
+                results.append(r)
+                print(
+                    f"{r['scenario']:<28}{submitted:>7}{polls:>7}{r['wall_s']:>9}{r['throughput_jobs_s']:>9}  "
+                    f"{'ok' if not problems else 'FAILED'}", file=out, flush=True
+                )
+    finally:
+        httpd.shutdown()
+        sys.stdout = out
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"💾 Results saved to {args.json}")
+
+    failures = [(r["scenario"], p) for r in results for p in r["problems"]]
+    if failures:
+        print("❌ Failed checks:")
+        for scenario, problem in failures:
+            print(f"   {scenario}: {problem}")
+        sys.exit(1)
+    print("✅ Batch client checks passed.")
+
+if __name__ == "__main__":
+    sys.path.insert(0, HERE)
+    import client
+    from fake_runpod import FakeRunPod
+    main()
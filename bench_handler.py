@@ -0,0 +1,540 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from cryptography.fernet import Fernet
+
+# =================================================================
+# HANDLER BENCHMARK
+# =================================================================
+# Drives rp_handler against fake_comfy.py (no GPU, no models) and reports
+# per scenario: handler overhead (latency minus ComfyUI queue wait and
+# execution, from the job's own metrics), input write and cleanup time,
+# latency, throughput and peak RSS of this process. Scenarios are the product of --payloads, --inputs and
+# --concurrency. Use --baseline to fail on p50 overhead or throughput
+# regressions in CI.
+#
+#   python bench_handler.py --jobs 20 --json bench.json
+#   python bench_handler.py --baseline bench.json --tolerance 0.3
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Handler settings must be in place before rp_handler is imported
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# =================================================================
+# PEAK RSS
+# =================================================================
+class RSSSampler:
+    """Samples this process's resident set size to find a scenario's peak."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # Not Linux: lifetime peak is the best available (KB on Linux, bytes on macOS)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+# =================================================================
+# JOBS
+# =================================================================
+def build_workflow(n_images):
+    workflow = {}
+    for i in range(n_images):
+        workflow[str(10 + i)] = {"class_type": "LoadImage", "inputs": {"image": f"input_{i}.png"}}
+    workflow["3"] = {"class_type": "KSampler", "inputs": {"seed": 1, "steps": 4}}
+    workflow["9"] = {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0]}}
+    return workflow
+
+def build_job(payload, n_images, image_kb, job_id, extra=None):
+    """A job for `payload` (plain, fernet or envelope); `extra` goes into its inner payload."""
+    workflow = build_workflow(n_images)
+    images = {f"input_{i}.png": os.urandom(image_kb * 1024) for i in range(n_images)}
+    extra = extra or {}
+    if payload == "envelope":
+        sealed = h.seal(h.envelope_key, {"workflow": workflow, **extra}, images)
+        job_input = {"envelope": base64.b64encode(sealed).decode()}
+    else:
+        inner = {
+            "workflow": workflow, **extra,
+            "images": {name: base64.b64encode(data).decode() for name, data in images.items()}
+        }
+        if payload == "fernet":
+            job_input = {"is_encrypted": True, "encrypted_input": h.cipher.encrypt(json.dumps(inner).encode()).decode()}
+        else:
+            job_input = inner
+    job_input["metrics"] = True
+    return {"id": job_id, "input": job_input}
+
+def response_metrics(response):
+    if response.get("status") != "success":
+        raise Exception(f"Job failed: {response.get('message', response.get('status'))}")
+    if "envelope" in response:
+        meta, _ = h.unseal(h.envelope_key, base64.b64decode(response["envelope"]))
+        return meta["metrics"]
+    return response["metrics"]
+
+async def run_scenario(payload, n_images, image_kb, concurrency, n_jobs):
+    # Payloads are built up front: client-side encryption is not handler time
+    jobs = [build_job(payload, n_images, image_kb, f"bench-{payload}-{i}") for i in range(n_jobs)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, overheads, writes, cleanups = [], [], [], []
+
+    async def one(job):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await h.async_handler(job)
+            latency = time.perf_counter() - started
+        metrics = response_metrics(response)
+        comfy = sum(v.get("queue_wait", 0) + v.get("execute", 0) for v in metrics["variants"].values())
+        latencies.append(latency)
+        overheads.append(max(latency - comfy, 0.0))
+        writes.append(metrics["phases"].get("write_inputs", 0.0))
+        cleanups.append(metrics["phases"].get("cleanup", 0.0))
+
+    with RSSSampler() as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(job) for job in jobs))
+        wall = time.perf_counter() - started
+    del jobs
+
+    return {
+        "scenario": f"{payload}/{n_images}x{image_kb}KB/c{concurrency}",
+        "overhead_p50_ms": round(percentile(overheads, 50) * 1000, 2),
+        "overhead_p99_ms": round(percentile(overheads, 99) * 1000, 2),
+        "write_inputs_p50_ms": round(percentile(writes, 50) * 1000, 2),
+        "cleanup_p50_ms": round(percentile(cleanups, 50) * 1000, 2),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "throughput_jobs_s": round(n_jobs / wall, 2),
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1)
+    }
+
+# =================================================================
+# CORRECTNESS CHECKS
+# =================================================================
+# Run with --checks after the scenarios, against the same fakes. Each
+# returns a list of problems; any problem fails the run.
+IMAGE_MAGIC = (b"\x89PNG", b"RIFF", b"\xff\xd8")
+
+def check_offload():
+    """
+    Offloads a WebP output and its preview to fake_s3.py for Fernet and
+    envelope jobs: stored objects must be sealed, and client.download_link
+    must restore images of the requested format and size.
+    """
+    import io
+    from urllib.parse import urlsplit
+    from PIL import Image
+    import client
+    from delivery import OutputBucket
+    from fake_s3 import FakeS3
+
+    fake = FakeS3()
+    port = free_port()
+    httpd = fake.serve(port=port)
+    saved_bucket = h.output_bucket
+    h.output_bucket = OutputBucket("outputs", f"http://127.0.0.1:{port}", "test", "test")
+    problems = []
+    try:
+        for payload, sealed_as in (("fernet", "fernet"), ("envelope", True)):
+            delivery = {"format": "webp", "quality": 80, "preview": 64, "offload": "always"}
+            response = h.handler(build_job(payload, 1, 64, f"offload-{payload}", {"delivery": delivery}))
+            if response.get("status") != "success":
+                problems.append(f"{payload}: job failed: {response.get('message')}")
+                continue
+            if payload == "envelope":
+                meta, blobs = h.unseal(h.envelope_key, base64.b64decode(response["envelope"]))
+                links, inline = meta.get("links", {}), blobs
+            else:
+                links, inline = response.get("links", {}), response.get("images", {})
+            if inline or len(links) != 2:
+                problems.append(f"{payload}: expected 2 links and no inline outputs, got {len(links)} and {len(inline)}")
+            for name, link in links.items():
+                stored = fake.objects.get(urlsplit(link["url"]).path.lstrip("/"), (b"",))[0]
+                if link.get("sealed") != sealed_as:
+                    problems.append(f"{payload}/{name}: link says sealed={link.get('sealed')!r}")
+                if not stored or stored.startswith(IMAGE_MAGIC):
+                    problems.append(f"{payload}/{name}: bucket holds plaintext (or nothing)")
+                try:
+                    data = client.download_link(link)
+                    with Image.open(io.BytesIO(data)) as image:
+                        if image.format != "WEBP":
+                            problems.append(f"{payload}/{name}: downloaded {image.format}, not WEBP")
+                        if "_preview" in name and max(image.size) > 64:
+                            problems.append(f"{payload}/{name}: preview is {image.size}")
+                    if data == stored:
+                        problems.append(f"{payload}/{name}: download was not decrypted")
+                except Exception as e:
+                    problems.append(f"{payload}/{name}: could not restore download: {e}")
+    finally:
+        h.output_bucket = saved_bucket
+        httpd.shutdown()
+    return problems
+
+def check_models():
+    """
+    Provisions models with MODEL_BACKEND=http from `python -m http.server`
+    (which ignores Range) and from a Range-capable server: a truncated
+    .part must end up complete (resumed where the server allows it), a
+    full-size .part must be accepted on 416, and a local file that fails
+    the manifest must be re-fetched.
+    """
+    import hashlib
+    import random
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from startup import load_provisioning
+
+    provisioning = load_provisioning()
+    root = tempfile.mkdtemp(prefix="bench_models_")
+    served = os.path.join(root, "served")
+    blobs = {name: random.randbytes(size) for name, size in (
+        ("fresh.bin", 300_000), ("truncated.bin", 400_000), ("complete.bin", 200_000), ("corrupt.bin", 250_000)
+    )}
+    os.makedirs(os.path.join(served, "org", "repo", "resolve", "main"))
+    for name, data in blobs.items():
+        with open(os.path.join(served, "org", "repo", "resolve", "main", name), "wb") as f:
+            f.write(data)
+    manifest = {name: {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+                for name, data in blobs.items() if name != "complete.bin"}
+
+    ranges = []
+
+    class RangeHandler(SimpleHTTPRequestHandler):
+        """Serves `bytes=N-` ranges: 206 with the tail, or 416 past the end."""
+
+        def log_message(self, *args):
+            pass
+
+        def send_head(self):
+            header = self.headers.get("Range", "")
+            if not header.startswith("bytes="):
+                return super().send_head()
+            start = int(header[6:].rstrip("-"))
+            path = self.translate_path(self.path)
+            size = os.path.getsize(path)
+            ranges.append((os.path.basename(path), start))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            f = open(path, "rb")
+            f.seek(start)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            self.send_header("Content-Length", str(size - start))
+            self.end_headers()
+            return f
+
+    plain_port, range_port = free_port(), free_port()
+    plain = subprocess.Popen(
+        [sys.executable, "-m", "http.server", str(plain_port), "--bind", "127.0.0.1", "--directory", served],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    httpd = ThreadingHTTPServer(("127.0.0.1", range_port), lambda *a: RangeHandler(*a, directory=served))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    problems = []
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{plain_port}/", timeout=1)
+                break
+            except requests.RequestException:
+                time.sleep(0.05)
+        for server, port in (("http.server", plain_port), ("range", range_port)):
+            dest_dir = os.path.join(root, server)
+            os.makedirs(dest_dir)
+            with open(os.path.join(dest_dir, "truncated.bin.part"), "wb") as f:
+                f.write(blobs["truncated.bin"][:150_000])
+            with open(os.path.join(dest_dir, "complete.bin.part"), "wb") as f:
+                f.write(blobs["complete.bin"])
+            with open(os.path.join(dest_dir, "corrupt.bin"), "wb") as f:
+                f.write(bytes(len(blobs["corrupt.bin"])))
+            del ranges[:]
+            report = provisioning.prepare_models(
+                [{"repo_id": "org/repo", "filename": name, "target_dir": dest_dir, "local_name": None} for name in blobs],
+                workers=2, backend=provisioning.HTTPBackend(f"http://127.0.0.1:{port}"), manifest=manifest,
+                report_path=os.path.join(root, f"{server}_report.json")
+            )
+            for model in report["models"]:
+                name = model["filename"]
+                if model["outcome"] != "downloaded":
+                    problems.append(f"{server}/{name}: {model['outcome']} ({model.get('error')})")
+                    continue
+                with open(os.path.join(dest_dir, name), "rb") as f:
+                    if f.read() != blobs[name]:
+                        problems.append(f"{server}/{name}: provisioned bytes differ from the served file")
+            if server == "range":
+                for name, start in (("truncated.bin", 150_000), ("complete.bin", len(blobs["complete.bin"]))):
+                    if (name, start) not in ranges:
+                        problems.append(f"range/{name}: no Range request from byte {start}")
+    finally:
+        plain.terminate()
+        plain.wait()
+        httpd.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    return problems
+
+def check_dispatch():
+    """
+    Dispatches concurrent jobs across three fake ComfyUI instances and one
+    address nothing listens on: every live instance must get a share, the
+    dead one none. Models count as loaded on an instance only once a prompt
+    using them has completed there, not when a job fails.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from dispatch import Dispatcher
+    from fake_comfy import FakeComfyUI
+
+    servers = []
+    for _ in range(3):
+        port = free_port()
+        servers.append((FakeComfyUI(h.OUTPUT_DIR).serve(port=port), f"127.0.0.1:{port}"))
+    dead = f"127.0.0.1:{free_port()}"
+    dispatcher = Dispatcher([address for _, address in servers] + [dead], h.DISPATCH_AFFINITY_WEIGHT, health_interval=3600)
+    saved_dispatcher, saved_concurrency = h._dispatcher, h.MAX_CONCURRENCY
+    h._dispatcher = dispatcher
+    # Per-job folders, since jobs overlap
+    h.MAX_CONCURRENCY = max(h.MAX_CONCURRENCY, 2)
+    problems = []
+    try:
+        n_jobs = 12
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            responses = list(pool.map(h.handler, [build_job("plain", 1, 16, f"dispatch-{i}") for i in range(n_jobs)]))
+        counts = {address: 0 for _, address in servers}
+        for response in responses:
+            if response.get("status") != "success":
+                problems.append(f"job failed: {response.get('message')}")
+                continue
+            address = response.get("completion", {}).get("backend")
+            if address == dead:
+                problems.append("a job was routed to the unreachable backend")
+            elif address in counts:
+                counts[address] += 1
+        if any(count < n_jobs // (2 * len(counts)) for count in counts.values()):
+            problems.append(f"unbalanced distribution: {counts}")
+        if dispatcher.backends[-1].healthy:
+            problems.append("the unreachable backend is marked healthy")
+
+        def with_model(ckpt, **inputs):
+            workflow = build_workflow(1)
+            workflow["4"] = {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt}}
+            workflow["3"]["inputs"].update(inputs)
+            return workflow
+
+        failed = h.handler(build_job("plain", 1, 16, "dispatch-failed", {"workflow": with_model("failed.safetensors", fake_error="boom")}))
+        if failed.get("status") != "error":
+            problems.append(f"the failing job returned {failed.get('status')!r}")
+        if any("failed.safetensors" in backend.models for backend in dispatcher.backends):
+            problems.append("a failed job's model was recorded as loaded")
+        done = h.handler(build_job("plain", 1, 16, "dispatch-done", {"workflow": with_model("done.safetensors")}))
+        ran_on = done.get("completion", {}).get("backend")
+        if not any(b.address == ran_on and "done.safetensors" in b.models for b in dispatcher.backends):
+            problems.append("a completed job's model was not recorded on its backend")
+    finally:
+        h._dispatcher, h.MAX_CONCURRENCY = saved_dispatcher, saved_concurrency
+        for backend in dispatcher.backends:
+            backend.conn.close()
+        for httpd, _ in servers:
+            httpd.shutdown()
+    return problems
+
+CHECKS = {"offload": check_offload, "models": check_models, "dispatch": check_dispatch}
+
+# =================================================================
+# REGRESSION CHECK
+# =================================================================
+# p50 overhead and throughput are stable enough on a shared runner to gate
+# on. With a few dozen jobs p99 is the single slowest one and RSS moves
+# with the allocator, so those are only reported.
+GATED = ("overhead_p50_ms",)
+REPORTED = ("overhead_p99_ms", "peak_rss_mb")
+
+def compare(results, baseline_path, tolerance):
+    """
+    Returns (regressions, notes) beyond `tolerance` versus a saved run:
+    regressions fail the run, notes are changes in the reported-only metrics.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions, notes = [], []
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if not base:
+            continue
+        for key in GATED + REPORTED:
+            if base.get(key) and result[key] > base[key] * (1 + tolerance):
+                (regressions if key in GATED else notes).append(
+                    f"{result['scenario']}: {key} {base[key]} -> {result[key]}"
+                )
+        if result["throughput_jobs_s"] < base["throughput_jobs_s"] * (1 - tolerance):
+            regressions.append(
+                f"{result['scenario']}: throughput_jobs_s {base['throughput_jobs_s']} -> {result['throughput_jobs_s']}"
+            )
+    return regressions, notes
+
+def parse_inputs(spec):
+    """"1x512,4x2048" -> [(1, 512), (4, 2048)] (count x KB)."""
+    pairs = []
+    for item in spec.split(","):
+        count, kb = item.lower().split("x")
+        pairs.append((int(count), int(kb)))
+    return pairs
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rp_handler against a fake ComfyUI")
+    parser.add_argument("--jobs", type=int, default=20, help="Jobs per scenario")
+    parser.add_argument("--payloads", default="plain,fernet,envelope")
+    parser.add_argument("--inputs", default="1x512,4x2048", help="Input images per job, as COUNTxKB list")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--output_kb", type=int, default=1024, help="Size of each output PNG")
+    parser.add_argument("--step_delay", type=float, default=0.005, help="Fake sampler seconds per step")
+    parser.add_argument("--output_mode", default="disk", choices=["disk", "websocket"])
+    parser.add_argument("--backends", type=int, default=1, help="Fake ComfyUI instances to dispatch across")
+    parser.add_argument("--json", help="Write results here")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    parser.add_argument("--checks", default="", help=f"Correctness checks to run as well ({', '.join(CHECKS)})")
+    parser.add_argument("--verbose", action="store_true", help="Show the handler's own log lines")
+    args = parser.parse_args()
+
+    # The table goes to the real stdout; handler logs are dropped unless --verbose
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    workdir = tempfile.mkdtemp(prefix="bench_handler_")
+    input_dir = os.path.join(workdir, "input")
+    output_dir = os.path.join(workdir, "output")
+    os.makedirs(input_dir)
+    os.makedirs(output_dir)
+
+    # The fakes run in their own processes so their memory is not counted
+    ports = [free_port() for _ in range(args.backends)]
+    fakes = [subprocess.Popen([
+        sys.executable, os.path.join(HERE, "fake_comfy.py"), "--port", str(port),
+        "--output_dir", output_dir, "--output_kb", str(args.output_kb), "--step_delay", str(args.step_delay)
+    ], stdout=subprocess.DEVNULL) for port in ports]
+
+    try:
+        for port in ports:
+            for _ in range(100):
+                try:
+                    requests.get(f"http://127.0.0.1:{port}/system_stats", timeout=1)
+                    break
+                except requests.RequestException:
+                    time.sleep(0.05)
+
+        h.COMFY_SERVERS = [f"127.0.0.1:{port}" for port in ports]
+        h.INPUT_DIR = input_dir
+        h.OUTPUT_DIR = output_dir
+        h.OUTPUT_MODE = args.output_mode
+        # Per-job folders, as in production whenever jobs overlap
+        h.MAX_CONCURRENCY = max(concurrency_levels)
+        # Progress goes to the RunPod API, which does not exist locally
+        h.runpod.serverless.progress_update = lambda *a, **k: None
+
+        results = []
+        problems = []
+        print(
+            f"{'scenario':<28}{'ovh p50':>9}{'ovh p99':>9}{'write':>9}{'cleanup':>9}"
+            f"{'lat p50':>9}{'lat p99':>9}{'jobs/s':>9}{'RSS MB':>9}", file=out
+        )
+        for payload in args.payloads.split(","):
+            for n_images, image_kb in parse_inputs(args.inputs):
+                for concurrency in concurrency_levels:
+                    r = asyncio.run(run_scenario(payload, n_images, image_kb, concurrency, args.jobs))
+                    results.append(r)
+                    print(
+                        f"{r['scenario']:<28}{r['overhead_p50_ms']:>9}{r['overhead_p99_ms']:>9}"
+                        f"{r['write_inputs_p50_ms']:>9}{r['cleanup_p50_ms']:>9}"
+                        f"{r['latency_p50_ms']:>9}{r['latency_p99_ms']:>9}{r['throughput_jobs_s']:>9}{r['peak_rss_mb']:>9}",
+                        file=out, flush=True
+                    )
+        for name in filter(None, args.checks.split(",")):
+            found = CHECKS[name]()
+            problems.extend(f"{name}: {problem}" for problem in found)
+            print(f"{'check ' + name:<28}{'ok' if not found else 'FAILED':>9}", file=out, flush=True)
+    finally:
+        for fake in fakes:
+            fake.terminate()
+            fake.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+        sys.stdout = out
+
+    report = {"config": vars(args), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Results saved to {args.json}")
+
+    if problems:
+        print("❌ Failed checks:")
+        for problem in problems:
+            print(f"   {problem}")
+        sys.exit(1)
+
+    if args.baseline:
+        regressions, notes = compare(results, args.baseline, args.tolerance)
+        if notes:
+            print("ℹ️  Changes in reported-only metrics (not gated):")
+            for line in notes:
+                print(f"   {line}")
+        if regressions:
+            print("❌ Regressions:")
+            for line in regressions:
+                print(f"   {line}")
+            sys.exit(1)
+        print("✅ No regressions against baseline.")
+
+if __name__ == "__main__":
+    sys.path.insert(0, HERE)
+    import rp_handler as h
+    main()
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from cryptography.fernet import InvalidToken
+
+# =================================================================
+# CONTENT-ADDRESSED INPUT CACHE
+# =================================================================
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class InputCache:
+    """
+    Size-bounded LRU of decoded input images keyed by SHA-256, kept in RAM
+    for the worker's lifetime. With a Fernet `cipher`, entries are stored
+    encrypted and decrypted on every hit.
+    """
+
+    def __init__(self, max_bytes, cipher=None):
+        self.max_bytes = max_bytes
+        self.cipher = cipher
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            stored = self._entries.get(digest)
+            if stored is None:
+                return None
+            self._entries.move_to_end(digest)
+        return self.cipher.decrypt(stored) if self.cipher else stored
+
+    def put(self, digest, data):
+        """Stores `data` under `digest`; oversized entries are not cached."""
+        stored = self.cipher.encrypt(bytes(data)) if self.cipher else bytes(data)
+        if len(stored) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[digest] = stored
+            self._size += len(stored)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+# =================================================================
+# ENCRYPTED RESULT CACHE
+# =================================================================
+class DiskLRU:
+    """
+    Size-bounded LRU of opaque blobs stored as <key>.bin files in
+    `directory`. Entries found there at start-up are adopted, oldest first.
+    A `shared` directory (a network volume several workers write to) is
+    re-scanned before each put, so the budget covers every worker's
+    entries, and hits touch the file so recency is shared too.
+    """
+
+    def __init__(self, directory, max_bytes, shared=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bin") and entry.is_file():
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        self._size = sum(self._entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            elif not self.shared:
+                return None
+        # On a shared directory another worker may have written it since our scan
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            if self.shared:
+                os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        tmp_path = f"{self._path(key)}.tmp{threading.get_ident()}"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self.shared:
+                self._scan()
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._size > self.max_bytes:
+                evicted, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+    def delete(self, key):
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+class ResultCache:
+    """
+    Finished job results keyed by a deterministic request hash, Fernet-
+    encrypted at rest. A fast tier (RAM disk) is backed by an optional
+    larger one (network volume); slow-tier hits are copied to the fast one.
+    """
+
+    def __init__(self, cipher, directory, max_bytes, volume_dir=None, volume_max_bytes=0):
+        self.cipher = cipher
+        self.fast = DiskLRU(directory, max_bytes)
+        self.slow = DiskLRU(volume_dir, volume_max_bytes, shared=True) if volume_dir else None
+
+    def get(self, key):
+        """
+        The cached result, or None. An entry that cannot be read or
+        decrypted (truncated, corrupt, or written with another key on a
+        shared volume) is deleted and treated as a miss.
+        """
+        tier = self.fast
+        try:
+            token = self.fast.get(key)
+            if token is None and self.slow is not None:
+                tier = self.slow
+                token = self.slow.get(key)
+            if token is None:
+                return None
+            data = self.cipher.decrypt(token)
+        except (InvalidToken, OSError) as e:
+            print(f"⚠️ Dropping unreadable result cache entry {key[:12]}: {type(e).__name__}")
+            self.fast.delete(key)
+            if self.slow is not None:
+                self.slow.delete(key)
+            return None
+        if tier is self.slow:
+            try:
+                self.fast.put(key, token)
+            except OSError as e:
+                print(f"⚠️ Could not copy result cache entry {key[:12]} to the fast tier: {e}")
+        return data
+
+    def put(self, key, data):
+        token = self.cipher.encrypt(data)
+        self.fast.put(key, token)
+        if self.slow is not None:
+            self.slow.put(key, token)
@@ -4,148 +4,144 @@ import base64
 import os
 import json
 import argparse
-import random
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
+from envelope import derive_key, seal, unseal
+from injection import WorkflowTemplate
 
 # ==============================================================================
 # CONFIGURATION
 # ==============================================================================
-# Replace these with your actual RunPod credentials
-ENDPOINT_ID = "YOUR_ENDPOINT_ID"
-API_KEY = "YOUR_API_KEY"
+# Replace these with your actual RunPod credentials (or set them in the environment)
+ENDPOINT_ID = os.environ.get("RUNPOD_ENDPOINT_ID", "YOUR_ENDPOINT_ID")
+API_KEY = os.environ.get("RUNPOD_API_KEY", "YOUR_API_KEY")
 
 # Pull key from environment variable
 ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY")
 
-BASE_URL = f"https://api.runpod.ai/v2/{ENDPOINT_ID}"
+# RUNPOD_BASE_URL points the client at another server, e.g. a local mock API
+BASE_URL = os.environ.get("RUNPOD_BASE_URL", f"https://api.runpod.ai/v2/{ENDPOINT_ID}")
 HEADERS = {
     "Authorization": f"Bearer {API_KEY}",
     "Content-Type": "application/json"
 }
 
+# Inputs uploaded within this window are first sent as hash references only;
+# a warm worker that still holds them skips the upload entirely.
+INPUT_HINTS_FILE = os.path.expanduser("~/.cache/comfy-endpoint/sent_inputs.json")
+INPUT_HINT_TTL = 3600
+
+# Outputs the worker offloaded to a bucket are fetched this many at a time
+DOWNLOAD_WORKERS = 8
+
 # ==============================================================================
 # HELPERS
 # ==============================================================================
-def encode_image(path):
-    """Converts a local image file to a base64 string."""
+def read_image(path):
+    """Reads a local image file as raw bytes (binary envelope format)."""
     if not os.path.exists(path):
         print(f"❌ Error: Image file '{path}' not found.")
         return None
     with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+        return f.read()
+
+def get_envelope_key():
+    if not ENCRYPTION_KEY:
+        print("❌ Error: ENCRYPTION_KEY environment variable not set.")
+        exit(1)
+    return derive_key(ENCRYPTION_KEY)
 
 def encrypt_payload(data_dict):
-    """Encrypts a dictionary into a single Fernet token."""
+    """Encrypts a dictionary (or pre-serialized JSON string) into a single Fernet token."""
     if not ENCRYPTION_KEY:
         print("❌ Error: ENCRYPTION_KEY environment variable not set.")
         exit(1)
     try:
         f = Fernet(ENCRYPTION_KEY.encode())
-        json_bytes = json.dumps(data_dict).encode()
+        json_bytes = (data_dict if isinstance(data_dict, str) else json.dumps(data_dict)).encode()
         return f.encrypt(json_bytes).decode()
     except Exception as e:
         print(f"❌ Encryption Error: {e}")
         exit(1)
 
-# ==============================================================================
-# MAIN
-# ==============================================================================
-def main():
-    parser = argparse.ArgumentParser(description="Secure ComfyUI RunPod Client")
-    parser.add_argument("--workflow", default="workflow_api.json", help="API Workflow JSON file")
-    parser.add_argument("--img", nargs='+', help="Input image(s). Mapped to LoadImage nodes by ID order.")
-    parser.add_argument("--prompt", help="Custom text prompt")
-    parser.add_argument("--poll_interval", type=int, default=2, help="Seconds between status checks")
-    parser.add_argument("--debug", action="store_true", help="Disable encryption for troubleshooting")
-    
-    args = parser.parse_args()
+def load_input_hints():
+    try:
+        with open(INPUT_HINTS_FILE, "r") as f:
+            hints = json.load(f)
+    except Exception:
+        return {}
+    now = time.time()
+    return {h: ts for h, ts in hints.items() if now - ts < INPUT_HINT_TTL}
 
-    # 1. Load Workflow JSON
-    if not os.path.exists(args.workflow):
-        print(f"❌ Error: Workflow file '{args.workflow}' not found.")
-        return
+def save_input_hints(hints):
+    try:
+        os.makedirs(os.path.dirname(INPUT_HINTS_FILE), exist_ok=True)
+        with open(INPUT_HINTS_FILE, "w") as f:
+            json.dump(hints, f)
+    except Exception as e:
+        print(f"⚠️ Could not save input cache hints: {e}")
 
-    with open(args.workflow, "r") as f:
-        workflow_data = json.load(f)
+def join_json(fields):
+    """Builds a JSON object from {key: already-serialized JSON value}."""
+    return "{" + ", ".join(f"{json.dumps(key)}: {value}" for key, value in fields.items()) + "}"
 
-    # 2. Smart Injection (Plaintext Processing)
-    images_to_upload = {}
-    
-    # A. Handle Multiple Images
-    if args.img:
-        # Identify all LoadImage nodes and sort by numerical ID
-        load_image_nodes = []
-        for node_id, node_data in workflow_data.items():
-            if node_data.get("class_type") == "LoadImage":
-                load_image_nodes.append((int(node_id), node_data))
-        
-        load_image_nodes.sort(key=lambda x: x[0])
-        
-        for i, img_path in enumerate(args.img):
-            if i >= len(load_image_nodes):
-                print(f"⚠️ Warning: More images provided than LoadImage nodes. Skipping {img_path}")
-                continue
-            
-            b64_data = encode_image(img_path)
-            if b64_data:
-                remote_name = os.path.basename(img_path)
-                images_to_upload[remote_name] = b64_data
-                
-                target_node_id = load_image_nodes[i][0]
-                target_node_data = load_image_nodes[i][1]
-                target_node_data["inputs"]["image"] = remote_name
-                print(f"🎯 Image Injection: '{img_path}' -> Node {target_node_id}")
+def build_payload(workflow_json, images_to_upload, image_refs, is_encrypted, fmt, variants=None, delivery=None):
+    """
+    Wraps a serialized workflow (see WorkflowTemplate.render_json) and raw
+    input bytes in the requested transport format. The workflow string is
+    spliced in as-is rather than parsed and re-serialized.
+    """
+    fields = {"workflow": workflow_json, "image_refs": json.dumps(image_refs)}
+    if variants:
+        fields["variants"] = json.dumps(variants)
+    if delivery:
+        fields["delivery"] = json.dumps(delivery)
+
+    if is_encrypted and fmt == "envelope":
+        print("🔒 Sealing binary envelope...")
+        sealed = seal(get_envelope_key(), join_json(fields), images_to_upload)
+        return {
+            "input": {
+                "envelope": base64.b64encode(sealed).decode('utf-8'),
+                "is_encrypted": True,
+                "debug": False
+            }
+        }
 
-    # B. Handle Prompt and Seed Injection
-    for node_id, node_data in workflow_data.items():
-        class_type = node_data.get("class_type")
-
-        # Inject Prompt
-        if args.prompt:
-            if class_type == "CLIPTextEncode":
-                node_data["inputs"]["text"] = args.prompt
-                print(f"✍️  Prompt Injection (CLIP): Node {node_id}")
-            elif class_type == "TextEncodeQwenImageEditPlus" and str(node_id) == "24":
-                node_data["inputs"]["prompt"] = args.prompt
-                print(f"✍️  Prompt Injection (Qwen): Node {node_id}")
-
-        # Randomize Seed
-        if "seed" in node_data.get("inputs", {}):
-            new_seed = random.randint(1, 10**15)
-            node_data["inputs"]["seed"] = new_seed
-            print(f"🎲 Seed Randomized: Node {node_id}")
-
-    # 3. Construct Payload (Encryption Layer)
-    is_encrypted = not args.debug
-    
     # Sensitive data bundle
-    inner_payload = {
-        "workflow": workflow_data,
-        "images": images_to_upload
-    }
+    images_b64 = {name: base64.b64encode(data).decode('utf-8') for name, data in images_to_upload.items()}
+    fields["images"] = json.dumps(images_b64)
 
     if is_encrypted:
         print("🔒 Encrypting payload...")
-        encrypted_token = encrypt_payload(inner_payload)
-        payload = {
+        encrypted_token = encrypt_payload(join_json(fields))
+        return {
             "input": {
                 "encrypted_input": encrypted_token,
                 "is_encrypted": True,
                 "debug": False
             }
         }
-    else:
-        print("⚠️  DEBUG MODE: Sending plaintext data.")
-        payload = {
-            "input": {
-                "workflow": workflow_data,
-                "images": images_to_upload,
-                "is_encrypted": False,
-                "debug": True
-            }
+
+    print("⚠️  DEBUG MODE: Sending plaintext data.")
+    return {
+        "input": {
+            **json.loads(join_json(fields)),
+            "is_encrypted": False,
+            "debug": True
         }
+    }
+
+def normalize_output(output):
+    """Streaming workers return a list of items; the last one has the status."""
+    if isinstance(output, list):
+        return {**(output[-1] if output else {"status": "error"}), "stream": output}
+    return output or {}
 
-    # 4. Submit Job
+def submit_and_wait(payload, poll_interval):
+    """Submits a job and polls until it finishes. Returns the output dict or None."""
     print(f"🚀 Submitting job to RunPod Endpoint {ENDPOINT_ID}...")
     try:
         run_resp = requests.post(f"{BASE_URL}/run", json=payload, headers=HEADERS)
@@ -154,9 +150,8 @@ def main():
         print(f"🆔 Job ID: {job_id}")
     except Exception as e:
         print(f"❌ Submission Failed: {e}")
-        return
+        return None
 
-    # 5. Polling Loop
     print("⏳ Polling for results...")
     last_status = None
     
@@ -172,39 +167,393 @@ def main():
                 last_status = status
             
             if "progress" in data:
-                print(f" | Progress: {data['progress']}", end="", flush=True)
+                progress = data["progress"]
+                if isinstance(progress, dict):
+                    progress = progress.get("message", progress)
+                print(f" | Progress: {progress}", end="", flush=True)
 
             if status == "COMPLETED":
                 print(f"\n\n✅ Job Completed Successfully!")
-                output = data.get("output", {})
-                
-                if output.get("status") == "success":
-                    images = output.get("images", {})
-                    if not images:
-                        print("ℹ️  No output images returned.")
-                    
-                    for filename, b64_data in images.items():
-                        out_filename = f"out_{filename}"
-                        with open(out_filename, "wb") as f:
-                            f.write(base64.b64decode(b64_data))
-                        print(f"💾 Saved: {out_filename}")
-                else:
-                    print(f"❌ Worker Error: {output.get('message')}")
-                break
+                return normalize_output(data.get("output"))
 
             elif status in ["FAILED", "CANCELLED"]:
                 print(f"\n❌ Job {status}!")
                 print(f"   Error: {data.get('error')}")
-                break
+                return None
             else:
                 print(".", end="", flush=True)
-                time.sleep(args.poll_interval)
+                time.sleep(poll_interval)
 
         except KeyboardInterrupt:
             print(f"\n\n🛑 Polling interrupted. Job ID: {job_id}")
-            break
+            return None
         except Exception as e:
             time.sleep(5)
 
+def download_link(link):
+    """Fetches one offloaded output; sealed ones are decrypted with ENCRYPTION_KEY."""
+    response = requests.get(link["url"], timeout=300)
+    response.raise_for_status()
+    if link.get("sealed") == "fernet":
+        return Fernet(ENCRYPTION_KEY.encode()).decrypt(response.content)
+    if link.get("sealed"):
+        meta, blobs = unseal(get_envelope_key(), response.content)
+        return bytes(blobs[meta["filename"]])
+    return response.content
+
+def download_links(links):
+    """Downloads {name: link} in parallel; returns {name: bytes}."""
+    if not links:
+        return {}
+    print(f"📥 Downloading {len(links)} offloaded output(s)...")
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = {name: pool.submit(download_link, link) for name, link in links.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def decode_stream(items):
+    """Collects the outputs yielded one by one by a streaming worker."""
+    images = {}
+    links = {}
+    for item in items:
+        meta = item
+        if "envelope" in item:
+            meta, blobs = unseal(get_envelope_key(), base64.b64decode(item["envelope"]))
+        if "filename" not in meta:
+            continue
+        name = meta["filename"] if "variant" not in meta else f"{meta['variant']}/{meta['filename']}"
+        if "link" in meta:
+            links[name] = meta["link"]
+        elif "envelope" in item:
+            images[name] = bytes(blobs[meta["filename"]])
+        elif "data" in item:
+            images[name] = base64.b64decode(item["data"])
+    images.update(download_links(links))
+    return images
+
+def save_outputs(output, out_dir=".", prefix="out_"):
+    if "stream" in output:
+        images = decode_stream(output["stream"])
+        variant_results = output.get("variants", {})
+    elif "envelope" in output:
+        meta, images = unseal(get_envelope_key(), base64.b64decode(output["envelope"]))
+        variant_results = meta.get("variants", {})
+        links = dict(meta.get("links", {}))
+    else:
+        variant_results = output.get("variants", {})
+        links = dict(output.get("links", {}))
+        images = {name: base64.b64decode(b64_data) for name, b64_data in output.get("images", {}).items()}
+        for key, result in variant_results.items():
+            for name, b64_data in result.get("images", {}).items():
+                images[f"{key}/{name}"] = base64.b64decode(b64_data)
+    if "stream" not in output:
+        # Large outputs come back as presigned bucket URLs instead of data
+        for key, result in variant_results.items():
+            links.update({f"{key}/{name}": link for name, link in result.get("links", {}).items()})
+        images = {**images, **download_links(links)}
+
+    for key, result in variant_results.items():
+        if result.get("status") != "success":
+            print(f"❌ Variant {key} failed: {result.get('message')}")
+    if not images:
+        print("ℹ️  No output images returned.")
+    
+    for filename, img_bytes in images.items():
+        # Batch results are named "<variant>/<file>"
+        out_filename = os.path.normpath(os.path.join(out_dir, prefix + filename.replace("/", "_")))
+        with open(out_filename, "wb") as f:
+            f.write(img_bytes)
+        print(f"💾 Saved: {out_filename}")
+
+# ==============================================================================
+# BATCH MODE (asyncio)
+# ==============================================================================
+# A manifest is a JSON list (or JSON lines) of entries:
+#   {"key": "cat-1", "workflow": "wf.json", "images": ["a.jpg"], "prompt": "...", "seed": 42}
+# Only "workflow" is required. Progress is kept in a state file so an
+# interrupted run resumes: finished entries are skipped and submitted ones
+# are polled again instead of being resubmitted.
+def load_manifest(path):
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+def prepare_entry(entry, templates, mapping_path=None):
+    """Builds (workflow JSON, {remote_name: bytes}) for one manifest entry."""
+    path = entry["workflow"]
+    mapping_path = entry.get("mapping", mapping_path)
+    if (path, mapping_path) not in templates:
+        templates[(path, mapping_path)] = WorkflowTemplate.from_files(path, mapping_path)
+    template = templates[(path, mapping_path)]
+
+    images_to_upload = {}
+    image_names = []
+    for img_path in entry.get("images", []):
+        img_data = read_image(img_path)
+        if img_data is None:
+            raise FileNotFoundError(img_path)
+        images_to_upload[os.path.basename(img_path)] = img_data
+        image_names.append(os.path.basename(img_path))
+
+    workflow_json = template.render_json(entry.get("prompt"), image_names, entry.get("seed"))
+    return workflow_json, images_to_upload
+
+class BatchRunner:
+    """Submits manifest entries with a bounded window and polls adaptively."""
+
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.state_path = args.state or f"{args.manifest}.state.json"
+        self.state = load_state(self.state_path)
+        self.hints = {} if args.no_cache else load_input_hints()
+        self.templates = {}
+
+    async def request(self, method, path, **kwargs):
+        response = await asyncio.to_thread(
+            self.session.request, method, f"{BASE_URL}{path}", timeout=60, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def submit(self, workflow_json, images, image_refs):
+        payload = build_payload(
+            workflow_json, images, image_refs, not self.args.debug, self.args.format, delivery=delivery_request(self.args)
+        )
+        return (await self.request("POST", "/run", json=payload))["id"]
+
+    async def wait(self, job_id):
+        """
+        Polls /status (or /stream) with adaptive backoff: quick checks right
+        after submission, then slower ones while the job sits in the queue
+        or runs, resetting whenever the status or progress changes.
+        """
+        delay = self.args.min_poll
+        last_seen = None
+        streamed = []
+        while True:
+            if self.args.stream:
+                data = await self.request("GET", f"/stream/{job_id}")
+                streamed.extend(item.get("output") for item in data.get("stream", []))
+            else:
+                data = await self.request("GET", f"/status/{job_id}")
+            status = data.get("status")
+
+            if status == "COMPLETED":
+                if self.args.stream and not streamed:
+                    data = await self.request("GET", f"/status/{job_id}")
+                    return normalize_output(data.get("output"))
+                return normalize_output(streamed if self.args.stream else data.get("output"))
+            if status in ["FAILED", "CANCELLED", "TIMED_OUT"]:
+                return {"status": "error", "message": f"Job {status}: {data.get('error')}"}
+
+            seen = (status, json.dumps(data.get("progress")), len(streamed))
+            delay = self.args.min_poll if seen != last_seen else min(delay * 1.5, self.args.max_poll)
+            last_seen = seen
+            await asyncio.sleep(delay)
+
+    async def run_entry(self, index, entry, window):
+        key = str(entry.get("key", index))
+        record = self.state.setdefault(key, {})
+        if record.get("status") == "done":
+            return True
+
+        async with window:
+            try:
+                workflow_json, images = prepare_entry(entry, self.templates, self.args.mapping)
+                image_refs = {}
+                to_send = images
+                if not self.args.no_cache:
+                    image_refs = {name: hashlib.sha256(data).hexdigest() for name, data in images.items()}
+                    to_send = {n: d for n, d in images.items() if image_refs[n] not in self.hints}
+
+                if not record.get("job_id"):
+                    record.update(job_id=await self.submit(workflow_json, to_send, image_refs), status="submitted")
+                    save_state(self.state_path, self.state)
+                print(f"🆔 [{key}] Job {record['job_id']}")
+
+                output = await self.wait(record["job_id"])
+                if output.get("status") == "missing_inputs":
+                    missing = set(output.get("missing", []))
+                    to_send = {n: d for n, d in images.items() if image_refs[n] in missing}
+                    record.update(job_id=await self.submit(workflow_json, to_send, image_refs))
+                    save_state(self.state_path, self.state)
+                    output = await self.wait(record["job_id"])
+
+                if output.get("status") != "success":
+                    raise Exception(output.get("message") or output.get("status"))
+
+                out_dir = os.path.join(self.args.out_dir, key)
+                os.makedirs(out_dir, exist_ok=True)
+                await asyncio.to_thread(save_outputs, output, out_dir, "")
+                now = time.time()
+                self.hints.update({digest: now for digest in image_refs.values()})
+                record["status"] = "done"
+                print(f"✅ [{key}] Done")
+                return True
+            except Exception as e:
+                # A failed entry is retried from scratch on the next run
+                print(f"❌ [{key}] Failed: {e}")
+                record.clear()
+                record["status"] = "failed"
+                record["error"] = str(e)
+                return False
+            finally:
+                save_state(self.state_path, self.state)
+
+    async def run(self, entries):
+        window = asyncio.Semaphore(self.args.concurrency)
+        started = time.time()
+        results = await asyncio.gather(*(
+            self.run_entry(i, entry, window) for i, entry in enumerate(entries)
+        ))
+        if not self.args.no_cache:
+            save_input_hints(self.hints)
+        print(f"\n🏁 Batch finished: {sum(results)}/{len(entries)} succeeded in {time.time() - started:.1f}s")
+        print(f"   State file: {self.state_path}")
+
+# ==============================================================================
+# MAIN
+# ==============================================================================
+def delivery_request(args):
+    """The job's "delivery" input from the command line, or None for plain PNGs."""
+    delivery = {}
+    if args.output_format:
+        delivery["format"] = args.output_format
+    if args.quality is not None:
+        delivery["quality"] = args.quality
+    if args.preview:
+        delivery["preview"] = args.preview
+    if args.offload:
+        delivery["offload"] = args.offload
+    return delivery or None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Secure ComfyUI RunPod Client")
+    parser.add_argument("--workflow", default="workflow_api.json", help="API Workflow JSON file")
+    parser.add_argument("--mapping", help="JSON file naming the image/prompt/seed injection points")
+    parser.add_argument("--img", nargs='+', help="Input image(s). Mapped to LoadImage nodes by ID order.")
+    parser.add_argument("--prompt", help="Custom text prompt")
+    parser.add_argument("--poll_interval", type=int, default=2, help="Seconds between status checks")
+    parser.add_argument("--debug", action="store_true", help="Disable encryption for troubleshooting")
+    parser.add_argument("--format", choices=["fernet", "envelope"], default="fernet",
+                        help="Encrypted payload format: Fernet JSON token or compact binary envelope")
+    parser.add_argument("--no-cache", action="store_true", help="Always upload input images in full")
+    parser.add_argument("--variants", type=int, default=1, help="Run N random-seed variants in one job")
+    parser.add_argument("--manifest", help="Batch mode: JSON/JSONL list of {workflow, images, prompt} entries")
+    parser.add_argument("--concurrency", type=int, default=8, help="Batch mode: jobs in flight at once")
+    parser.add_argument("--out_dir", default="batch_out", help="Batch mode: output folder (one subfolder per entry)")
+    parser.add_argument("--state", help="Batch mode: resume state file (default: <manifest>.state.json)")
+    parser.add_argument("--stream", action="store_true", help="Batch mode: poll the /stream endpoint instead of /status")
+    parser.add_argument("--min_poll", type=float, default=0.5, help="Batch mode: shortest poll interval (s)")
+    parser.add_argument("--max_poll", type=float, default=10.0, help="Batch mode: longest poll interval (s)")
+    parser.add_argument("--output_format", choices=["png", "webp", "jpeg", "avif"], help="Have the worker transcode outputs")
+    parser.add_argument("--quality", type=int, help="Quality (1-100) for --output_format and previews")
+    parser.add_argument("--preview", type=int, help="Also return previews scaled to fit N x N pixels")
+    parser.add_argument("--offload", choices=["auto", "always", "never"],
+                        help="Return outputs as bucket URLs: above the worker's size limit (auto), always or never")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.manifest:
+        asyncio.run(BatchRunner(args).run(load_manifest(args.manifest)))
+        return
+
+    # 1. Load Workflow JSON (and resolve its injection points once)
+    if not os.path.exists(args.workflow):
+        print(f"❌ Error: Workflow file '{args.workflow}' not found.")
+        return
+
+    template = WorkflowTemplate.from_files(args.workflow, args.mapping)
+
+    # 2. Smart Injection (Plaintext Processing)
+    images_to_upload = {}
+    
+    # A. Handle Multiple Images (mapped to LoadImage nodes by numerical ID)
+    image_targets = {}
+    if args.img:
+        for i, img_path in enumerate(args.img):
+            if i >= len(template.image_slots):
+                print(f"⚠️ Warning: More images provided than LoadImage nodes. Skipping {img_path}")
+                continue
+            
+            img_data = read_image(img_path)
+            if img_data:
+                remote_name = os.path.basename(img_path)
+                images_to_upload[remote_name] = img_data
+                node_id = template.image_slots[i][0]
+                image_targets[node_id] = remote_name
+                print(f"🎯 Image Injection: '{img_path}' -> Node {node_id}")
+
+    # B. Handle Prompt and Seed Injection
+    if args.prompt:
+        for node_id, _ in template.prompt_slots:
+            print(f"✍️  Prompt Injection ({template.workflow[node_id].get('class_type')}): Node {node_id}")
+    for node_id, _ in template.seed_slots:
+        print(f"🎲 Seed Randomized: Node {node_id}")
+
+    workflow_json = template.render_json(args.prompt, image_targets)
+
+    # 3. Content-addressed inputs: skip uploads a warm worker likely holds
+    is_encrypted = not args.debug
+    image_refs = {}
+    to_send = dict(images_to_upload)
+    hints = {}
+    if not args.no_cache:
+        hints = load_input_hints()
+        image_refs = {name: hashlib.sha256(data).hexdigest() for name, data in images_to_upload.items()}
+        to_send = {name: data for name, data in images_to_upload.items() if image_refs[name] not in hints}
+        if len(to_send) < len(images_to_upload):
+            print(f"♻️  Sending {len(images_to_upload) - len(to_send)} image(s) by hash only.")
+
+    # Seed sweep: one job, N variants queued together on the worker
+    variants = None
+    if args.variants > 1:
+        variants = [{"key": f"v{i}", "seed": "random"} for i in range(args.variants)]
+        print(f"🎲 Batch: {args.variants} seed variants in one job.")
+
+    # 4. Construct Payload (Encryption Layer) and Submit
+    delivery = delivery_request(args)
+    payload = build_payload(workflow_json, to_send, image_refs, is_encrypted, args.format, variants, delivery)
+    output = submit_and_wait(payload, args.poll_interval)
+
+    if output and output.get("status") == "missing_inputs":
+        # Cold worker (or evicted entry): resend with the missing bytes
+        missing = set(output.get("missing", []))
+        print(f"📤 Worker is missing {len(missing)} input(s); re-uploading.")
+        to_send = {name: data for name, data in images_to_upload.items() if image_refs[name] in missing}
+        payload = build_payload(workflow_json, to_send, image_refs, is_encrypted, args.format, variants, delivery)
+        output = submit_and_wait(payload, args.poll_interval)
+
+    if output is None:
+        return
+
+    # 5. Save Results
+    if output.get("status") == "success":
+        save_outputs(output)
+        if image_refs:
+            now = time.time()
+            hints.update({digest: now for digest in image_refs.values()})
+            save_input_hints(hints)
+    else:
+        print(f"❌ Worker Error: {output.get('message')}")
+
 if __name__ == "__main__":
     main()
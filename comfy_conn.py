@@ -0,0 +1,205 @@
+import collections
+import json
+import queue
+import threading
+import time
+import uuid
+
+import requests
+import websocket
+
+# =================================================================
+# PERSISTENT COMFYUI CONNECTION
+# =================================================================
+# Events are delivered to subscribers as (kind, payload) tuples:
+#   ("json", message_dict)   - a text frame for that prompt, stamped with
+#                              "received_at" (time.monotonic() on arrival)
+#   ("binary", bytes)        - a binary frame sent while that prompt ran
+#   ("disconnected", None)   - the websocket dropped; events may be lost
+class ComfyConnection:
+    """
+    One websocket and one keep-alive HTTP session for the whole worker
+    lifetime. A background thread reads the websocket and routes every
+    message to the queue of the prompt it belongs to, reconnecting with
+    backoff whenever the socket drops.
+    """
+
+    def __init__(self, server_address, connect_timeout=10):
+        self.server_address = server_address
+        self.base_url = f"http://{server_address}"
+        self.client_id = str(uuid.uuid4())
+        self.connect_timeout = connect_timeout
+        self.session = requests.Session()
+        self._ws = None
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._released = collections.deque(maxlen=512)
+        self._current = None
+        self._connected = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+    # -------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------
+    def get(self, path, **kwargs):
+        return self.session.get(f"{self.base_url}{path}", **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(f"{self.base_url}{path}", **kwargs)
+
+    def queue_prompt(self, prompt):
+        """Submits a prompt and returns (prompt_id, event_queue)."""
+        response = self.post("/prompt", json={"prompt": prompt, "client_id": self.client_id})
+        response.raise_for_status()
+        prompt_id = response.json()['prompt_id']
+        return prompt_id, self.subscribe(prompt_id)
+
+    def prompt_state(self, prompt_id, timeout=5):
+        """"running", "pending", "done" (in /history) or "unknown" (also when ComfyUI does not answer)."""
+        try:
+            queue_state = self.get("/queue", timeout=timeout).json()
+            if any(entry[1] == prompt_id for entry in queue_state.get("queue_running", [])):
+                return "running"
+            if any(entry[1] == prompt_id for entry in queue_state.get("queue_pending", [])):
+                return "pending"
+            if self.get(f"/history/{prompt_id}", timeout=timeout).json().get(prompt_id):
+                return "done"
+        except Exception:
+            pass
+        return "unknown"
+
+    def cancel(self, prompt_ids, timeout=5):
+        """
+        Stops prompts the worker gave up on: pending ones are deleted from
+        the queue first (so none of them starts next), then a running one
+        is interrupted. Prompts of other clients are never touched.
+        Returns {"deleted": [...], "interrupted": [...]}.
+        """
+        prompt_ids = set(prompt_ids)
+        queue_state = self.get("/queue", timeout=timeout).json()
+        pending = sorted({entry[1] for entry in queue_state.get("queue_pending", [])} & prompt_ids)
+        if pending:
+            self.post("/queue", json={"delete": pending}, timeout=timeout).raise_for_status()
+            # One of them may have started before the delete landed
+            queue_state = self.get("/queue", timeout=timeout).json()
+        running = sorted({entry[1] for entry in queue_state.get("queue_running", [])} & prompt_ids)
+        for prompt_id in running:
+            # The ID limits the interrupt to this prompt, even if another
+            # client's prompt has started since /queue was read
+            self.post("/interrupt", json={"prompt_id": prompt_id}, timeout=timeout).raise_for_status()
+        for prompt_id in prompt_ids:
+            self.release(prompt_id)
+        return {"deleted": pending, "interrupted": running}
+
+    # -------------------------------------------------------------
+    # WEBSOCKET
+    # -------------------------------------------------------------
+    def start(self, wait=True):
+        """Starts the receiver thread (idempotent) and waits for the socket."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="comfy-ws", daemon=True)
+                self._thread.start()
+        if wait and not self._connected.wait(self.connect_timeout):
+            raise Exception(f"Could not connect to ComfyUI websocket at {self.server_address}.")
+
+    def close(self):
+        """Stops the receiver thread and closes the socket and HTTP session."""
+        self._closed.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=self.connect_timeout)
+        self.session.close()
+
+    def subscribe(self, prompt_id):
+        with self._lock:
+            return self._queue_for(prompt_id)
+
+    def release(self, prompt_id):
+        with self._lock:
+            self._queues.pop(prompt_id, None)
+            self._released.append(prompt_id)
+
+    def _queue_for(self, prompt_id):
+        # Events can arrive before /prompt has returned the ID to the caller,
+        # so queues are created on first sight and picked up by subscribe().
+        q = self._queues.get(prompt_id)
+        if q is None and prompt_id not in self._released:
+            q = self._queues[prompt_id] = queue.Queue()
+        return q
+
+    def _dispatch(self, prompt_id, event):
+        if prompt_id is None:
+            return
+        with self._lock:
+            q = self._queue_for(prompt_id)
+        if q is not None:
+            q.put(event)
+
+    def _handle(self, out):
+        if not isinstance(out, str):
+            # Binary frames carry no prompt ID; ComfyUI runs one prompt at a time.
+            self._dispatch(self._current, ("binary", out))
+            return
+
+        message = json.loads(out)
+        message['received_at'] = time.monotonic()
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+        msg_type = message.get('type')
+
+        if msg_type in ('execution_start', 'executing') and prompt_id:
+            self._current = prompt_id
+        self._dispatch(prompt_id or self._current, ("json", message))
+        if msg_type == 'executing' and data.get('node') is None and prompt_id == self._current:
+            self._current = None
+
+    def _run(self):
+        delay = 0.1
+        while not self._closed.is_set():
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(
+                    f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                    timeout=self.connect_timeout
+                )
+                ws.settimeout(None)
+                self._ws = ws
+                if self._closed.is_set():
+                    raise ConnectionError("connection closed")
+                self._connected.set()
+                delay = 0.1
+                while True:
+                    out = ws.recv()
+                    if not ws.connected:
+                        raise ConnectionError("socket closed by server")
+                    self._handle(out)
+            except Exception as e:
+                if self._closed.is_set():
+                    self._on_disconnect()
+                    return
+                if self._connected.is_set():
+                    print(f"⚠️ ComfyUI websocket dropped: {e}. Reconnecting...")
+                self._on_disconnect()
+            self._closed.wait(delay)
+            delay = min(delay * 2, 5.0)
+
+    def _on_disconnect(self):
+        self._connected.clear()
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+        self._current = None
+        with self._lock:
+            waiting = list(self._queues.values())
+        for q in waiting:
+            q.put(("disconnected", None))
@@ -0,0 +1,250 @@
+import base64
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# =================================================================
+# OUTPUT DELIVERY
+# =================================================================
+# ComfyUI saves full-size PNGs. A job's "delivery" input can ask for them
+# as WebP/JPEG/AVIF at a given quality, plus a downscaled preview of each.
+# Outputs are encoded on a thread pool (Pillow releases the GIL) while the
+# next ones are still being read. Anything larger than OUTPUT_INLINE_MAX_KB,
+# or past the job's inline budget, goes to an S3-compatible bucket (AWS,
+# R2, MinIO) and a presigned URL is returned in its place.
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", 4))
+OUTPUT_INLINE_MAX_KB = int(os.environ.get("OUTPUT_INLINE_MAX_KB", 2048))
+# RunPod rejects oversized results; keep the base64 data of a response under this
+OUTPUT_INLINE_BUDGET_MB = float(os.environ.get("OUTPUT_INLINE_BUDGET_MB", 8))
+OUTPUT_URL_EXPIRY = int(os.environ.get("OUTPUT_URL_EXPIRY", 3600))
+
+# format: (Pillow format, extension, content type)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png", "image/png"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "avif": ("AVIF", ".avif", "image/avif"),
+}
+# Still images Pillow can re-encode; gifs, videos and audio pass through
+TRANSCODABLE = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+CONTENT_TYPES = {
+    ".gif": "image/gif", ".mp4": "video/mp4", ".webm": "video/webm",
+    ".wav": "audio/wav", ".mp3": "audio/mpeg", ".flac": "audio/flac",
+}
+OFFLOAD_MODES = ("auto", "always", "never")
+
+_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="deliver")
+
+def delivery_options(spec):
+    """
+    Validates a job's "delivery" input: {"format": "webp", "quality": 80,
+    "preview": 512, "offload": "auto"}. Every field is optional.
+    """
+    spec = spec or {}
+    fmt = str(spec.get("format", "png")).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{fmt}' (use {', '.join(OUTPUT_FORMATS)}).")
+    if fmt == "avif":
+        from PIL import features
+        if not features.check("avif"):
+            raise ValueError("AVIF output is not supported by this worker's Pillow build.")
+    quality = int(spec.get("quality", 85))
+    if not 1 <= quality <= 100:
+        raise ValueError("Output quality must be between 1 and 100.")
+    preview = spec.get("preview")
+    if preview is not None and int(preview) <= 0:
+        raise ValueError("Preview size must be a positive number of pixels.")
+    offload = spec.get("offload", "auto")
+    if offload not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown offload mode '{offload}' (use {', '.join(OFFLOAD_MODES)}).")
+    return {"format": fmt, "quality": quality, "preview": int(preview) if preview else None, "offload": offload}
+
+def content_type(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    for _, format_ext, mime in OUTPUT_FORMATS.values():
+        if ext == format_ext:
+            return mime
+    return "image/jpeg" if ext == ".jpeg" else CONTENT_TYPES.get(ext, "application/octet-stream")
+
+def _encode(image, fmt, quality):
+    pil_format = OUTPUT_FORMATS[fmt][0]
+    if fmt == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    out = io.BytesIO()
+    if fmt == "png":
+        image.save(out, pil_format, compress_level=4)
+    else:
+        image.save(out, pil_format, quality=quality)
+    return out.getvalue()
+
+def transcode(filename, data, fmt, quality=85, preview=None):
+    """
+    Re-encodes one output. Returns [(filename, bytes)]: the output itself
+    (unchanged if it is not a still image or already in `fmt`) and, with
+    `preview`, a copy scaled to fit preview x preview pixels.
+    """
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() not in TRANSCODABLE:
+        return [(filename, data)]
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return [(filename, data)]
+        target_ext = OUTPUT_FORMATS[fmt][1]
+        if ext.lower() == target_ext or (fmt == "jpeg" and ext.lower() == ".jpeg"):
+            results = [(filename, data)]
+        else:
+            results = [(stem + target_ext, _encode(image, fmt, quality))]
+        if preview:
+            small = image.copy()
+            small.thumbnail((preview, preview))
+            # A PNG preview would defeat the point; default those to WebP
+            preview_fmt = "webp" if fmt == "png" else fmt
+            results.append((f"{stem}_preview{OUTPUT_FORMATS[preview_fmt][1]}", _encode(small, preview_fmt, quality)))
+    return results
+
+
+class OutputBucket:
+    """S3-compatible bucket that large outputs are uploaded to."""
+
+    def __init__(self, name, endpoint_url=None, access_key=None, secret_key=None,
+                 region=None, prefix="", expiry=OUTPUT_URL_EXPIRY):
+        import boto3
+        from botocore.config import Config
+
+        self.name = name
+        self.prefix = prefix
+        self.expiry = expiry
+        # Path-style addressing works with MinIO and other self-hosted stores
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key, region_name=region or "us-east-1",
+            config=Config(
+                signature_version="s3v4", s3={"addressing_style": "path"},
+                retries={"max_attempts": 3}, max_pool_connections=ENCODE_WORKERS * 2
+            )
+        )
+
+    @classmethod
+    def from_env(cls):
+        """
+        The bucket named by BUCKET_NAME, reached through RunPod's usual
+        BUCKET_ENDPOINT_URL / BUCKET_ACCESS_KEY_ID / BUCKET_SECRET_ACCESS_KEY;
+        None when BUCKET_NAME is not set.
+        """
+        name = os.environ.get("BUCKET_NAME")
+        if not name:
+            return None
+        try:
+            import boto3  # noqa: F401
+        except ImportError:
+            raise RuntimeError("BUCKET_NAME is set but boto3 is not installed; pip install boto3 or unset BUCKET_NAME.")
+        return cls(
+            name,
+            os.environ.get("BUCKET_ENDPOINT_URL"),
+            os.environ.get("BUCKET_ACCESS_KEY_ID"),
+            os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+            os.environ.get("BUCKET_REGION"),
+            os.environ.get("BUCKET_PREFIX", "outputs/")
+        )
+
+    def upload(self, key, data, mime):
+        """Stores `data` under prefix + key; returns a presigned GET URL."""
+        key = self.prefix + key
+        self.client.put_object(Bucket=self.name, Key=key, Body=data, ContentType=mime)
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.name, "Key": key}, ExpiresIn=self.expiry
+        )
+
+
+class Delivery:
+    """
+    Turns one job's raw outputs into what goes back to the client. `run`
+    wraps execute_job's events: each ("output", key, filename, bytes) is
+    transcoded, then either kept inline (raw bytes if `raw`, since envelopes
+    carry them, else base64) or uploaded, becoming
+    ("link", key, filename, {"url", "size", "content_type", "expires_in"}).
+    With `seal_blob(filename, data)`, uploads are encrypted first and the
+    link says how (`"sealed": sealed_as`). Encrypted jobs must pass one;
+    without it uploads are stored as plaintext.
+    """
+
+    def __init__(self, options, job_id, bucket=None, seal_blob=None, metrics=None, raw=False, sealed_as=True,
+                 inline_max=OUTPUT_INLINE_MAX_KB * 1024, inline_budget=int(OUTPUT_INLINE_BUDGET_MB * 1024 * 1024)):
+        self.options = options
+        self.job_id = job_id
+        self.bucket = bucket
+        self.seal_blob = seal_blob
+        self.raw = raw
+        self.sealed_as = sealed_as
+        self.metrics = metrics
+        self.inline_max = inline_max
+        self.inline_left = inline_budget
+        self._lock = threading.Lock()
+
+    def _keep_inline(self, data):
+        offload = self.options["offload"]
+        if self.bucket is None or offload == "never":
+            return True
+        if offload == "always" or len(data) > self.inline_max:
+            return False
+        # Outputs finish in parallel, so which ones overflow the budget can vary
+        encoded = (len(data) + 2) // 3 * 4
+        with self._lock:
+            if encoded > self.inline_left:
+                return False
+            self.inline_left -= encoded
+            return True
+
+    def process(self, key, filename, data):
+        """Transcodes and places one output; returns the events that replace it."""
+        options = self.options
+        if options["format"] != "png" or options["preview"]:
+            files = transcode(filename, data, options["format"], options["quality"], options["preview"])
+        else:
+            files = [(filename, data)]
+
+        events = []
+        for name, blob in files:
+            if self._keep_inline(blob):
+                events.append(("output", key, name, blob if self.raw else base64.b64encode(blob).decode('utf-8')))
+                continue
+            mime = content_type(name)
+            object_name = f"{self.job_id}/{name}" if key is None else f"{self.job_id}/{key}/{name}"
+            if self.seal_blob:
+                blob, object_name, mime = self.seal_blob(name, blob), object_name + ".sealed", "application/octet-stream"
+            url = self.bucket.upload(object_name, blob, mime)
+            ref = {"url": url, "size": len(blob), "content_type": mime, "expires_in": self.bucket.expiry}
+            if self.seal_blob:
+                ref["sealed"] = self.sealed_as
+            events.append(("link", key, name, ref))
+        return events
+
+    def _drain(self, pending, wait):
+        """Results of finished futures, oldest first (all of them if `wait`)."""
+        events = []
+        timing = self.metrics.phase("deliver") if wait and self.metrics is not None else nullcontext()
+        with timing:
+            while pending and (wait or pending[0].done()):
+                events.extend(pending.popleft().result())
+        return events
+
+    def run(self, events):
+        """Yields `events` with outputs delivered, in their original order."""
+        pending = deque()
+        for event in events:
+            if event[0] == "output":
+                pending.append(_pool.submit(self.process, *event[1:]))
+                yield from self._drain(pending, wait=False)
+            else:
+                # Every output of a variant comes before its "done"
+                yield from self._drain(pending, wait=True)
+                yield event
+        yield from self._drain(pending, wait=True)
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from comfy_conn import ComfyConnection
+from injection import workflow_model_refs
+
+# =================================================================
+# MULTI-BACKEND DISPATCH
+# =================================================================
+# One handler can front several ComfyUI instances (one per GPU, or a CPU
+# instance for preprocessing). Each job goes to the healthy instance with
+# the lowest score: queue depth, plus AFFINITY_WEIGHT if the instance has
+# not recently run every model the workflow loads (it would have to load
+# them into VRAM first).
+COMFY_BASE_PORT = 8188
+
+def instance_addresses():
+    """
+    Addresses of the local ComfyUI instances: COMFY_SERVERS (comma list)
+    if set, else one per COMFY_DEVICES entry / COMFY_INSTANCES from 8188 up.
+    """
+    servers = os.environ.get("COMFY_SERVERS")
+    if servers:
+        return [s.strip() for s in servers.split(",") if s.strip()]
+    return [f"127.0.0.1:{COMFY_BASE_PORT + i}" for i in range(len(instance_devices()))]
+
+def instance_devices():
+    """Per-instance device ("0", "1", "cpu"; None = ComfyUI's default)."""
+    devices = os.environ.get("COMFY_DEVICES")
+    if devices:
+        return [d.strip() for d in devices.split(",") if d.strip()]
+    count = int(os.environ.get("COMFY_INSTANCES", 1))
+    return [None] if count == 1 else [str(i) for i in range(count)]
+
+
+class Backend:
+    """One ComfyUI instance: its connection, health and recent models."""
+
+    def __init__(self, address, resident_models=8):
+        self.address = address
+        self.conn = ComfyConnection(address)
+        self.healthy = True
+        self.remote_depth = 0
+        self.inflight = 0
+        self.resident_models = resident_models
+        self.models = OrderedDict()
+
+    @property
+    def depth(self):
+        # Our own in-flight count is current; /queue also sees other clients
+        return max(self.inflight, self.remote_depth)
+
+    def missing_models(self, models):
+        return [m for m in models if m not in self.models]
+
+    def note_models(self, models):
+        for model in models:
+            self.models.pop(model, None)
+            self.models[model] = True
+        while len(self.models) > self.resident_models:
+            self.models.popitem(last=False)
+
+    def check(self, timeout=2):
+        """Refreshes health and queue depth from /system_stats and /queue."""
+        try:
+            self.conn.get("/system_stats", timeout=timeout).raise_for_status()
+            queue = self.conn.get("/queue", timeout=timeout).json()
+            self.remote_depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+            if not self.healthy:
+                print(f"✅ ComfyUI backend {self.address} is healthy again.")
+            self.healthy = True
+        except Exception as e:
+            if self.healthy:
+                print(f"⚠️ ComfyUI backend {self.address} failed its health check: {e}")
+            self.healthy = False
+
+
+class Dispatcher:
+    """Routes jobs across Backends; a health thread polls them in the background."""
+
+    def __init__(self, addresses, affinity_weight=1.0, health_interval=5.0):
+        self.backends = [Backend(address) for address in addresses]
+        self.affinity_weight = affinity_weight
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        """Connects every backend that answers and starts health checks (idempotent)."""
+        with self._lock:
+            first = self._thread is None
+            if first:
+                self._thread = threading.Thread(target=self._health_loop, name="comfy-health", daemon=True)
+        if not first:
+            # Jobs arriving together at cold start wait for the first health round
+            self._started.wait()
+            return
+        for backend in self.backends:
+            backend.check()
+            if backend.healthy:
+                try:
+                    backend.conn.start()
+                except Exception:
+                    backend.healthy = False
+        self._thread.start()
+        self._started.set()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for backend in self.backends:
+                backend.check()
+
+    def score(self, backend, models):
+        return backend.depth + self.affinity_weight * bool(backend.missing_models(models))
+
+    def acquire(self, workflows):
+        """Picks the backend for a job's workflows and counts the job against it."""
+        self.start()
+        models = set()
+        for workflow in workflows:
+            models |= workflow_model_refs(workflow)
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy]
+            if not candidates:
+                raise Exception("No healthy ComfyUI backend available.")
+            # Ties go to the first instance, keeping routing stable
+            backend = min(candidates, key=lambda b: self.score(b, models))
+            backend.inflight += 1
+        try:
+            backend.conn.start()
+        except Exception:
+            self.release(backend)
+            # Do not wait for the next health round to stop routing to it
+            backend.check()
+            raise
+        return backend
+
+    def completed(self, backend, workflow):
+        """Records that `workflow` ran to the end on `backend`, so its models are loaded there."""
+        models = workflow_model_refs(workflow)
+        with self._lock:
+            backend.note_models(models)
+
+    def release(self, backend):
+        with self._lock:
+            backend.inflight -= 1
@@ -0,0 +1,138 @@
+import base64
+import json
+import os
+import struct
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# =================================================================
+# BINARY ENCRYPTED ENVELOPE (v1)
+# =================================================================
+# Layout:
+#   MAGIC (3) | VERSION (1) | NONCE PREFIX (7) | CHUNK SIZE (uint32 BE)
+#   chunk_0 | chunk_1 | ... | chunk_n
+#
+# The plaintext is split into CHUNK SIZE pieces, each sealed with
+# AES-256-GCM (16-byte tag) under nonce = prefix | index (uint32) | last
+# flag, with the 15-byte header as associated data. Reordering, dropping
+# or truncating chunks therefore fails authentication.
+#
+# Plaintext: HEADER LEN (uint32 BE) | header JSON | blob bytes...
+# The header JSON is {"meta": {...}, "blobs": [[name, size], ...]} and the
+# blobs follow back to back in that order, as raw bytes (no base64).
+MAGIC = b"CEV"
+VERSION = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_PREFIX = struct.Struct(">3sB7sI")
+_TAG_SIZE = 16
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def derive_key(fernet_key):
+    """Derives the AES-256-GCM key from the shared Fernet ENCRYPTION_KEY."""
+    raw = base64.urlsafe_b64decode(fernet_key.encode() if isinstance(fernet_key, str) else fernet_key)
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"comfy-endpoint envelope v1",
+    ).derive(raw)
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+def _iter_plaintext(parts, chunk_size):
+    """Yields full chunk_size slices across `parts`, then the remainder."""
+    buf = bytearray()
+    for part in parts:
+        view = memoryview(part)
+        while len(view):
+            take = min(chunk_size - len(buf), len(view))
+            buf += view[:take]
+            view = view[take:]
+            if len(buf) == chunk_size:
+                yield bytes(buf)
+                buf.clear()
+    yield bytes(buf)
+
+
+def seal(key, meta, blobs=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Encrypts `meta` and `blobs` ({name: bytes}) into an envelope. `meta` is
+    JSON-able, or a str holding already-serialized JSON.
+    """
+    blobs = blobs or {}
+    meta_json = meta if isinstance(meta, str) else json.dumps(meta)
+    blob_table = json.dumps([[name, len(data)] for name, data in blobs.items()])
+    header = f'{{"meta": {meta_json}, "blobs": {blob_table}}}'.encode()
+    parts = [struct.pack(">I", len(header)), header, *blobs.values()]
+
+    prefix = os.urandom(7)
+    aad = _PREFIX.pack(MAGIC, VERSION, prefix, chunk_size)
+    aead = AESGCM(key)
+
+    # _iter_plaintext always ends with a short (possibly empty) chunk, so
+    # every chunk but the last is full and the last one is flagged.
+    out = bytearray(aad)
+    chunks = _iter_plaintext(parts, chunk_size)
+    chunk = next(chunks)
+    index = 0
+    for following in chunks:
+        out += aead.encrypt(_nonce(prefix, index, False), chunk, aad)
+        index += 1
+        chunk = following
+    out += aead.encrypt(_nonce(prefix, index, True), chunk, aad)
+    return bytes(out)
+
+
+def unseal(key, data):
+    """Decrypts an envelope. Returns (meta, {name: memoryview})."""
+    data = memoryview(data)
+    if len(data) < _PREFIX.size + _TAG_SIZE:
+        raise EnvelopeError("Envelope too short.")
+    magic, version, prefix, chunk_size = _PREFIX.unpack(data[:_PREFIX.size])
+    if magic != MAGIC:
+        raise EnvelopeError("Not an envelope (bad magic).")
+    if version != VERSION:
+        raise EnvelopeError(f"Unsupported envelope version {version}.")
+    if chunk_size <= 0:
+        raise EnvelopeError("Invalid chunk size.")
+
+    aad = bytes(data[:_PREFIX.size])
+    body = data[_PREFIX.size:]
+    sealed_chunk = chunk_size + _TAG_SIZE
+    n_chunks = len(body) // sealed_chunk + 1
+    if len(body) < n_chunks * _TAG_SIZE:
+        raise EnvelopeError("Envelope truncated.")
+    plain = bytearray(len(body) - n_chunks * _TAG_SIZE)
+
+    aead = AESGCM(key)
+    pos = 0
+    try:
+        for index in range(n_chunks):
+            sealed = body[index * sealed_chunk:(index + 1) * sealed_chunk]
+            chunk = aead.decrypt(_nonce(prefix, index, index == n_chunks - 1), bytes(sealed), aad)
+            plain[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    except Exception:
+        raise EnvelopeError("Envelope authentication failed.")
+
+    view = memoryview(plain)
+    (header_len,) = struct.unpack(">I", view[:4])
+    header = json.loads(bytes(view[4:4 + header_len]))
+    offset = 4 + header_len
+    blobs = {}
+    for name, size in header.get("blobs", []):
+        blobs[name] = view[offset:offset + size]
+        offset += size
+    if offset != len(view):
+        raise EnvelopeError("Envelope blob table does not match payload size.")
+    return header.get("meta", {}), blobs
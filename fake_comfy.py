@@ -0,0 +1,290 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =================================================================
+# FAKE COMFYUI SERVER
+# =================================================================
+# A GPU-free stand-in for the parts of ComfyUI the handler talks to:
+#   POST /prompt, GET /ws (websocket), GET /history/{id}, GET /queue,
+#   GET /system_stats, GET /object_info, POST /interrupt
+# Prompts run one at a time like the real server. Per node it sends
+# `executing`; nodes with a `seed` input emit `steps` progress events
+# `step_delay` apart; SaveImage writes PNGs to the output folder and sends
+# `executed`; SaveImageWebsocket sends binary image frames instead.
+# For failure tests, a node input `fake_seconds` makes it run that long
+# (until interrupted) and `fake_error` makes it fail with execution_error.
+# POST /interrupt and POST /queue {"delete": [...]} behave like ComfyUI's.
+# Used by bench_handler.py; run standalone for manual testing.
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# /object_info for the core nodes used in tests and benchmarks. Required
+# inputs are trimmed to what the fake needs, so minimal workflows validate.
+OBJECT_INFO = {
+    "LoadImage": {"input": {"required": {"image": [[], {"image_upload": True}]}}, "output": ["IMAGE", "MASK"]},
+    "CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [[]]}}, "output": ["MODEL", "CLIP", "VAE"]},
+    "CLIPTextEncode": {"input": {"required": {"text": ["STRING", {}]}}, "output": ["CONDITIONING"]},
+    "KSampler": {"input": {"required": {"seed": ["INT", {}]}}, "output": ["LATENT"]},
+    "VAEDecode": {"input": {"required": {"samples": ["LATENT"]}}, "output": ["IMAGE"]},
+    "SaveImage": {"input": {"required": {"images": ["IMAGE"]}}, "output": []},
+    "SaveImageWebsocket": {"input": {"required": {"images": ["IMAGE"]}}, "output": []},
+}
+
+def make_png(num_bytes):
+    """A valid PNG of roughly `num_bytes` (random pixels do not compress)."""
+    side = max(1, int((num_bytes / 3) ** 0.5))
+    raw = b"".join(b"\x00" + os.urandom(side * 3) for _ in range(side))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+class FakeComfyUI:
+    def __init__(self, output_dir, steps=4, step_delay=0.005, output_bytes=256 * 1024, images_per_node=1):
+        self.output_dir = output_dir
+        self.steps = steps
+        self.step_delay = step_delay
+        self.images_per_node = images_per_node
+        self.png = make_png(output_bytes)
+        self.clients = {}
+        self.history = {}
+        self.pending = []
+        self.running = []
+        self.counter = 0
+        self.interrupted = False
+        self.deleted = set()
+        self._queue = queue.Queue()
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    # -------------------------------------------------------------
+    # WEBSOCKET
+    # -------------------------------------------------------------
+    def send(self, client_id, payload, binary=False):
+        sock = self.clients.get(client_id)
+        if sock is None:
+            return
+        data = payload if binary else json.dumps(payload).encode()
+        opcode = 0x82 if binary else 0x81
+        size = len(data)
+        if size < 126:
+            header = bytes([opcode, size])
+        elif size < 65536:
+            header = bytes([opcode, 126]) + struct.pack(">H", size)
+        else:
+            header = bytes([opcode, 127]) + struct.pack(">Q", size)
+        try:
+            with self._send_lock:
+                sock.sendall(header + data)
+        except OSError:
+            self.clients.pop(client_id, None)
+
+    # -------------------------------------------------------------
+    # EXECUTION
+    # -------------------------------------------------------------
+    def submit(self, prompt, client_id):
+        prompt_id = str(uuid.uuid4())
+        self.pending.append(prompt_id)
+        self._queue.put((prompt_id, prompt, client_id))
+        return prompt_id
+
+    def delete(self, prompt_ids):
+        for prompt_id in prompt_ids:
+            if prompt_id in self.pending:
+                self.pending.remove(prompt_id)
+                self.deleted.add(prompt_id)
+
+    def _worker(self):
+        while True:
+            prompt_id, prompt, client_id = self._queue.get()
+            if prompt_id in self.deleted:
+                continue
+            self.pending.remove(prompt_id)
+            self.running = [prompt_id]
+            self.interrupted = False
+            started = time.monotonic()
+            outputs, error = self._execute(prompt_id, prompt, client_id)
+            messages = [["execution_start", {"prompt_id": prompt_id}]]
+            if error:
+                messages.append(error)
+                self.send(client_id, {"type": error[0], "data": error[1]})
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, []],
+                "outputs": outputs,
+                "status": {"status_str": "error" if error else "success", "completed": not error, "messages": messages},
+                "execution_seconds": time.monotonic() - started
+            }
+            self.running = []
+            if not error:
+                self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+                self.send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+
+    def _execute(self, prompt_id, prompt, client_id):
+        """Returns (outputs, None) or (outputs, [error event type, data])."""
+        self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        self.send(client_id, {"type": "execution_cached", "data": {"nodes": [], "prompt_id": prompt_id}})
+        outputs = {}
+        for node_id, node in prompt.items():
+            class_type = node.get("class_type")
+            inputs = node.get("inputs", {})
+            self.send(client_id, {"type": "executing", "data": {"node": node_id, "display_node": node_id, "prompt_id": prompt_id}})
+            if inputs.get("fake_error"):
+                return outputs, ["execution_error", {
+                    "prompt_id": prompt_id, "node_id": node_id, "node_type": class_type,
+                    "exception_type": "RuntimeError", "exception_message": str(inputs["fake_error"])
+                }]
+            deadline = time.monotonic() + inputs.get("fake_seconds", 0)
+            while time.monotonic() < deadline and not self.interrupted:
+                time.sleep(0.01)
+            if self.interrupted:
+                return outputs, ["execution_interrupted", {
+                    "prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": list(outputs)
+                }]
+            if "seed" in inputs:
+                for step in range(self.steps):
+                    time.sleep(self.step_delay)
+                    self.send(client_id, {"type": "progress", "data": {
+                        "value": step + 1, "max": self.steps, "prompt_id": prompt_id, "node": node_id
+                    }})
+            if class_type == "SaveImage":
+                subfolder, _, base = inputs.get("filename_prefix", "ComfyUI").rpartition("/")
+                os.makedirs(os.path.join(self.output_dir, subfolder), exist_ok=True)
+                images = []
+                for _ in range(self.images_per_node):
+                    self.counter += 1
+                    filename = f"{base}_{self.counter:05}_.png"
+                    with open(os.path.join(self.output_dir, subfolder, filename), "wb") as f:
+                        f.write(self.png)
+                    images.append({"filename": filename, "subfolder": subfolder, "type": "output"})
+                outputs[node_id] = {"images": images}
+                self.send(client_id, {"type": "executed", "data": {
+                    "node": node_id, "display_node": node_id, "output": outputs[node_id], "prompt_id": prompt_id
+                }})
+            elif class_type == "SaveImageWebsocket":
+                for _ in range(self.images_per_node):
+                    self.send(client_id, struct.pack(">II", 1, 2) + self.png, binary=True)
+                self.send(client_id, {"type": "executed", "data": {
+                    "node": node_id, "display_node": node_id, "output": None, "prompt_id": prompt_id
+                }})
+        return outputs, None
+
+    # -------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, obj, code=200):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/ws"):
+                    return self.websocket()
+                if self.path.startswith("/history/"):
+                    prompt_id = self.path.rsplit("/", 1)[-1]
+                    entry = server.history.get(prompt_id)
+                    return self.reply({prompt_id: entry} if entry else {})
+                if self.path == "/queue":
+                    return self.reply({
+                        "queue_running": [[0, p] for p in server.running],
+                        "queue_pending": [[0, p] for p in server.pending]
+                    })
+                if self.path == "/object_info":
+                    return self.reply(OBJECT_INFO)
+                if self.path == "/system_stats":
+                    return self.reply({"system": {"comfyui_version": "fake"}, "devices": []})
+                return self.reply({})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/prompt":
+                    prompt_id = server.submit(body["prompt"], body.get("client_id"))
+                    return self.reply({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+                if self.path == "/interrupt":
+                    target = body.get("prompt_id")
+                    if target is None or target in server.running:
+                        server.interrupted = True
+                if self.path == "/queue":
+                    server.delete(body.get("delete", []))
+                return self.reply({})
+
+            def websocket(self):
+                client_id = self.path.split("clientId=")[-1]
+                key = self.headers["Sec-WebSocket-Key"]
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                server.clients[client_id] = self.connection
+                server.send(client_id, {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id}})
+                try:
+                    while True:
+                        frame = self.connection.recv(4096)
+                        if not frame:
+                            break
+                        if frame[0] & 0x0F == 0x8:
+                            # Answer the close frame so the client is not left waiting
+                            with server._send_lock:
+                                self.connection.sendall(b"\x88\x00")
+                            break
+                except OSError:
+                    pass
+                server.clients.pop(client_id, None)
+                self.close_connection = True
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8188):
+        """Starts serving on a background thread; returns the HTTP server."""
+        httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPU-free ComfyUI stand-in")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output_dir", default="fake_output")
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--step_delay", type=float, default=0.005, help="Seconds per sampler step")
+    parser.add_argument("--output_kb", type=int, default=256, help="Size of each output PNG")
+    parser.add_argument("--images_per_node", type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeComfyUI(
+        args.output_dir, args.steps, args.step_delay, args.output_kb * 1024, args.images_per_node
+    )
+    httpd = fake.serve(port=args.port)
+    print(f"🧪 Fake ComfyUI on 127.0.0.1:{args.port} (outputs in {args.output_dir})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
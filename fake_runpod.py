@@ -0,0 +1,223 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.fernet import Fernet
+from envelope import derive_key, seal, unseal
+from fake_comfy import make_png
+
+# =================================================================
+# FAKE RUNPOD SERVERLESS API
+# =================================================================
+# An in-memory stand-in for the endpoint API client.py talks to:
+#   POST /run, GET /status/{id}, GET /stream/{id}, POST /cancel/{id}
+# Jobs sit IN_QUEUE for `queue_delay` seconds and IN_PROGRESS for
+# `run_delay`, then complete with one PNG per variant. The fake worker
+# opens plain, Fernet and envelope inputs with ENCRYPTION_KEY and answers
+# in kind, and remembers uploaded input hashes like a warm worker: image
+# references it has not seen get a "missing_inputs" answer. Point the
+# client at it with RUNPOD_BASE_URL=http://127.0.0.1:8000.
+
+class FakeRunPod:
+    def __init__(self, key=None, queue_delay=0.02, run_delay=0.05, output_bytes=16 * 1024):
+        key = key or os.environ.get("ENCRYPTION_KEY")
+        self.cipher = Fernet(key.encode()) if key else None
+        self.envelope_key = derive_key(key) if key else None
+        self.queue_delay = queue_delay
+        self.run_delay = run_delay
+        self.png = make_png(output_bytes)
+        self.jobs = {}
+        self.inputs = set()
+        self.submitted = 0
+        self.missing_answers = 0
+        self.polls = 0
+        self._lock = threading.RLock()
+
+    # -------------------------------------------------------------
+    # WORKER
+    # -------------------------------------------------------------
+    def open_input(self, job_input):
+        """Returns (inner payload, {filename: bytes}) as rp_handler.prepare_job sees them."""
+        if "envelope" in job_input:
+            inner, images = unseal(self.envelope_key, base64.b64decode(job_input["envelope"]))
+            return inner, {name: bytes(data) for name, data in images.items()}
+        if job_input.get("is_encrypted"):
+            inner = json.loads(self.cipher.decrypt(job_input["encrypted_input"].encode()))
+        else:
+            inner = job_input
+        return inner, {name: base64.b64decode(data) for name, data in inner.get("images", {}).items()}
+
+    def execute(self, job_input):
+        """Returns the job's stream items; the last one carries the status."""
+        try:
+            inner, images = self.open_input(job_input)
+        except Exception as e:
+            return [{"status": "error", "message": f"Decryption failed: {e}"}]
+        with self._lock:
+            for name, digest in inner.get("image_refs", {}).items():
+                if name in images:
+                    if hashlib.sha256(images[name]).hexdigest() != digest:
+                        return [{"status": "error", "message": f"Input '{name}' does not match its hash."}]
+                    self.inputs.add(digest)
+            missing = [d for d in inner.get("image_refs", {}).values() if d not in self.inputs]
+            if missing:
+                self.missing_answers += 1
+                return [{"status": "missing_inputs", "missing": missing}]
+
+        use_envelope = "envelope" in job_input
+        keys = [str(v.get("key", i)) for i, v in enumerate(inner.get("variants") or [])] or [None]
+        items = []
+        for key in keys:
+            meta = {"filename": "ComfyUI_00001_.png"}
+            if key is not None:
+                meta["variant"] = key
+            if use_envelope:
+                items.append({"status": "success", "envelope": self._seal(meta, {meta["filename"]: self.png})})
+            else:
+                items.append({"status": "success", **meta, "data": base64.b64encode(self.png).decode()})
+        completion = {"source": "websocket", "disk_waits": 0, "output_mode": "disk", "cached": False}
+        if keys == [None]:
+            items.append({"status": "success", "completion": completion, "done": True})
+        else:
+            variants = {key: {"status": "success", "completion": completion} for key in keys}
+            items.append({"status": "success", "variants": variants, "done": True})
+        return items
+
+    def _seal(self, meta, blobs):
+        return base64.b64encode(seal(self.envelope_key, meta, blobs)).decode()
+
+    def aggregate(self, job_input, items):
+        """The non-streaming handler's response for the same outputs."""
+        final = items[-1]
+        if final.get("status") in ("error", "missing_inputs"):
+            return final
+        if "envelope" in job_input:
+            blobs = {}
+            for item in items[:-1]:
+                meta, files = unseal(self.envelope_key, base64.b64decode(item["envelope"]))
+                name = meta["filename"] if "variant" not in meta else f"{meta['variant']}/{meta['filename']}"
+                blobs[name] = bytes(files[meta["filename"]])
+            if "variants" in final:
+                variants = {
+                    key: {**result, "images": [n.split("/", 1)[1] for n in blobs if n.startswith(f"{key}/")]}
+                    for key, result in final["variants"].items()
+                }
+                return {"status": "success", "envelope": self._seal({"variants": variants}, blobs)}
+            return {"status": "success", "envelope": self._seal({"completion": final["completion"]}, blobs)}
+        if "variants" in final:
+            variants = {key: {**result, "images": {}} for key, result in final["variants"].items()}
+            for item in items[:-1]:
+                variants[item["variant"]]["images"][item["filename"]] = item["data"]
+            return {"status": "success", "variants": variants}
+        images = {item["filename"]: item["data"] for item in items[:-1]}
+        return {"status": "success", "images": images, "completion": final["completion"]}
+
+    # -------------------------------------------------------------
+    # JOBS
+    # -------------------------------------------------------------
+    def submit(self, job_input):
+        job_id = f"fake-{uuid.uuid4()}"
+        with self._lock:
+            self.jobs[job_id] = {"input": job_input, "submitted_at": time.monotonic(), "items": None, "sent": 0}
+            self.submitted += 1
+        return job_id
+
+    def status(self, job_id):
+        """(RunPod status, job record); the job runs on its first poll after `run_delay`."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None, None
+        if job.get("cancelled"):
+            return "CANCELLED", job
+        elapsed = time.monotonic() - job["submitted_at"]
+        if elapsed < self.queue_delay:
+            return "IN_QUEUE", job
+        if elapsed < self.queue_delay + self.run_delay:
+            return "IN_PROGRESS", job
+        with self._lock:
+            if job["items"] is None:
+                job["items"] = self.execute(job["input"])
+        return "COMPLETED", job
+
+    # -------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, obj, code=200):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server.polls += 1
+                route, _, job_id = self.path.strip("/").rpartition("/")
+                status, job = server.status(job_id)
+                if job is None or route not in ("status", "stream"):
+                    return self.reply({"error": "job not found"}, 404)
+                response = {"id": job_id, "status": status}
+                if status == "IN_PROGRESS":
+                    response["progress"] = {"message": "running"}
+                if status != "COMPLETED":
+                    return self.reply(response)
+                if route == "stream":
+                    with server._lock:
+                        new = job["items"][job["sent"]:]
+                        job["sent"] = len(job["items"])
+                    response["stream"] = [{"output": item} for item in new]
+                else:
+                    response["output"] = server.aggregate(job["input"], job["items"])
+                return self.reply(response)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/run":
+                    return self.reply({"id": server.submit(body.get("input", {})), "status": "IN_QUEUE"})
+                if self.path.startswith("/cancel/"):
+                    job = server.jobs.get(self.path.rsplit("/", 1)[-1])
+                    if job is None:
+                        return self.reply({"error": "job not found"}, 404)
+                    job["cancelled"] = True
+                    return self.reply({"status": "CANCELLED"})
+                return self.reply({"error": "not found"}, 404)
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8000):
+        """Starts serving on a background thread; returns the HTTP server."""
+        httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory RunPod endpoint API stand-in")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--queue_delay", type=float, default=0.02, help="Seconds a job stays IN_QUEUE")
+    parser.add_argument("--run_delay", type=float, default=0.05, help="Seconds a job stays IN_PROGRESS")
+    args = parser.parse_args()
+
+    httpd = FakeRunPod(queue_delay=args.queue_delay, run_delay=args.run_delay).serve(port=args.port)
+    print(f"🧪 Fake RunPod API on http://127.0.0.1:{args.port} (RUNPOD_BASE_URL)", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
@@ -0,0 +1,97 @@
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+# =================================================================
+# FAKE S3 SERVER
+# =================================================================
+# An in-memory stand-in for the S3 calls delivery.py makes (path-style
+# PUT object, GET/HEAD object through presigned URLs), for testing output
+# offload without MinIO. Signatures are not checked. Point the worker at it:
+#   BUCKET_NAME=outputs BUCKET_ENDPOINT_URL=http://127.0.0.1:9000
+#   BUCKET_ACCESS_KEY_ID=test BUCKET_SECRET_ACCESS_KEY=test
+
+def decode_aws_chunked(body):
+    """Payload of an `aws-chunked` upload: "<hex size>[;sig]\r\n<data>\r\n"... then trailers."""
+    data = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b"\r\n", pos)
+        size = int(body[pos:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        pos = line_end + 2 + size + 2
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+        self.gets = 0
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def key(self):
+                return unquote(urlsplit(self.path).path.lstrip("/"))
+
+            def reply(self, code, body=b"", content_type="application/xml", head=False):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "aws-chunked" in self.headers.get("Content-Encoding", "") or \
+                        self.headers.get("x-amz-content-sha256", "").startswith("STREAMING-"):
+                    body = decode_aws_chunked(body)
+                server.objects[self.key()] = (body, self.headers.get("Content-Type", "application/octet-stream"))
+                server.puts += 1
+                self.send_response(200)
+                self.send_header("ETag", '"fake"')
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self, head=False):
+                entry = server.objects.get(self.key())
+                if entry is None:
+                    return self.reply(404, b"<Error><Code>NoSuchKey</Code></Error>", head=head)
+                server.gets += not head
+                self.reply(200, entry[0], entry[1], head=head)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=9000):
+        """Starts serving on a background thread; returns the HTTP server."""
+        httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory S3 stand-in")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+
+    httpd = FakeS3().serve(port=args.port)
+    print(f"🪣 Fake S3 on http://127.0.0.1:{args.port} (any bucket, any credentials)", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
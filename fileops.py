@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# =================================================================
+# INPUT FILES AND SECURE CLEANUP
+# =================================================================
+# Inputs are base64-decoded and written in CHUNK_BYTES pieces on a shared
+# thread pool, so a job never holds a second full copy of each image.
+# Secure deletes overwrite with one fixed zero buffer, also in parallel.
+# fsync is skipped on tmpfs (/dev/shm, the RAM disk): there is no device
+# to flush to, the page cache *is* the file.
+CHUNK_BYTES = 1024 * 1024
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 4))
+
+RAM_FILESYSTEMS = {"tmpfs", "ramfs"}
+_ZEROS = memoryview(bytes(CHUNK_BYTES))
+_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="file-io")
+
+def _read_mounts():
+    mounts = {}
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    # Mount points escape spaces as \040
+                    mounts[fields[1].replace("\\040", " ")] = fields[2]
+    except OSError:
+        pass
+    return mounts
+
+# /dev/shm (the RAM disk behind input/ and output/) exists before the worker starts
+_mount_types = _read_mounts()
+
+def filesystem_type(path):
+    """Type of the filesystem holding `path`, from the longest matching /proc/mounts entry."""
+    path = os.path.realpath(path)
+    best = ""
+    for mount_point in _mount_types:
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+            best = mount_point
+    return _mount_types.get(best, "unknown")
+
+def needs_fsync(path):
+    return filesystem_type(path) not in RAM_FILESYSTEMS
+
+def _chunks(data):
+    """Yields the decoded bytes of `data` (bytes, or a base64 str) piece by piece."""
+    if not isinstance(data, str):
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK_BYTES):
+            yield view[start:start + CHUNK_BYTES]
+        return
+    if any(c in data for c in "\n\r \t"):
+        # Wrapped base64 does not split on 4-character boundaries; decode whole
+        yield base64.b64decode(data)
+        return
+    step = CHUNK_BYTES // 3 * 4
+    for start in range(0, len(data), step):
+        yield base64.b64decode(data[start:start + step])
+
+def write_file(path, data, fsync=True):
+    """Writes `data` (bytes, or a base64 str) to `path` in chunks."""
+    with open(path, "wb") as f:
+        for chunk in _chunks(data):
+            f.write(chunk)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+def hash_data(data):
+    """(decoded bytes, SHA-256 hex) of `data` (bytes, or a base64 str)."""
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return data, hashlib.sha256(data).hexdigest()
+
+def hash_inputs(images):
+    """
+    Decodes and hashes {filename: bytes or base64 str} without touching
+    disk. Returns ({filename: sha256 hex}, {filename: bytes}); writing the
+    bytes later skips a second base64 decode.
+    """
+    futures = {name: _pool.submit(hash_data, data) for name, data in images.items()}
+    results = {name: future.result() for name, future in futures.items()}
+    return {name: digest for name, (_, digest) in results.items()}, {name: data for name, (data, _) in results.items()}
+
+def write_inputs(directory, images):
+    """Writes {filename: bytes or base64 str} into `directory` in parallel."""
+    os.makedirs(directory, exist_ok=True)
+    fsync = needs_fsync(directory)
+    futures = [
+        _pool.submit(write_file, os.path.join(directory, name), data, fsync)
+        for name, data in images.items()
+    ]
+    for future in futures:
+        future.result()
+
+def secure_delete(path, fsync=None):
+    if os.path.exists(path):
+        try:
+            remaining = os.path.getsize(path)
+            # Overwrite in place: truncating first would just free the old
+            # pages (or blocks) without ever zeroing them
+            with open(path, "r+b") as f:
+                while remaining > 0:
+                    remaining -= f.write(_ZEROS[:min(remaining, CHUNK_BYTES)])
+                if needs_fsync(path) if fsync is None else fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.remove(path)
+        except Exception as e:
+            print(f"⚠️ Secure delete error: {e}")
+
+def secure_delete_all(paths):
+    """Securely deletes many files at once on the I/O pool."""
+    paths = list(paths)
+    if not paths:
+        return
+    fsync = needs_fsync(os.path.dirname(paths[0]))
+    for future in [_pool.submit(secure_delete, path, fsync) for path in paths]:
+        future.result()
+
+def clear_directory(path):
+    """Securely deletes the files directly in `path` and drops its empty subfolders."""
+    if os.path.exists(path):
+        secure_delete_all(
+            os.path.join(path, f) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))
+        )
+        for name in os.listdir(path):
+            # Per-job scope folders left by an earlier job; rmdir keeps non-empty ones
+            try:
+                os.rmdir(os.path.join(path, name))
+            except OSError:
+                pass
+
+def remove_tree(path):
+    """Securely deletes every file below `path`, then the folders themselves."""
+    if not os.path.isdir(path):
+        return
+    walked = list(os.walk(path, topdown=False))
+    secure_delete_all(os.path.join(root, f) for root, _, files in walked for f in files)
+    for root, dirs, _ in walked:
+        for d in dirs:
+            try:
+                os.rmdir(os.path.join(root, d))
+            except OSError:
+                pass
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
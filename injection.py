@@ -0,0 +1,211 @@
+import json
+import random
+import re
+
+# =================================================================
+# WORKFLOW INJECTION
+# =================================================================
+# Shared by client.py (single jobs) and rp_handler.py (batch variants).
+# All helpers return a modified copy; the input workflow is left intact.
+
+# Qwen edit workflows take the prompt on this specific node
+QWEN_PROMPT_NODE = "24"
+
+def load_image_node_ids(workflow):
+    """LoadImage node IDs, sorted numerically (the order images map to)."""
+    ids = [node_id for node_id, node in workflow.items() if node.get("class_type") == "LoadImage"]
+    return sorted(ids, key=lambda node_id: (0, int(node_id)) if str(node_id).isdigit() else (1, str(node_id)))
+
+def _node_inputs(workflow, node_id):
+    """Copies one node (and its inputs) into `workflow`; returns the inputs."""
+    node = workflow[node_id]
+    inputs = dict(node.get("inputs", {}))
+    workflow[node_id] = {**node, "inputs": inputs}
+    return inputs
+
+def inject_images(workflow, names):
+    """
+    Points LoadImage nodes at `names`: a list maps in node ID order, a dict
+    maps {node_id: filename}. Returns (workflow, [(node_id, name), ...]).
+    """
+    workflow = dict(workflow)
+    if isinstance(names, dict):
+        pairs = [(str(node_id), name) for node_id, name in names.items()]
+    else:
+        pairs = list(zip(load_image_node_ids(workflow), names))
+    for node_id, name in pairs:
+        _node_inputs(workflow, node_id)["image"] = name
+    return workflow, pairs
+
+def inject_prompt(workflow, prompt):
+    """Sets the prompt on CLIPTextEncode nodes and the Qwen edit node."""
+    workflow = dict(workflow)
+    touched = []
+    for node_id, node in list(workflow.items()):
+        class_type = node.get("class_type")
+        if class_type == "CLIPTextEncode":
+            _node_inputs(workflow, node_id)["text"] = prompt
+            touched.append((node_id, "CLIP"))
+        elif class_type == "TextEncodeQwenImageEditPlus" and str(node_id) == QWEN_PROMPT_NODE:
+            _node_inputs(workflow, node_id)["prompt"] = prompt
+            touched.append((node_id, "Qwen"))
+    return workflow, touched
+
+def set_seeds(workflow, seed=None):
+    """Sets every `seed` input to `seed`, or a fresh random one per node."""
+    workflow = dict(workflow)
+    touched = []
+    for node_id, node in list(workflow.items()):
+        if "seed" in node.get("inputs", {}):
+            _node_inputs(workflow, node_id)["seed"] = seed if seed is not None else random.randint(1, 10**15)
+            touched.append(node_id)
+    return workflow, touched
+
+# Loader inputs that name a model file: ckpt_name, unet_name (incl. GGUF
+# loaders), lora_name, vae_name, clip_name, clip_name1..N
+MODEL_INPUT_RE = re.compile(r"^(ckpt|unet|lora|vae|clip)_name\d*$")
+
+def workflow_model_refs(workflow):
+    """Model filenames referenced by loader nodes in an API-format workflow."""
+    refs = set()
+    for node in workflow.values():
+        for key, value in node.get("inputs", {}).items():
+            if isinstance(value, str) and MODEL_INPUT_RE.match(key):
+                refs.add(value)
+    return refs
+
+def apply_overrides(workflow, overrides):
+    """
+    Builds one variant from a base workflow. Supported keys:
+      "prompt":  text for the prompt nodes
+      "seed":    int for every seed input, or "random"
+      "images":  list (LoadImage ID order) or {node_id: filename}
+      "inputs":  {node_id: {input_name: value}} for anything else
+    """
+    if "images" in overrides:
+        workflow, _ = inject_images(workflow, overrides["images"])
+    if "prompt" in overrides:
+        workflow, _ = inject_prompt(workflow, overrides["prompt"])
+    if "seed" in overrides:
+        seed = overrides["seed"]
+        workflow, _ = set_seeds(workflow, None if seed == "random" else seed)
+    if "inputs" in overrides:
+        workflow = dict(workflow)
+        for node_id, values in overrides["inputs"].items():
+            if str(node_id) not in workflow:
+                raise ValueError(f"Override targets unknown node {node_id}.")
+            _node_inputs(workflow, str(node_id)).update(values)
+    return workflow
+
+# =================================================================
+# COMPILED TEMPLATES
+# =================================================================
+class WorkflowTemplate:
+    """
+    A workflow with its injection points resolved once, for generating
+    many jobs cheaply. Untouched nodes are shared between renders and
+    pre-serialized, so render_json() only serializes the injected nodes.
+
+    Injection points come from a mapping (dict or JSON file):
+        {"images": ["12", "13"],              # LoadImage nodes, in order
+         "prompt": [["24", "prompt"]],        # [node_id, input_name]
+         "seed":   [["3", "seed"], ["5", "noise_seed"]]}
+    Without one they are discovered the same way inject_images,
+    inject_prompt and set_seeds find them.
+    """
+
+    def __init__(self, workflow, mapping=None):
+        self.workflow = workflow
+        self.mapping = mapping if mapping is not None else self.discover(workflow)
+        self.image_slots = [self._slot(s, "image") for s in self.mapping.get("images", [])]
+        self.prompt_slots = [self._slot(s, "text") for s in self.mapping.get("prompt", [])]
+        self.seed_slots = [self._slot(s, "seed") for s in self.mapping.get("seed", [])]
+
+        self._dynamic = {node_id for node_id, _ in self.image_slots + self.prompt_slots + self.seed_slots}
+        unknown = self._dynamic - set(workflow)
+        if unknown:
+            raise ValueError(f"Template mapping targets unknown node(s): {sorted(unknown)}")
+        # Serialized form: runs of static nodes pre-joined into one string,
+        # interleaved with the IDs of nodes that change per job
+        self._segments = []
+        static = []
+        for node_id, node in workflow.items():
+            if node_id in self._dynamic:
+                if static:
+                    self._segments.append(", ".join(static))
+                    static = []
+                self._segments.append((node_id,))
+            else:
+                static.append(f"{json.dumps(node_id)}: {json.dumps(node)}")
+        if static:
+            self._segments.append(", ".join(static))
+
+    @classmethod
+    def from_files(cls, workflow_path, mapping_path=None):
+        with open(workflow_path, "r") as f:
+            workflow = json.load(f)
+        mapping = None
+        if mapping_path:
+            with open(mapping_path, "r") as f:
+                mapping = json.load(f)
+        return cls(workflow, mapping)
+
+    @staticmethod
+    def discover(workflow):
+        mapping = {"images": [[node_id, "image"] for node_id in load_image_node_ids(workflow)], "prompt": [], "seed": []}
+        for node_id, node in workflow.items():
+            class_type = node.get("class_type")
+            if class_type == "CLIPTextEncode":
+                mapping["prompt"].append([node_id, "text"])
+            elif class_type == "TextEncodeQwenImageEditPlus" and str(node_id) == QWEN_PROMPT_NODE:
+                mapping["prompt"].append([node_id, "prompt"])
+            if "seed" in node.get("inputs", {}):
+                mapping["seed"].append([node_id, "seed"])
+        return mapping
+
+    @staticmethod
+    def _slot(spec, default_input):
+        if isinstance(spec, (list, tuple)):
+            return str(spec[0]), spec[1]
+        return str(spec), default_input
+
+    def _values(self, prompt=None, images=(), seed=None):
+        """{node_id: {input_name: value}} for one job."""
+        values = {}
+        if isinstance(images, dict):
+            for node_id, input_name in self.image_slots:
+                if node_id in images:
+                    values.setdefault(node_id, {})[input_name] = images[node_id]
+        else:
+            for (node_id, input_name), name in zip(self.image_slots, images):
+                values.setdefault(node_id, {})[input_name] = name
+        if prompt is not None:
+            for node_id, input_name in self.prompt_slots:
+                values.setdefault(node_id, {})[input_name] = prompt
+        for node_id, input_name in self.seed_slots:
+            values.setdefault(node_id, {})[input_name] = seed if seed is not None else random.randint(1, 10**15)
+        return values
+
+    def render(self, prompt=None, images=(), seed=None):
+        """
+        Returns a job workflow. `images` is a list (slot order) or
+        {node_id: filename}; seed=None draws a random seed per slot.
+        Only injected nodes are copied; the rest are shared with the template.
+        """
+        workflow = dict(self.workflow)
+        for node_id, values in self._values(prompt, images, seed).items():
+            _node_inputs(workflow, node_id).update(values)
+        return workflow
+
+    def render_json(self, prompt=None, images=(), seed=None):
+        """Like render(), but returns the serialized workflow directly."""
+        values = self._values(prompt, images, seed)
+        parts = []
+        for segment in self._segments:
+            if isinstance(segment, tuple):
+                node_id = segment[0]
+                node = self.workflow[node_id]
+                node = {**node, "inputs": {**node.get("inputs", {}), **values.get(node_id, {})}}
+                segment = f"{json.dumps(node_id)}: {json.dumps(node)}"
+            parts.append(segment)
+        return "{" + ", ".join(parts) + "}"
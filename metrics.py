@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# =================================================================
+# JOB TIMINGS
+# =================================================================
+class NodeTimer:
+    """
+    Per-node durations for one prompt, derived from its websocket events.
+    A node runs from its `executing` event until the next one; cached
+    nodes are reported with 0s. Times are the events' receive times
+    (see ComfyConnection), so prompts read late are still measured right.
+    """
+
+    def __init__(self, prompt, queued_at):
+        self.prompt = prompt
+        self.queued_at = queued_at
+        self.started_at = None
+        self.finished_at = None
+        self.history_seconds = 0.0
+        self.nodes = {}
+        self.current = None
+        self.since = None
+
+    def _close(self, now):
+        if self.current is not None:
+            node = self.nodes.setdefault(self.current, self._entry(self.current))
+            node["seconds"] = round(node["seconds"] + now - self.since, 4)
+            self.current = None
+
+    def _entry(self, node_id, cached=False):
+        class_type = self.prompt.get(node_id, {}).get("class_type")
+        return {"class_type": class_type, "seconds": 0.0, "cached": cached}
+
+    def observe(self, message):
+        now = message.get("received_at", time.monotonic())
+        data = message.get("data") or {}
+        msg_type = message.get("type")
+        if msg_type == "execution_start":
+            self.started_at = now
+        elif msg_type == "execution_cached":
+            for node_id in data.get("nodes", []):
+                self.nodes[str(node_id)] = self._entry(str(node_id), cached=True)
+        elif msg_type == "executing":
+            if self.started_at is None:
+                self.started_at = now
+            self._close(now)
+            if data.get("node") is None:
+                self.finished_at = now
+            else:
+                self.current = str(data["node"])
+                self.since = now
+
+    def summary(self):
+        summary = {"nodes": self.nodes}
+        if self.started_at is not None:
+            summary["queue_wait"] = round(self.started_at - self.queued_at, 4)
+            if self.finished_at is not None:
+                summary["execute"] = round(self.finished_at - self.started_at, 4)
+        if self.history_seconds:
+            summary["history"] = round(self.history_seconds, 4)
+        return summary
+
+
+class JobMetrics:
+    """Monotonic phase timings for one job plus a NodeTimer per variant."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.timers = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - started
+
+    def timer(self, key, prompt, queued_at):
+        timer = self.timers[key] = NodeTimer(prompt, queued_at)
+        return timer
+
+    def as_dict(self):
+        """{"total", "phases", "variants": {key: node summary}}; plain jobs use key "main"."""
+        return {
+            "total": round(time.monotonic() - self.started, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "variants": {
+                ("main" if key is None else key): timer.summary() for key, timer in self.timers.items()
+            }
+        }
+
+# =================================================================
+# EXPORT
+# =================================================================
+class MetricsSink:
+    """
+    Writes finished jobs' metrics for scraping:
+      "jsonl":      one JSON object per job appended to `path`
+      "prometheus": cumulative counters rewritten to `path` after every
+                    job (node_exporter textfile collector format)
+    """
+
+    def __init__(self, fmt, path):
+        if fmt not in ("jsonl", "prometheus"):
+            raise ValueError(f"Unknown METRICS_FORMAT '{fmt}'")
+        self.fmt = fmt
+        self.path = path
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._phases = {}
+        self._nodes = {}
+
+    def record(self, job_id, status, metrics):
+        summary = metrics.as_dict()
+        with self._lock:
+            if self.fmt == "jsonl":
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"job_id": job_id, "status": status, "time": time.time(), **summary}) + "\n")
+                return
+            self._jobs[status] = self._jobs.get(status, 0) + 1
+            phases = dict(summary["phases"], total=summary["total"])
+            for variant in summary["variants"].values():
+                for name in ("queue_wait", "execute", "history"):
+                    if name in variant:
+                        phases[name] = phases.get(name, 0.0) + variant[name]
+                for node in variant["nodes"].values():
+                    if not node["cached"]:
+                        self._add(self._nodes, node["class_type"] or "unknown", node["seconds"])
+            for name, seconds in phases.items():
+                self._add(self._phases, name, seconds)
+            self._write_prometheus()
+
+    @staticmethod
+    def _add(table, label, seconds):
+        total, count = table.get(label, (0.0, 0))
+        table[label] = (total + seconds, count + 1)
+
+    def _write_prometheus(self):
+        lines = ["# TYPE comfy_jobs_total counter"]
+        lines += [f'comfy_jobs_total{{status="{status}"}} {count}' for status, count in self._jobs.items()]
+        for metric, label, table in (
+            ("comfy_job_phase_seconds", "phase", self._phases),
+            ("comfy_node_seconds", "class_type", self._nodes),
+        ):
+            lines.append(f"# TYPE {metric} summary")
+            for value, (total, count) in table.items():
+                lines.append(f'{metric}_sum{{{label}="{value}"}} {total:.6f}')
+                lines.append(f'{metric}_count{{{label}="{value}"}} {count}')
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# =================================================================
+# PROGRESS REPORTING
+# =================================================================
+# ComfyUI sends a `progress` event per sampler step. The websocket loop
+# only records the latest state of each job here; ProgressReporter sends
+# it from a background thread at most once per `interval`, so fast
+# workflows are not slowed down and long ones do not flood the API.
+# Each update names the running node, the fraction of the workflow done
+# and an ETA from earlier runs of the same workflow (DurationHistory).
+
+def workflow_signature(workflow, ignore=()):
+    """
+    Hash of a workflow's structure: node classes, links and non-string
+    settings (steps, sizes, cfg). Prompts, filenames and `ignore` inputs
+    (seeds) are left out so that re-runs with new values still match.
+    """
+    parts = []
+    for node_id in sorted(workflow, key=str):
+        node = workflow[node_id]
+        inputs = {
+            name: value for name, value in node.get("inputs", {}).items()
+            if name not in ignore and not isinstance(value, str)
+        }
+        parts.append([str(node_id), node.get("class_type"), inputs])
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class DurationHistory:
+    """Per-node seconds of recent runs, smoothed, for the last `max_workflows` signatures."""
+
+    def __init__(self, max_workflows=256, smoothing=0.5):
+        self.max_workflows = max_workflows
+        self.smoothing = smoothing
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, signature):
+        with self._lock:
+            durations = self._entries.get(signature)
+            return dict(durations) if durations else {}
+
+    def record(self, signature, nodes):
+        """Folds a finished run's NodeTimer nodes into the estimate; cached nodes are skipped."""
+        with self._lock:
+            durations = self._entries.pop(signature, {})
+            for node_id, node in nodes.items():
+                if node.get("cached"):
+                    continue
+                old = durations.get(node_id)
+                seconds = node["seconds"]
+                durations[node_id] = seconds if old is None else old + self.smoothing * (seconds - old)
+            self._entries[signature] = durations
+            while len(self._entries) > self.max_workflows:
+                self._entries.popitem(last=False)
+
+
+class ProgressTracker:
+    """
+    Progress of one queued prompt, built on its NodeTimer (which already
+    follows `executing` events) plus the sampler steps of the running node.
+    """
+
+    def __init__(self, prompt, timer, durations=None, variant=None):
+        self.prompt = prompt
+        self.timer = timer
+        self.durations = durations or {}
+        self.variant = variant
+        self.cached = set()
+        self.step = None
+
+    def observe(self, message):
+        data = message.get("data") or {}
+        msg_type = message.get("type")
+        if msg_type == "execution_cached":
+            self.cached.update(str(n) for n in data.get("nodes", []))
+        elif msg_type == "executing":
+            self.step = None
+        elif msg_type == "progress":
+            self.step = (data.get("value", 0), data.get("max", 0))
+
+    def snapshot(self):
+        now = time.monotonic()
+        current = self.timer.current
+        pending = [n for n in map(str, self.prompt) if n not in self.cached]
+        done = [n for n in pending if n in self.timer.nodes and n != current]
+        step_fraction = self.step[0] / self.step[1] if self.step and self.step[1] else 0.0
+        fraction = min((len(done) + step_fraction) / len(pending), 1.0) if pending else 1.0
+
+        snapshot = {"node": current, "fraction": round(fraction, 3), "eta": None}
+        if current is not None:
+            snapshot["class_type"] = self.prompt.get(current, {}).get("class_type")
+        if self.step:
+            snapshot["step"] = f"{self.step[0]}/{self.step[1]}"
+        if self.variant is not None:
+            snapshot["variant"] = self.variant
+
+        if self.durations:
+            remaining = sum(self.durations.get(n, 0.0) for n in pending if n not in done and n != current)
+            if current is not None:
+                elapsed = now - self.timer.since
+                if step_fraction > 0:
+                    # The running node's own pace beats the historical average
+                    remaining += elapsed * (1 - step_fraction) / step_fraction
+                else:
+                    remaining += max(self.durations.get(current, 0.0) - elapsed, 0.0)
+            snapshot["eta"] = round(remaining, 1)
+
+        parts = [f"{snapshot['fraction']:.0%}"]
+        if current is not None:
+            parts.append(f"{snapshot['class_type']} (node {current})")
+        if self.step:
+            parts.append(f"step {snapshot['step']}")
+        if snapshot["eta"] is not None:
+            parts.append(f"ETA {snapshot['eta']:.0f}s")
+        snapshot["message"] = " · ".join(parts)
+        return snapshot
+
+
+class ProgressReporter:
+    """
+    Background sender: `update` only stores the latest progress of a job;
+    a daemon thread calls `send(job, progress)` at most once per `interval`
+    per job. `finish` drops whatever is still pending for a job.
+    """
+
+    def __init__(self, send, interval=1.0):
+        self.send = send
+        self.interval = interval
+        self._pending = {}
+        self._sent_at = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def update(self, job, progress):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                self._thread.start()
+            self._pending[job.get("id")] = (job, progress)
+            self._cond.notify()
+
+    def finish(self, job):
+        with self._cond:
+            self._pending.pop(job.get("id"), None)
+            self._sent_at.pop(job.get("id"), None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [
+                    job_id for job_id in self._pending
+                    if now - self._sent_at.get(job_id, float("-inf")) >= self.interval
+                ]
+                if not due:
+                    self._cond.wait(min(self.interval - (now - self._sent_at[job_id]) for job_id in self._pending))
+                    continue
+                batch = [self._pending.pop(job_id) for job_id in due]
+                for job_id in due:
+                    self._sent_at[job_id] = now
+            for job, progress in batch:
+                try:
+                    self.send(job, progress)
+                except Exception as e:
+                    print(f"⚠️ Progress update failed: {e}")
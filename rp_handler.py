@@ -1,174 +1,993 @@
 import runpod
-import requests
-import websocket
+import asyncio
 import json
-import uuid
 import base64
+import queue
 import os
+import re
+import threading
+import uuid
 import time
 from cryptography.fernet import Fernet
+from delivery import Delivery, OutputBucket, delivery_options
+from dispatch import Dispatcher, instance_addresses
+from envelope import derive_key, seal, unseal
+from fileops import clear_directory, hash_inputs, remove_tree, write_inputs
+from caches import InputCache, ResultCache, sha256_hex
+from injection import apply_overrides
+from metrics import JobMetrics, MetricsSink, NodeTimer
+from progress import DurationHistory, ProgressReporter, ProgressTracker, workflow_signature
+from startup import load_provisioning
+from validation import validate_workflow
 
 # =================================================================
 # CONFIGURATION
 # =================================================================
-SERVER_ADDRESS = "127.0.0.1:8188"
+# ComfyUI instances to dispatch jobs across (see dispatch.py); a single
+# 127.0.0.1:8188 unless COMFY_SERVERS / COMFY_DEVICES / COMFY_INSTANCES say otherwise
+COMFY_SERVERS = instance_addresses()
+# Extra queue depth an instance is charged for lacking the job's models
+DISPATCH_AFFINITY_WEIGHT = float(os.environ.get("DISPATCH_AFFINITY_WEIGHT", 1.0))
 INPUT_DIR = "/ComfyUI/input"
 OUTPUT_DIR = "/ComfyUI/output"
 
+# Jobs run at once on this worker. Above 1, each job works in its own
+# input/output subfolder and the shared folders are never wiped wholesale.
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1))
+
+# "disk": outputs round-trip through PNG files in OUTPUT_DIR (default).
+# "websocket": SaveImage nodes are swapped for SaveImageWebsocket and the
+# image bytes are taken straight from binary websocket frames.
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "disk")
+
+# STREAM_OUTPUTS=1 starts a generator handler that yields each output as
+# soon as its node finishes (runpod /stream, aggregated for /run)
+STREAM_OUTPUTS = os.environ.get("STREAM_OUTPUTS") == "1"
+
+# How long to wait on /history for a prompt whose websocket events were lost
+HISTORY_WAIT_TIMEOUT = float(os.environ.get("HISTORY_WAIT_TIMEOUT", 600))
+
+# Seconds a job may run in total (0 = no limit); a job input "timeout"
+# overrides it. A running prompt that sends no websocket event for
+# EXECUTION_IDLE_TIMEOUT seconds counts as wedged (0 = never). Either way,
+# and when RunPod cancels the job, its prompts are removed from ComfyUI's
+# queue or interrupted so the next job starts at once.
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 0))
+EXECUTION_IDLE_TIMEOUT = float(os.environ.get("EXECUTION_IDLE_TIMEOUT", 600))
+# How often a quiet websocket is cross-checked against /queue and /history
+QUIET_CHECK_INTERVAL = 10.0
+
 ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY")
 cipher = Fernet(ENCRYPTION_KEY.encode()) if ENCRYPTION_KEY else None
+envelope_key = derive_key(ENCRYPTION_KEY) if ENCRYPTION_KEY else None
+
+# Decoded inputs kept in RAM by SHA-256 so repeat jobs can send only a
+# reference. INPUT_CACHE_ENCRYPT=1 keeps them Fernet-encrypted at rest.
+INPUT_CACHE_MB = int(os.environ.get("INPUT_CACHE_MB", 512))
+input_cache = InputCache(
+    INPUT_CACHE_MB * 1024 * 1024,
+    cipher if os.environ.get("INPUT_CACHE_ENCRYPT") == "1" else None
+)
+
+# RESULT_CACHE=1 answers repeats of deterministic requests (same workflow
+# with literal seeds, same input bytes) from earlier results, stored
+# Fernet-encrypted in a RAM-disk LRU and optionally on the network volume.
+# A job can bypass it with "cache": false.
+RESULT_CACHE_MB = int(os.environ.get("RESULT_CACHE_MB", 1024))
+RESULT_CACHE_VOLUME_MB = int(os.environ.get("RESULT_CACHE_VOLUME_MB", 10240))
+result_cache = None
+if os.environ.get("RESULT_CACHE") == "1":
+    if cipher:
+        result_cache = ResultCache(
+            cipher,
+            os.environ.get("RESULT_CACHE_DIR", "/dev/shm/result_cache"),
+            RESULT_CACHE_MB * 1024 * 1024,
+            os.environ.get("RESULT_CACHE_VOLUME_DIR"),
+            RESULT_CACHE_VOLUME_MB * 1024 * 1024
+        )
+    else:
+        print("⚠️ RESULT_CACHE needs ENCRYPTION_KEY; result caching disabled.")
+
+# Per-job phase and node timings. Always collected; returned in a `metrics`
+# field when the job input sets "metrics": true, and written for scraping
+# when METRICS_FORMAT is "jsonl" or "prometheus" (to METRICS_PATH).
+METRICS_FORMAT = os.environ.get("METRICS_FORMAT")
+METRICS_PATH = os.environ.get(
+    "METRICS_PATH", "/tmp/comfy_metrics.prom" if METRICS_FORMAT == "prometheus" else "/tmp/comfy_metrics.jsonl"
+)
+metrics_sink = MetricsSink(METRICS_FORMAT, METRICS_PATH) if METRICS_FORMAT else None
+
+# Progress goes to RunPod from a background thread, at most once per
+# PROGRESS_INTERVAL seconds per job, with an ETA learned from earlier runs
+# of the same workflow (kept in memory for the worker's lifetime).
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 1.0))
+progress_reporter = ProgressReporter(
+    lambda job, progress: runpod.serverless.progress_update(job, progress), PROGRESS_INTERVAL
+)
+node_durations = DurationHistory()
+
+# Outputs too large to return inline (see delivery.py) are uploaded to the
+# S3-compatible bucket BUCKET_NAME and returned as presigned URLs
+output_bucket = OutputBucket.from_env()
+
+# PROVISION_MODE=lazy: models in MODELS are fetched when a workflow first
+# references them (see utils.ModelStore) instead of all at startup.
+model_store = None
+if os.environ.get("PROVISION_MODE") == "lazy":
+    model_store = load_provisioning().ModelStore()
+
+# Stop flags of jobs running under the async handlers, set when RunPod
+# cancels them; the job's thread checks its flag while waiting on ComfyUI
+_cancel_flags = {}
+
+# Worker-lifetime websocket + HTTP session per instance (see comfy_conn.py)
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(COMFY_SERVERS, DISPATCH_AFFINITY_WEIGHT)
+    _dispatcher.start()
+    return _dispatcher
+
+def get_connection():
+    """Connection to the first healthy instance, for schema and one-off calls."""
+    backends = get_dispatcher().backends
+    backend = next((b for b in backends if b.healthy), backends[0])
+    backend.conn.start()
+    return backend.conn
+
+# ComfyUI's node schema (/object_info), fetched once and used to reject
+# invalid workflows before any I/O. VALIDATE_WORKFLOWS=0 turns this off.
+VALIDATE_WORKFLOWS = os.environ.get("VALIDATE_WORKFLOWS", "1") == "1"
+_object_info = None
+
+def get_object_info():
+    """The cached schema; None (validation skipped) if it cannot be fetched yet."""
+    global _object_info
+    if _object_info is None:
+        try:
+            response = get_connection().get("/object_info", timeout=30)
+            response.raise_for_status()
+            _object_info = response.json()
+            print(f"📚 Cached schema for {len(_object_info)} node types.")
+        except Exception as e:
+            print(f"⚠️ Could not fetch /object_info, skipping validation: {e}")
+    return _object_info
 
 # =================================================================
 # HELPERS
 # =================================================================
-def secure_delete(path):
-    if os.path.exists(path):
-        try:
-            file_size = os.path.getsize(path)
-            with open(path, "wb") as f:
-                f.write(b'\0' * file_size)
-                f.flush()
-                os.fsync(f.fileno())
-            os.remove(path)
-        except Exception as e:
-            print(f"⚠️ Secure delete error: {e}")
+def job_scope(job):
+    """Per-job subfolder name used under INPUT_DIR and OUTPUT_DIR."""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(job.get("id") or uuid.uuid4()))
+
+# Inputs of loader nodes (LoadImage, LoadImageMask, LoadAudio,
+# VHS_LoadVideo, ...) that name a file in ComfyUI's input folder
+FILE_INPUTS = ("image", "video", "audio")
+
+def scope_workflow(workflow, scope, input_names):
+    """
+    Returns a copy of the workflow pointed at the job's subfolders:
+    loader inputs naming an uploaded file become `scope/name` and every
+    `filename_prefix` becomes `scope/prefix`.
+    """
+    scoped = {}
+    for node_id, node in workflow.items():
+        inputs = dict(node.get("inputs", {}))
+        loader = "Load" in str(node.get("class_type", ""))
+        for key, value in inputs.items():
+            if not isinstance(value, str):
+                continue
+            if key == "filename_prefix" or (loader and key in FILE_INPUTS and value in input_names):
+                inputs[key] = f"{scope}/{value}"
+        scoped[node_id] = {**node, "inputs": inputs}
+    return scoped
+
+def use_websocket_save(workflow):
+    """
+    Swaps every SaveImage node for SaveImageWebsocket (shipped in
+    ComfyUI's custom_nodes/websocket_image_save.py).
+    Returns (workflow, {node_id: filename_prefix}).
+    """
+    rewritten = {}
+    ws_nodes = {}
+    for node_id, node in workflow.items():
+        if node.get("class_type") == "SaveImage":
+            inputs = node.get("inputs", {})
+            ws_nodes[str(node_id)] = os.path.basename(inputs.get("filename_prefix", "ComfyUI"))
+            node = {**node, "class_type": "SaveImageWebsocket", "inputs": {"images": inputs["images"]}}
+        rewritten[node_id] = node
+    return rewritten, ws_nodes
+
+def resolve_cached_inputs(images_dict, image_refs):
+    """
+    Applies the client's {filename: sha256} references: uploaded bytes are
+    verified and cached, missing ones are filled from the cache.
+    Returns (images_dict, [missing digests]).
+    """
+    resolved = dict(images_dict)
+    missing = []
+    for filename, digest in image_refs.items():
+        data = resolved.get(filename)
+        if data is not None:
+            if isinstance(data, str):
+                data = base64.b64decode(data)
+            if sha256_hex(data) != digest:
+                raise ValueError(f"Input '{filename}' does not match its hash.")
+            if INPUT_CACHE_MB > 0:
+                input_cache.put(digest, data)
+            resolved[filename] = data
+            continue
+        data = input_cache.get(digest)
+        if data is None:
+            missing.append(digest)
+        else:
+            resolved[filename] = data
+    return resolved, missing
+
+# Inputs holding a sampler seed; a result is only reused when they are literals
+SEED_INPUTS = ("seed", "noise_seed")
+
+def has_fixed_seeds(workflow):
+    """False if any seed is wired from another node (e.g. a random seed node)."""
+    for node in workflow.values():
+        inputs = node.get("inputs", {})
+        for name in SEED_INPUTS:
+            if isinstance(inputs.get(name), list):
+                return False
+    return True
+
+def result_key(workflow, input_digests, output_mode):
+    """Hash of the canonical workflow JSON, input hashes and output mode."""
+    canonical = json.dumps(
+        {"workflow": workflow, "inputs": input_digests, "output_mode": output_mode},
+        sort_keys=True, separators=(",", ":")
+    )
+    return sha256_hex(canonical.encode())
+
+def pack_result(outputs, completion):
+    """Serializes [(filename, base64 data)] plus completion info for the result cache."""
+    return json.dumps({"outputs": outputs, "completion": completion}).encode()
 
-def clear_directory(path):
-    if os.path.exists(path):
-        for f in os.listdir(path):
-            file_path = os.path.join(path, f)
-            if os.path.isfile(file_path):
-                secure_delete(file_path)
+def unpack_result(data):
+    result = json.loads(data)
+    return result["outputs"], result["completion"]
 
 # =================================================================
 # COMFYUI API LOGIC
 # =================================================================
-def get_images(ws, prompt, client_id, job):
-    # 1. Submit Prompt
-    p = {"prompt": prompt, "client_id": client_id}
-    response = requests.post(f"http://{SERVER_ADDRESS}/prompt", json=p)
-    response.raise_for_status()
-    prompt_id = response.json()['prompt_id']
-    
-    # 2. Monitor WebSocket
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'progress':
-                data = message['data']
-                runpod.serverless.progress_update(job, f"Step {data['value']}/{data['max']}")
-            if message['type'] == 'executing':
-                if message['data']['node'] is None and message['data']['prompt_id'] == prompt_id:
-                    break 
-        else:
-            continue
+# Binary frame header: event type (1 = image) + image format, both uint32 BE
+BINARY_IMAGE_EVENT = 1
+BINARY_IMAGE_FORMATS = {1: "jpg", 2: "png", 3: "webp"}
 
-    # 3. Retrieve History (Retry Loop)
-    history = {}
-    for i in range(5):
-        time.sleep(0.2)
+# Keys of a node's UI output that list saved files: images (also animated
+# webp/video from core nodes), gifs (VideoHelperSuite), videos and audio
+OUTPUT_KEYS = ("images", "gifs", "videos", "audio")
+
+def terminal_nodes(prompt):
+    """Node IDs whose outputs are not consumed by any other node."""
+    linked = set()
+    for node in prompt.values():
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2:
+                linked.add(str(value[0]))
+    return {str(node_id) for node_id in prompt if str(node_id) not in linked}
+
+def extract_outputs(node_output):
+    """Yields (filename, subfolder) for every file in a node's UI output."""
+    for key in OUTPUT_KEYS:
+        for item in node_output.get(key, []):
+            if isinstance(item, dict) and 'filename' in item:
+                yield item['filename'], item.get('subfolder', '')
+
+def fetch_history(conn, prompt_id, timeout=3.0, delay=0.05, deadline=None, cancelled=None):
+    """
+    Fallback: poll /history with exponential backoff (capped at 1s). Raises
+    like check_abandoned once the job's `deadline` passes or it is `cancelled`.
+    """
+    give_up = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        check_abandoned(deadline, cancelled)
         try:
-            resp = requests.get(f"http://{SERVER_ADDRESS}/history/{prompt_id}")
+            resp = conn.get(f"/history/{prompt_id}")
             if resp.status_code == 200:
                 data = resp.json()
                 if prompt_id in data:
-                    history = data[prompt_id]
-                    break
+                    return data[prompt_id]
         except Exception:
             pass
-        print(f"⏳ History API not ready, retry {i+1}/5...")
+        attempt += 1
+        if time.monotonic() >= give_up:
+            return {}
+        print(f"⏳ History API not ready, retry {attempt}...")
+        time.sleep(delay if deadline is None else min(delay, max(deadline - time.monotonic(), 0.0)))
+        delay = min(delay * 2, 1.0)
+
+def execution_failure(event, data):
+    """Error message for an execution_error / execution_interrupted event."""
+    node = f"node {data.get('node_id')} ({data.get('node_type')})"
+    if event == "execution_interrupted":
+        return f"ComfyUI interrupted the prompt at {node}."
+    return f"ComfyUI error in {node}: {str(data.get('exception_message', '')).strip()}"
+
+def history_failure(history):
+    """The failure recorded in a /history entry's status messages, if any."""
+    for event, data in history.get("status", {}).get("messages", []):
+        if event in ("execution_error", "execution_interrupted"):
+            return execution_failure(event, data)
+    return None
+
+def check_abandoned(deadline=None, cancelled=None):
+    """Raises when the job was cancelled or ran past its deadline."""
+    if cancelled is not None and cancelled.is_set():
+        raise Exception("Job was cancelled.")
+    if deadline is not None and time.monotonic() >= deadline:
+        raise Exception("Job exceeded its time limit.")
 
+def wait_for_file(path, timeout=2.0, delay=0.01):
+    """Fallback: wait for an output file with exponential backoff."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, 0.4)
+
+def iter_outputs(
+    conn, prompt_id, events, prompt, job, ws_nodes=None, info=None, timer=None, variant=None,
+    deadline=None, cancelled=None
+):
+    """
+    Yields (filename, subfolder or bytes) for a queued prompt as each output
+    node finishes. On exhaustion info["source"] says whether the websocket
+    was enough or /history had to fill in. A NodeTimer (see metrics.py)
+    is fed every event and the time spent on /history; progress is handed
+    to progress_reporter without waiting on the RunPod API.
+    Raises on ComfyUI errors and interrupts, past the monotonic `deadline`,
+    once the `cancelled` Event is set, or when a running prompt goes quiet
+    for EXECUTION_IDLE_TIMEOUT. info["finished"] tells the caller whether
+    the prompt is over in ComfyUI or still has to be cancelled there.
+    """
+    ws_nodes = ws_nodes or {}
+    info = info if info is not None else {}
+    seen = set()
+    timer = timer or NodeTimer(prompt, time.monotonic())
+    signature = workflow_signature(prompt, SEED_INPUTS)
+    progress = ProgressTracker(prompt, timer, node_durations.get(signature), variant)
+
+    try:
+        # 2. Monitor WebSocket
+        cached_nodes = set()
+        current_node = None
+        frame_counts = {}
+        history_timeout = 3.0
+        lost_events = False
+        last_event = last_check = time.monotonic()
+        while True:
+            check_abandoned(deadline, cancelled)
+            # Short waits so cancellation and deadlines are noticed promptly
+            wait = 1.0 if deadline is None else min(1.0, max(deadline - time.monotonic(), 0.01))
+            try:
+                kind, message = events.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                if now - last_check < QUIET_CHECK_INTERVAL:
+                    continue
+                last_check = now
+                state = conn.prompt_state(prompt_id)
+                if state == "done":
+                    # Finished, but its events never reached us
+                    if ws_nodes:
+                        raise Exception("ComfyUI websocket events were lost while streaming in-memory outputs.")
+                    lost_events = True
+                    break
+                if state == "pending":
+                    # Waiting behind other prompts is not a stall
+                    last_event = now
+                elif EXECUTION_IDLE_TIMEOUT and now - last_event > EXECUTION_IDLE_TIMEOUT:
+                    raise Exception(f"ComfyUI sent no events for {EXECUTION_IDLE_TIMEOUT:.0f}s; the prompt looks stuck.")
+                continue
+            last_event = time.monotonic()
+            if kind == "disconnected":
+                if ws_nodes:
+                    raise Exception("ComfyUI websocket dropped while streaming in-memory outputs.")
+                # Events for this prompt may be lost; wait on history instead
+                lost_events = True
+                history_timeout = HISTORY_WAIT_TIMEOUT
+                break
+            if kind == "binary":
+                if current_node in ws_nodes and len(message) > 8:
+                    event_type = int.from_bytes(message[:4], "big")
+                    image_format = int.from_bytes(message[4:8], "big")
+                    if event_type == BINARY_IMAGE_EVENT:
+                        count = frame_counts[current_node] = frame_counts.get(current_node, 0) + 1
+                        ext = BINARY_IMAGE_FORMATS.get(image_format, "png")
+                        filename = f"{ws_nodes[current_node]}_{current_node}_{count:05}_.{ext}"
+                        seen.add(filename)
+                        yield filename, message[8:]
+                continue
+            timer.observe(message)
+            progress.observe(message)
+            data = message.get('data') or {}
+            if message['type'] in ('progress', 'executing'):
+                progress_reporter.update(job, progress.snapshot())
+            if message['type'] in ('execution_error', 'execution_interrupted'):
+                info["finished"] = True
+                raise Exception(execution_failure(message['type'], data))
+            if message['type'] == 'execution_cached':
+                cached_nodes.update(str(n) for n in data.get('nodes', []))
+            elif message['type'] == 'executed':
+                for filename, subfolder in extract_outputs(data.get('output') or {}):
+                    if filename not in seen:
+                        seen.add(filename)
+                        yield filename, subfolder
+            elif message['type'] == 'executing':
+                current_node = data['node']
+                if data['node'] is None:
+                    info["finished"] = True
+                    node_durations.record(signature, timer.nodes)
+                    break 
+    finally:
+        conn.release(prompt_id)
+
+    # 3. Cached output nodes emit no `executed` event; only then ask history
+    if seen and not lost_events and not (cached_nodes & terminal_nodes(prompt)):
+        info["source"] = "websocket"
+        return
+
+    history_started = time.monotonic()
+    history = fetch_history(conn, prompt_id, timeout=history_timeout, deadline=deadline, cancelled=cancelled)
+    timer.history_seconds += time.monotonic() - history_started
     if not history:
         raise Exception("Failed to retrieve job metadata from ComfyUI history.")
+    info["finished"] = True
+    failure = history_failure(history)
+    if failure:
+        raise Exception(failure)
 
     # 4. Extract filenames
-    output_images = {}
-    for node_id in history.get('outputs', {}):
-        node_output = history['outputs'][node_id]
-        if 'images' in node_output:
-            for img in node_output['images']:
-                output_images[img['filename']] = img['subfolder']
+    for node_output in history.get('outputs', {}).values():
+        for filename, subfolder in extract_outputs(node_output):
+            if filename not in seen:
+                seen.add(filename)
+                yield filename, subfolder
                 
-    return output_images
+    info["source"] = "history"
+
+def read_output(filename, subfolder, raw=False):
+    """
+    Loads one output reported by iter_outputs. Returns (data, waited):
+    data is raw bytes if `raw`, else a base64 string; None if missing.
+    """
+    if isinstance(subfolder, (bytes, bytearray)):
+        # Zero-disk mode: bytes came straight off the websocket
+        return (subfolder if raw else base64.b64encode(subfolder).decode('utf-8')), False
+
+    file_path = os.path.join(OUTPUT_DIR, subfolder, filename)
+    
+    # `executed` is sent after the file is written, so this is normally
+    # an immediate hit; the backoff wait only covers slow filesystems.
+    waited = False
+    if not (os.path.exists(file_path) and os.path.getsize(file_path) > 0):
+        waited = True
+        wait_for_file(file_path)
+    
+    if not os.path.exists(file_path):
+        print(f"⚠️ Error: Output file {filename} listed in history but missing from disk.")
+        return None, waited
+
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return (data if raw else base64.b64encode(data).decode('utf-8')), waited
+
+def build_variants(workflow, variants):
+    """
+    Expands a batch request into [(key, workflow)]. Each variant is either
+    {"workflow": {...}} or overrides for the base workflow (see
+    injection.apply_overrides); "key" names it in the results.
+    """
+    if not variants:
+        return [(None, workflow)]
+    built = []
+    for i, variant in enumerate(variants):
+        key = str(variant.get("key", i))
+        if "workflow" in variant:
+            built.append((key, variant["workflow"]))
+        elif workflow:
+            overrides = {k: v for k, v in variant.items() if k != "key"}
+            built.append((key, apply_overrides(workflow, overrides)))
+        else:
+            raise ValueError(f"Variant {key} has no workflow and no base workflow was given.")
+    if len({key for key, _ in built}) != len(built):
+        raise ValueError("Variant keys must be unique.")
+    return built
 
 # =================================================================
-# MAIN HANDLER
+# JOB EXECUTION
 # =================================================================
-def handler(job):
+def prepare_job(job):
+    """
+    Decrypts and unpacks a job. Returns (ctx, None) on success or
+    (None, response) when the job must be answered without running.
+    """
     job_input = job["input"]
     is_encrypted = job_input.get("is_encrypted", False)
-    debug_mode = job_input.get("debug", False)
-    
+    use_envelope = "envelope" in job_input
+    metrics = JobMetrics()
+
     # 1. Decryption Layer
     try:
-        if is_encrypted:
-            if not cipher:
-                return {"status": "error", "message": "Server missing ENCRYPTION_KEY."}
-            print("🔓 Decrypting internal payload...")
-            decrypted_data = cipher.decrypt(job_input["encrypted_input"].encode()).decode()
-            inner_payload = json.loads(decrypted_data)
-            workflow = inner_payload.get("workflow")
-            images_dict = inner_payload.get("images", {})
-        else:
-            workflow = job_input.get("workflow")
-            images_dict = job_input.get("images", {})
+        with metrics.phase("decrypt"):
+            if use_envelope:
+                # Binary envelope: raw image bytes, no base64 inside the ciphertext
+                if not envelope_key:
+                    return None, {"status": "error", "message": "Server missing ENCRYPTION_KEY."}
+                print("🔓 Opening binary envelope...")
+                inner_payload, images_dict = unseal(envelope_key, base64.b64decode(job_input["envelope"]))
+            elif is_encrypted:
+                if not cipher:
+                    return None, {"status": "error", "message": "Server missing ENCRYPTION_KEY."}
+                print("🔓 Decrypting internal payload...")
+                decrypted_data = cipher.decrypt(job_input["encrypted_input"].encode()).decode()
+                inner_payload = json.loads(decrypted_data)
+                images_dict = inner_payload.get("images", {})
+            else:
+                inner_payload = job_input
+                images_dict = job_input.get("images", {})
     except Exception as e:
-        return {"status": "error", "message": f"Decryption failed: {str(e)}"}
+        return None, {"status": "error", "message": f"Decryption failed: {str(e)}"}
 
-    if not workflow:
-        return {"status": "error", "message": "No workflow provided."}
+    workflow = inner_payload.get("workflow")
+    variants = inner_payload.get("variants")
+    if not workflow and not variants:
+        return None, {"status": "error", "message": "No workflow provided."}
 
-    client_id = str(uuid.uuid4())
-    ws = websocket.WebSocket()
-    
     try:
-        ws.connect(f"ws://{SERVER_ADDRESS}/ws?clientId={client_id}")
-        
-        if not debug_mode:
+        deadline = job_deadline(job_input, metrics.started)
+    except ValueError as e:
+        return None, {"status": "error", "message": str(e)}
+
+    # 1b. Content-addressed inputs: ask the client for anything not cached
+    image_refs = inner_payload.get("image_refs", {})
+    if image_refs:
+        try:
+            with metrics.phase("resolve_inputs"):
+                images_dict, missing = resolve_cached_inputs(images_dict, image_refs)
+        except Exception as e:
+            return None, {"status": "error", "message": str(e)}
+        if missing:
+            print(f"📭 {len(missing)} input(s) not cached on this worker.")
+            return None, {"status": "missing_inputs", "missing": missing}
+
+    # 1c. Expand variants and validate them before touching disk or queue
+    try:
+        built = build_variants(workflow, variants)
+    except Exception as e:
+        return None, {"status": "error", "message": str(e)}
+    object_info = get_object_info() if VALIDATE_WORKFLOWS else None
+    if object_info:
+        errors = []
+        try:
+            with metrics.phase("validate"):
+                input_names = set(images_dict) | {os.path.basename(name) for name in images_dict}
+                for key, variant_workflow in built:
+                    for error in validate_workflow(variant_workflow, object_info, input_names):
+                        errors.append(error if key is None else {**error, "variant": key})
+        except Exception as e:
+            print(f"❌ Workflow validation crashed: {e}")
+            return None, {"status": "error", "message": f"Workflow validation failed: {e}"}
+        if errors:
+            print(f"🚫 Workflow rejected: {len(errors)} validation error(s).")
+            return None, {"status": "error", "message": "Workflow validation failed.", "errors": errors}
+
+    # 1d. Output format, previews and offload; nothing to do for plain PNGs
+    # when no bucket is configured
+    delivery = None
+    if inner_payload.get("delivery") or output_bucket is not None:
+        try:
+            delivery = delivery_options(inner_payload.get("delivery"))
+        except Exception as e:
+            return None, {"status": "error", "message": str(e)}
+        if delivery["offload"] == "always" and output_bucket is None:
+            return None, {"status": "error", "message": "Offload requested but no BUCKET_NAME is configured."}
+
+    return {
+        "workflow": workflow,
+        "variants": variants,
+        "built": built,
+        "images": images_dict,
+        "use_envelope": use_envelope,
+        "is_encrypted": is_encrypted,
+        "delivery": delivery,
+        "output_mode": job_input.get("output_mode", OUTPUT_MODE),
+        "debug": job_input.get("debug", False),
+        "use_cache": job_input.get("cache", True),
+        "deadline": deadline,
+        "metrics": metrics,
+        "return_metrics": job_input.get("metrics", False)
+    }, None
+
+def job_deadline(job_input, started):
+    """
+    Monotonic deadline from the job's "timeout" or JOB_TIMEOUT; None without
+    a limit. Raises ValueError unless a given "timeout" is a positive number.
+    """
+    timeout = job_input.get("timeout")
+    if timeout is None:
+        timeout = JOB_TIMEOUT
+    else:
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            timeout = None
+        if timeout is None or not timeout > 0:
+            raise ValueError("Job timeout must be a positive number of seconds.")
+    return started + timeout if timeout > 0 else None
+
+def execute_job(job, ctx):
+    """
+    Runs a prepared job and yields events as they happen:
+      ("output", key, filename, data)  - one output file (raw bytes with
+                                         an envelope or delivery, else base64)
+      ("done", key, completion_info)   - a variant finished
+      ("failed", key, message)         - a variant failed (batch jobs only)
+    Plain jobs are a single variant with key None; their failures raise.
+    """
+    variants = ctx["variants"]
+    # Envelopes and Delivery want bytes; plain JSON responses want base64
+    raw = ctx["use_envelope"] or ctx["delivery"] is not None
+    output_mode = ctx["output_mode"]
+    debug_mode = ctx["debug"]
+    metrics = ctx["metrics"]
+    deadline = ctx["deadline"]
+    cancelled = _cancel_flags.get(job.get("id"))
+
+    scope = job_scope(job)
+    input_scope = os.path.join(INPUT_DIR, scope)
+    output_scope = os.path.join(OUTPUT_DIR, scope)
+    pinned_models = []
+    backend = None
+    # Prompts queued in ComfyUI that have not finished there yet
+    unfinished = set()
+
+    try:
+        images = {os.path.basename(k): v for k, v in ctx["images"].items()}
+        built = ctx["built"]
+
+        # 1. Result cache: repeats of deterministic requests skip ComfyUI.
+        # Inputs are decoded and hashed here; hits never write them to disk.
+        cache_keys = {}
+        if result_cache is not None and ctx["use_cache"]:
+            hits = []
+            with metrics.phase("result_cache"):
+                digests, images = hash_inputs(images)
+                for key, variant_workflow in built:
+                    if has_fixed_seeds(variant_workflow):
+                        cache_keys[key] = result_key(variant_workflow, digests, output_mode)
+                        cached = result_cache.get(cache_keys[key])
+                        if cached is not None:
+                            hits.append((key, cached))
+            for key, cached in hits:
+                print(f"♻️ Result cache hit{'' if key is None else f' for variant {key}'}.")
+                outputs, completion = unpack_result(cached)
+                for filename, data in outputs:
+                    yield "output", key, filename, base64.b64decode(data) if raw else data
+                yield "done", key, {**completion, "cached": True}
+            hit_keys = {key for key, _ in hits}
+            built = [(key, wf) for key, wf in built if key not in hit_keys]
+            if not built:
+                return
+
+        if not debug_mode and MAX_CONCURRENCY == 1:
             clear_directory(INPUT_DIR)
             clear_directory(OUTPUT_DIR)
-        
-        # 2. Write Input Images (fsync fix)
-        for filename, b64_str in images_dict.items():
-            file_path = os.path.join(INPUT_DIR, filename)
-            with open(file_path, "wb") as f:
-                f.write(base64.b64decode(b64_str))
-                f.flush()
-                os.fsync(f.fileno())
-                    
-        # 3. Execute Workflow
-        output_files = get_images(ws, workflow, client_id, job)
-        
-        # 4. Encode Output Images (Polling Wait Fix)
-        result_images = {}
-        
-        for filename in output_files:
-            file_path = os.path.join(OUTPUT_DIR, filename)
-            
-            # Wait up to 2 seconds for the file to appear on disk
-            # This fixes the "Success but empty" race condition
-            for _ in range(10): 
-                if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                    break
-                time.sleep(0.2)
-            
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as f:
-                    result_images[filename] = base64.b64encode(f.read()).decode('utf-8')
+
+        # 1b. Decode and write inputs in chunks on the I/O pool
+        with metrics.phase("write_inputs"):
+            write_inputs(input_scope, images)
+
+        # 2. Pick the ComfyUI instance (shortest queue, models already loaded)
+        dispatcher = get_dispatcher()
+        backend = dispatcher.acquire([wf for _, wf in built])
+        conn = backend.conn
+
+        # 3. Prepare every variant (a plain job is a single unnamed variant)
+        prepared = []
+        with metrics.phase("prepare"):
+            for key, variant_workflow in built:
+                ws_nodes = {}
+                if output_mode == "websocket":
+                    variant_workflow, ws_nodes = use_websocket_save(variant_workflow)
+                prepared.append((key, scope_workflow(variant_workflow, scope, images), ws_nodes))
+
+        # Lazy mode: make sure the referenced models are on disk before queuing
+        if model_store is not None:
+            with metrics.phase("models"):
+                pinned_models = model_store.acquire([wf for _, wf, _ in prepared])
+
+        # 4. Queue them all at once so the GPU never idles between variants
+        submitted = []
+        for key, variant_workflow, ws_nodes in prepared:
+            try:
+                check_abandoned(deadline, cancelled)
+                queued_at = time.monotonic()
+                with metrics.phase("submit"):
+                    prompt_id, events = conn.queue_prompt(variant_workflow)
+                unfinished.add(prompt_id)
+                timer = metrics.timer(key, variant_workflow, queued_at)
+                submitted.append((key, variant_workflow, ws_nodes, prompt_id, events, timer, None))
+            except Exception as e:
+                if variants is None:
+                    raise
+                submitted.append((key, variant_workflow, ws_nodes, None, None, None, e))
+
+        # 5. Read outputs as each node finishes, variant by variant
+        for key, variant_workflow, ws_nodes, prompt_id, events, timer, error in submitted:
+            if error is not None:
+                print(f"❌ Variant {key} failed: {error}")
+                yield "failed", key, str(error)
+                continue
+            info = {}
+            disk_waits = 0
+            produced = []
+            try:
+                for filename, subfolder in iter_outputs(
+                    conn, prompt_id, events, variant_workflow, job, ws_nodes, info, timer, key,
+                    deadline, cancelled
+                ):
+                    with metrics.phase("read_outputs"):
+                        data, waited = read_output(filename, subfolder, raw=raw)
+                    disk_waits += waited
+                    if data is not None:
+                        if key in cache_keys:
+                            produced.append((filename, data))
+                        yield "output", key, filename, data
+            except Exception as e:
+                if info.get("finished"):
+                    unfinished.discard(prompt_id)
+                if variants is None:
+                    raise
+                print(f"❌ Variant {key} failed: {e}")
+                yield "failed", key, str(e)
+                continue
+            unfinished.discard(prompt_id)
+            dispatcher.completed(backend, variant_workflow)
+            completion = {"source": info["source"], "disk_waits": disk_waits, "output_mode": output_mode}
+            if len(dispatcher.backends) > 1:
+                completion["backend"] = backend.address
+            if key in cache_keys and produced:
+                try:
+                    result_cache.put(cache_keys[key], pack_result([
+                        (filename, base64.b64encode(data).decode('utf-8') if raw else data)
+                        for filename, data in produced
+                    ], completion))
+                except Exception as e:
+                    print(f"⚠️ Could not cache result: {e}")
+            yield "done", key, {**completion, "cached": False}
+
+    finally:
+        progress_reporter.finish(job)
+        _cancel_flags.pop(job.get("id"), None)
+        if unfinished:
+            # Abandoned (error, deadline, cancel or the caller went away):
+            # free ComfyUI for the next job instead of letting these run on
+            try:
+                stopped = conn.cancel(unfinished)
+                print(f"🛑 Removed {len(stopped['deleted'])} queued and interrupted "
+                      f"{len(stopped['interrupted'])} running prompt(s) of this job.")
+            except Exception as e:
+                print(f"⚠️ Could not cancel ComfyUI prompts: {e}")
+        if backend is not None:
+            dispatcher.release(backend)
+        if pinned_models:
+            model_store.release(pinned_models)
+        if not debug_mode:
+            with metrics.phase("cleanup"):
+                remove_tree(input_scope)
+                remove_tree(output_scope)
+
+def job_events(job, ctx):
+    """execute_job's events, with outputs transcoded and offloaded when the job needs it."""
+    events = execute_job(job, ctx)
+    if ctx["delivery"] is None:
+        return events
+    # Uploads of encrypted jobs are encrypted the same way as their input,
+    # so a third-party bucket never holds their plaintext
+    seal_blob, sealed_as = None, True
+    if ctx["use_envelope"]:
+        seal_blob = lambda name, data: seal(envelope_key, {"filename": name}, {name: data})
+    elif ctx["is_encrypted"]:
+        seal_blob, sealed_as = lambda name, data: cipher.encrypt(data), "fernet"
+    return Delivery(
+        ctx["delivery"], job.get("id"), output_bucket, seal_blob, ctx["metrics"],
+        raw=ctx["use_envelope"], sealed_as=sealed_as
+    ).run(events)
+
+def seal_response(payload, blobs=None, status="success"):
+    """Encrypted envelope response: results go back the way inputs came."""
+    sealed = seal(envelope_key, payload, blobs or {})
+    return {"status": status, "envelope": base64.b64encode(sealed).decode('utf-8')}
+
+def attach_metrics(ctx, payload):
+    """Adds the `metrics` field when the job input asked for it."""
+    if ctx["return_metrics"]:
+        payload["metrics"] = ctx["metrics"].as_dict()
+    return payload
+
+def export_metrics(job, ctx, status):
+    if metrics_sink is None:
+        return
+    try:
+        metrics_sink.record(job.get("id"), status, ctx["metrics"])
+    except Exception as e:
+        print(f"⚠️ Could not write metrics: {e}")
+
+# =================================================================
+# MAIN HANDLER
+# =================================================================
+def handler(job):
+    ctx, response = prepare_job(job)
+    if response:
+        return response
+
+    response = build_response(job, ctx)
+    export_metrics(job, ctx, response["status"])
+    return response
+
+def build_response(job, ctx):
+    results = {}
+    try:
+        for event in job_events(job, ctx):
+            kind, key = event[0], event[1]
+            result = results.setdefault(key, {"status": "success", "images": {}})
+            if kind == "output":
+                result["images"][event[2]] = event[3]
+            elif kind == "link":
+                result.setdefault("links", {})[event[2]] = event[3]
+            elif kind == "done":
+                result["completion"] = event[2]
             else:
-                print(f"⚠️ Error: Output file {filename} listed in history but missing from disk.")
+                results[key] = {"status": "error", "message": event[2]}
+    except Exception as e:
+        print(f"❌ Handler Error: {e}")
+        return attach_metrics(ctx, {"status": "error", "message": str(e)})
 
-        return {"status": "success", "images": result_images}
+    use_envelope = ctx["use_envelope"]
+    with ctx["metrics"].phase("encode"):
+        if ctx["variants"] is None:
+            result = results[None]
+            if use_envelope:
+                meta = {"completion": result["completion"]}
+                if "links" in result:
+                    meta["links"] = result["links"]
+                return seal_response(attach_metrics(ctx, meta), result["images"])
+            return attach_metrics(ctx, result)
 
+        status = "success" if any(r["status"] == "success" for r in results.values()) else "error"
+        if use_envelope:
+            meta = {"variants": {}}
+            blobs = {}
+            for key, result in results.items():
+                images = result.pop("images", {})
+                meta["variants"][key] = {**result, "images": list(images)}
+                blobs.update({f"{key}/{name}": data for name, data in images.items()})
+            return seal_response(attach_metrics(ctx, meta), blobs, status)
+        return attach_metrics(ctx, {"status": status, "variants": results})
+
+def stream_handler(job):
+    """
+    Generator handler: yields every output as soon as its node finishes
+    instead of holding all of them until the end. Each item is
+    {"filename", "data"} (plus "variant" in batch jobs), {"filename", "link"}
+    for an offloaded output, or an "envelope" sealing the same fields; a
+    final status item closes the stream.
+    """
+    ctx, response = prepare_job(job)
+    if response:
+        yield response
+        return
+
+    use_envelope = ctx["use_envelope"]
+    metrics = ctx["metrics"]
+    completions = {}
+    try:
+        for event in job_events(job, ctx):
+            kind, key = event[0], event[1]
+            if kind == "output":
+                filename, data = event[2], event[3]
+                meta = {"filename": filename}
+                if key is not None:
+                    meta["variant"] = key
+                with metrics.phase("encode"):
+                    item = seal_response(meta, {filename: data}) if use_envelope else {"status": "success", **meta, "data": data}
+                yield item
+            elif kind == "link":
+                meta = {"filename": event[2], "link": event[3]}
+                if key is not None:
+                    meta["variant"] = key
+                yield seal_response(meta) if use_envelope else {"status": "success", **meta}
+            elif kind == "done":
+                completions[key] = {"status": "success", "completion": event[2]}
+            else:
+                completions[key] = {"status": "error", "message": event[2]}
     except Exception as e:
         print(f"❌ Handler Error: {e}")
-        return {"status": "error", "message": str(e)}
-    finally:
-        ws.close()
-        if not debug_mode:
-            clear_directory(INPUT_DIR)
-            clear_directory(OUTPUT_DIR)
+        export_metrics(job, ctx, "error")
+        yield attach_metrics(ctx, {"status": "error", "message": str(e)})
+        return
+
+    if ctx["variants"] is None:
+        final = {"status": "success", "completion": completions[None]["completion"], "done": True}
+    else:
+        status = "success" if any(r["status"] == "success" for r in completions.values()) else "error"
+        final = {"status": status, "variants": completions, "done": True}
+    export_metrics(job, ctx, final["status"])
+    yield attach_metrics(ctx, final)
+
+def on_cancel(job, cancelled):
+    # The worker thread cannot be killed; the flag makes it cancel its
+    # ComfyUI prompts and return. It then drops the flag (execute_job).
+    cancelled.set()
+    print(f"🛑 Job {job.get('id')} was cancelled by RunPod.")
+
+async def async_handler(job):
+    """
+    Concurrent entry point: the blocking handler runs on a worker thread so
+    one job's decrypt/decode/encode overlaps another job's GPU execution.
+    """
+    cancelled = _cancel_flags[job.get("id")] = threading.Event()
+    try:
+        response = await asyncio.to_thread(handler, job)
+    except asyncio.CancelledError:
+        on_cancel(job, cancelled)
+        raise
+    _cancel_flags.pop(job.get("id"), None)
+    return response
+
+async def async_stream_handler(job):
+    """Concurrent streaming entry point; each step runs on a worker thread."""
+    cancelled = _cancel_flags[job.get("id")] = threading.Event()
+    stream = stream_handler(job)
+    done = object()
+    while True:
+        try:
+            item = await asyncio.to_thread(next, stream, done)
+        except asyncio.CancelledError:
+            on_cancel(job, cancelled)
+            raise
+        if item is done:
+            break
+        yield item
+    _cancel_flags.pop(job.get("id"), None)
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENCY
 
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    # Connect once up front so the first job pays no handshake either
+    get_connection()
+    if len(COMFY_SERVERS) > 1:
+        print(f"🔀 Dispatching across {len(COMFY_SERVERS)} ComfyUI instances: {', '.join(COMFY_SERVERS)}")
+        if MAX_CONCURRENCY < len(COMFY_SERVERS):
+            print(f"⚠️ MAX_CONCURRENCY={MAX_CONCURRENCY} leaves some instances idle; set it to at least {len(COMFY_SERVERS)}.")
+    if VALIDATE_WORKFLOWS:
+        get_object_info()
+    if STREAM_OUTPUTS:
+        print("📡 Streaming mode: outputs are yielded as nodes finish.")
+    # Async entry points even for one job at a time: a blocking handler
+    # would stall RunPod's event loop, so cancellations never got through
+    config = {
+        "handler": async_stream_handler if STREAM_OUTPUTS else async_handler,
+        "concurrency_modifier": concurrency_modifier
+    }
+    if STREAM_OUTPUTS:
+        config["return_aggregate_stream"] = True
+    if MAX_CONCURRENCY > 1:
+        print(f"⚡ Concurrency mode: up to {MAX_CONCURRENCY} jobs at once.")
+    runpod.serverless.start(config)
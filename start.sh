@@ -27,22 +27,12 @@ setup_ssh() {
     fi
 }
 
-# =================================================================
-# 2. MODEL PREPARATION
-# =================================================================
-echo "---------------------------------------------------"
-echo "📥 Syncing Models via utils.py..."
-echo "---------------------------------------------------"
-
 # Navigate to application folder and activate environment
 cd /ComfyUI
 source .venv/bin/activate
 
-# Use the utility script to download or link models from cache
-python3 utils.py
-
 # =================================================================
-# 3. SECURE RAM DISK SETUP (Input/Output)
+# 2. SECURE RAM DISK SETUP (Input/Output)
 # =================================================================
 echo "---------------------------------------------------"
 echo "🛡️  Setting up Secure RAM Disk in /dev/shm"
@@ -62,7 +52,7 @@ echo "✅ /ComfyUI/input  -> /dev/shm/input"
 echo "✅ /ComfyUI/output -> /dev/shm/output"
 
 # =================================================================
-# 4. LAUNCH COMFYUI SERVER
+# 3. PROVISION MODELS & LAUNCH COMFYUI SERVER
 # =================================================================
 echo "---------------------------------------------------"
 echo "🚀 Launching ComfyUI & SSH Services..."
@@ -74,37 +64,16 @@ setup_ssh
 # Create a log file for startup monitoring
 touch /ComfyUI/comfyui.log
 
-# Start ComfyUI in the background
-# --listen 127.0.0.1: Only accessible to localhost (secure)
-# --fast / --use-pytorch-cross-attention: Optimization flags
-# TODO : readd --fast if it works!
-python3 main.py --listen 127.0.0.1 --port 8188 --use-pytorch-cross-attention >> /ComfyUI/comfyui.log 2>&1 &
-COMFY_PID=$!
-
-# Health Check: Wait for ComfyUI to respond on localhost:8188
-echo "⏳ Waiting for ComfyUI to become responsive..."
-MAX_RETRIES=60
-COUNT=0
-
-while ! curl -s http://127.0.0.1:8188 > /dev/null; do
-    # Display the last line of the log to see startup errors or progress
-    tail -n 1 /ComfyUI/comfyui.log
-    
-    sleep 2
-    ((COUNT++))
-    
-    if [ $COUNT -ge $MAX_RETRIES ]; then
-        echo "❌ ERROR: ComfyUI failed to start within timeout."
-        echo "--- Full Log ---"
-        cat /ComfyUI/comfyui.log
-        exit 1
-    fi
-done
-
-echo "✅ ComfyUI is Alive!"
+# startup.py downloads/links models (utils.py) while ComfyUI boots, waits
+# for /system_stats, runs the optional WARMUP_WORKFLOW and logs phase
+# timings. ComfyUI keeps running in the background once it returns.
+if ! python3 startup.py; then
+    echo "❌ ERROR: Start-up failed (ComfyUI or model provisioning)."
+    exit 1
+fi
 
 # =================================================================
-# 5. START SERVERLESS HANDLER OR INTERACTIVE MODE
+# 4. START SERVERLESS HANDLER OR INTERACTIVE MODE
 # =================================================================
 echo "---------------------------------------------------"
 
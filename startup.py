@@ -0,0 +1,246 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from comfy_conn import ComfyConnection
+from dispatch import COMFY_BASE_PORT, instance_devices
+
+# =================================================================
+# CONFIGURATION
+# =================================================================
+COMFY_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = os.path.join(COMFY_DIR, "comfyui.log")
+OUTPUT_DIR = os.path.join(COMFY_DIR, "output")
+
+# Seconds ComfyUI may take to answer /system_stats before start-up fails
+STARTUP_TIMEOUT = float(os.environ.get("STARTUP_TIMEOUT", 120))
+
+# Optional API-format workflow run once before the handler accepts jobs,
+# so the first real job does not pay the model load into VRAM
+WARMUP_WORKFLOW = os.environ.get("WARMUP_WORKFLOW")
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", 600))
+
+# --listen 127.0.0.1: Only accessible to localhost (secure)
+# --fast / --use-pytorch-cross-attention: Optimization flags
+# TODO : readd --fast if it works!
+# --port is added per instance (8188, 8189, ...; see dispatch.py)
+COMFY_ARGS = ["--listen", "127.0.0.1", "--use-pytorch-cross-attention"]
+
+phase_times = {}
+
+def load_provisioning():
+    """utils.py as a module. ComfyUI ships a utils/ package that shadows it, so load it by path."""
+    spec = importlib.util.spec_from_file_location("provisioning", os.path.join(COMFY_DIR, "utils.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def timed(name, started):
+    phase_times[name] = round(time.monotonic() - started, 3)
+    print(f"⏱️  {name}: {phase_times[name]}s")
+
+def log_file(index):
+    # Instance 0 keeps the usual comfyui.log; the others get comfyui_<n>.log
+    return LOG_FILE if index == 0 else os.path.join(COMFY_DIR, f"comfyui_{index}.log")
+
+def tail_log(lines=1, path=LOG_FILE):
+    try:
+        with open(path, "r", errors="replace") as f:
+            return "".join(f.readlines()[-lines:]).rstrip()
+    except OSError:
+        return ""
+
+# =================================================================
+# PHASES
+# =================================================================
+def provision(provisioning, result):
+    started = time.monotonic()
+    try:
+        if provisioning.PROVISION_MODE == "lazy":
+            print("💤 PROVISION_MODE=lazy: models are fetched per workflow by rp_handler.")
+        else:
+            result["report"] = provisioning.prepare_models()
+    except Exception as e:
+        print(f"❌ Model provisioning failed: {e}")
+        result["error"] = str(e)
+    timed("provision", started)
+
+def launch_comfyui(index=0, device=None):
+    """Starts one ComfyUI instance; `device` is a CUDA index, "cpu" or None."""
+    args = [*COMFY_ARGS, "--port", str(COMFY_BASE_PORT + index)]
+    if device == "cpu":
+        args.append("--cpu")
+    elif device is not None:
+        args += ["--cuda-device", device]
+    log = open(log_file(index), "a")
+    return subprocess.Popen(
+        [sys.executable, "main.py", *args],
+        cwd=COMFY_DIR, stdout=log, stderr=subprocess.STDOUT
+    )
+
+def wait_until_ready(process, index=0, timeout=STARTUP_TIMEOUT):
+    """Polls /system_stats with short backoff until ComfyUI answers."""
+    started = time.monotonic()
+    delay = 0.05
+    last_line = None
+    while time.monotonic() - started < timeout:
+        if process.poll() is not None:
+            raise Exception(f"ComfyUI exited during start-up (code {process.returncode}).")
+        try:
+            if requests.get(f"http://127.0.0.1:{COMFY_BASE_PORT + index}/system_stats", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        # Show start-up progress without repeating the same line
+        line = tail_log(path=log_file(index))
+        if line and line != last_line:
+            print(line)
+            last_line = line
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    raise Exception(f"ComfyUI did not become ready within {timeout:.0f}s.")
+
+def warm_up(workflow, address, timeout=WARMUP_TIMEOUT):
+    """Runs the warm-up workflow once on one instance and waits for it to finish."""
+    conn = ComfyConnection(address)
+    prompt_id = None
+    try:
+        conn.start()
+        prompt_id, events = conn.queue_prompt(workflow)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f"Warm-up did not finish within {timeout:.0f}s.")
+            try:
+                kind, message = events.get(timeout=min(remaining, 5))
+            except Exception:
+                # Quiet socket: check history in case events were missed
+                if conn.get(f"/history/{prompt_id}", timeout=5).json().get(prompt_id):
+                    break
+                continue
+            if kind != "json":
+                continue
+            if message["type"] == "execution_error":
+                raise Exception(f"Warm-up failed: {message['data'].get('exception_message')}")
+            if message["type"] == "execution_interrupted":
+                raise Exception("Warm-up was interrupted.")
+            if message["type"] == "executing" and message["data"].get("node") is None:
+                break
+    finally:
+        if prompt_id is not None:
+            conn.release(prompt_id)
+        conn.close()
+
+def warm_up_all(provisioning, path, count):
+    """Warms every instance in parallel; each one loads the weights into its own device."""
+    with open(path, "r") as f:
+        workflow = json.load(f)
+
+    pinned = []
+    store = None
+    if provisioning.PROVISION_MODE == "lazy":
+        store = provisioning.ModelStore()
+        pinned = store.acquire([workflow])
+
+    errors = {}
+
+    def run(index):
+        try:
+            warm_up(workflow, f"127.0.0.1:{COMFY_BASE_PORT + index}")
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if store is not None:
+            store.release(pinned)
+    for index, e in sorted(errors.items()):
+        # A failed warm-up only costs that instance's first job its load time
+        print(f"⚠️ Warm-up failed on instance {index}: {e}")
+
+    # Warm-up outputs are not needed; the RAM disk starts clean for jobs
+    for name in os.listdir(OUTPUT_DIR):
+        full_path = os.path.join(OUTPUT_DIR, name)
+        if os.path.isfile(full_path):
+            os.remove(full_path)
+
+# =================================================================
+# MAIN
+# =================================================================
+def main():
+    total_started = time.monotonic()
+    provisioning = load_provisioning()
+
+    # 1. Provision models and boot ComfyUI side by side. ComfyUI lists
+    # model folders when a prompt is validated, so late files are picked up.
+    print("📥 Syncing models while ComfyUI boots...")
+    provision_result = {}
+    provision_thread = threading.Thread(target=provision, args=(provisioning, provision_result), daemon=True)
+    provision_thread.start()
+
+    boot_started = time.monotonic()
+    devices = instance_devices()
+    processes = [launch_comfyui(i, device) for i, device in enumerate(devices)]
+    for i, (process, device) in enumerate(zip(processes, devices)):
+        where = f" on device {device}" if device is not None else ""
+        print(f"🚀 ComfyUI launched on port {COMFY_BASE_PORT + i}{where} (pid {process.pid}).")
+    print("⏳ Waiting for /system_stats...")
+    # Instances boot side by side, so waiting on them in turn costs nothing
+    for i, process in enumerate(processes):
+        try:
+            wait_until_ready(process, i)
+        except Exception as e:
+            print(f"❌ ERROR (instance {i}): {e}")
+            print("--- Full Log ---")
+            print(tail_log(lines=200, path=log_file(i)))
+            for other in processes:
+                other.kill()
+            # Exit now: sys.exit would wait for the download pool's threads,
+            # keeping a dead container around until every model arrives
+            sys.stdout.flush()
+            os._exit(1)
+    timed("comfyui_boot", boot_started)
+    print("✅ ComfyUI is Alive!")
+
+    # 2. Jobs need the models, so wait for provisioning to finish
+    provision_thread.join()
+    report = provision_result.get("report") or {}
+    if report.get("failed"):
+        print(f"⚠️ {report['failed']} model(s) failed to provision; jobs that need them will fail.")
+        phase_times["provision_failed"] = report["failed"]
+    if "error" in provision_result:
+        # A worker without its models would fail every job, so do not take any
+        phase_times["provision_error"] = provision_result["error"]
+        print(json.dumps({"startup_phases": phase_times}))
+        for process in processes:
+            process.kill()
+        sys.stdout.flush()
+        os._exit(1)
+
+    # 3. Optional warm-up so weights are in VRAM before the first job
+    if WARMUP_WORKFLOW:
+        started = time.monotonic()
+        print(f"🔥 Warming up with {WARMUP_WORKFLOW}...")
+        try:
+            warm_up_all(provisioning, WARMUP_WORKFLOW, len(processes))
+            print("✅ Warm-up complete.")
+        except Exception as e:
+            print(f"⚠️ Warm-up failed: {e}")
+        timed("warmup", started)
+
+    timed("total", total_started)
+    print(json.dumps({"startup_phases": phase_times}))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,35 @@
 import os
+import json
+import time
 import shutil
 import glob
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from huggingface_hub import hf_hub_download
+from injection import workflow_model_refs
 
 # Standard RunPod Host Cache Path
 RUNPOD_CACHE_DIR = "/runpod-volume/huggingface-cache/hub"
+# Optional path to persist the cache index between starts (must be writable)
+HF_CACHE_INDEX = os.environ.get("HF_CACHE_INDEX")
+
+# Provisioning engine settings
+PROVISION_WORKERS = int(os.environ.get("PROVISION_WORKERS", 4))
+# Optional JSON manifest: {"<local name> or <repo_id>:<filename>": {"size": int, "sha256": "..."}}
+MODELS_MANIFEST = os.environ.get("MODELS_MANIFEST")
+PROVISION_REPORT = os.environ.get("PROVISION_REPORT", "/tmp/provision_report.json")
+# "hf" (huggingface_hub) or "http" (plain HTTP with Range resume against MODEL_BASE_URL)
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "hf")
+MODEL_BASE_URL = os.environ.get("MODEL_BASE_URL", "https://huggingface.co")
+
+# "eager": provision every model in MODELS before ComfyUI starts (default).
+# "lazy": skip that; rp_handler fetches what each workflow references.
+PROVISION_MODE = os.environ.get("PROVISION_MODE", "eager")
+# Local disk allowed for lazily downloaded models; LRU eviction above it (0 = no limit)
+MODEL_DISK_BUDGET_GB = float(os.environ.get("MODEL_DISK_BUDGET_GB", 0))
 
 def get_model_map():
     models_env = os.environ.get("MODELS", "")
@@ -23,87 +48,497 @@ def get_model_map():
         })
     return model_list
 
-def find_in_runpod_cache(repo_id, filename):
+# =================================================================
+# RUNPOD CACHE INDEX
+# =================================================================
+# The network volume makes every stat slow, so the folders of the repos
+# named in MODELS are scanned once into
+# {"models--user--repo": {filename: resolved blob path}} and all lookups
+# after that are dictionary hits. Other repos on the volume are not read.
+_cache_index = {}
+_cache_index_lock = threading.Lock()
+
+def repo_folder(repo_id):
+    return f"models--{repo_id.replace('/', '--')}"
+
+def repo_fingerprint(repo_dir):
+    """
+    What a repo's index entry is checked against: the contents of every
+    refs/ file (huggingface_hub rewrites refs/main in place, which leaves
+    the folder's mtime alone) and the mtime of each snapshots/<rev> folder
+    (a file added to an existing snapshot never touches refs/).
+    """
+    refs = {}
+    refs_dir = os.path.join(repo_dir, "refs")
+    for root, _, files in os.walk(refs_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                with open(path, "r") as f:
+                    refs[os.path.relpath(path, refs_dir)] = f.read().strip()
+            except OSError:
+                pass
+    snapshots = {}
+    try:
+        for entry in os.scandir(os.path.join(repo_dir, "snapshots")):
+            if entry.is_dir():
+                snapshots[entry.name] = entry.stat().st_mtime
+    except OSError:
+        pass
+    return {"refs": refs, "snapshots": snapshots}
+
+def _ordered_snapshots(repo_dir):
+    """Snapshot dirs oldest first, ref targets (e.g. refs/main) last so they win."""
+    snapshots_dir = os.path.join(repo_dir, "snapshots")
+    try:
+        entries = [e for e in os.scandir(snapshots_dir) if e.is_dir()]
+    except OSError:
+        return []
+    referenced = set()
+    refs_dir = os.path.join(repo_dir, "refs")
+    for root, _, files in os.walk(refs_dir):
+        for name in files:
+            try:
+                with open(os.path.join(root, name), "r") as f:
+                    referenced.add(f.read().strip())
+            except OSError:
+                pass
+    return [e.path for e in sorted(entries, key=lambda e: (e.name in referenced, e.stat().st_mtime))]
+
+def scan_repo(repo_dir):
+    """{filename: blob path} for one repo; newer snapshots override older ones."""
+    files = {}
+    for snapshot in _ordered_snapshots(repo_dir):
+        for root, _, names in os.walk(snapshot):
+            for name in names:
+                full_path = os.path.join(root, name)
+                # Resolve to the actual blob path to avoid broken relative links
+                blob = os.path.realpath(full_path)
+                if os.path.exists(blob):
+                    files[os.path.relpath(full_path, snapshot)] = blob
+    return files
+
+def build_cache_index(repo_ids, cache_dir=RUNPOD_CACHE_DIR, index_path=None):
+    """
+    Scans the HF hub cache folders of `repo_ids`. With `index_path`, the
+    index is stored there and later loads only rescan repos whose
+    fingerprint changed.
     """
-    Checks if the file exists in the RunPod Network Volume.
+    index_path = index_path if index_path is not None else HF_CACHE_INDEX
+    if not os.path.isdir(cache_dir):
+        return {}
+
+    saved = {}
+    if index_path and os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as f:
+                saved = json.load(f).get("repos", {})
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable cache index {index_path}: {e}")
+
+    repos = {}
+    rescanned = 0
+    for name in sorted({repo_folder(repo_id) for repo_id in repo_ids}):
+        repo_dir = os.path.join(cache_dir, name)
+        if not os.path.isdir(repo_dir):
+            continue
+        fingerprint = repo_fingerprint(repo_dir)
+        cached = saved.get(name)
+        if cached and cached.get("fingerprint") == fingerprint:
+            repos[name] = cached
+        else:
+            repos[name] = {"fingerprint": fingerprint, "files": scan_repo(repo_dir)}
+            rescanned += 1
+
+    if index_path and rescanned:
+        try:
+            # Keep entries of repos other workers sharing the volume use
+            tmp_path = f"{index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"cache_dir": cache_dir, "repos": {**saved, **repos}}, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print(f"⚠️ Could not persist cache index: {e}")
+
+    print(f"🗂️  Indexed RunPod cache: {len(repos)} repos ({rescanned} scanned)")
+    return {name: repo["files"] for name, repo in repos.items()}
+
+def get_cache_index(repo_ids=None):
+    """The index for `repo_ids` (default: every repo in MODELS); repos not seen yet are scanned."""
+    if repo_ids is None:
+        repo_ids = [model["repo_id"] for model in get_model_map()]
+    with _cache_index_lock:
+        missing = {repo_id for repo_id in repo_ids if repo_folder(repo_id) not in _cache_index}
+        if missing:
+            found = build_cache_index(missing)
+            # Repos absent from the volume are remembered as empty, not rescanned
+            _cache_index.update({repo_folder(repo_id): found.get(repo_folder(repo_id), {}) for repo_id in missing})
+        return _cache_index
+
+def find_in_runpod_cache(repo_id, filename, index=None):
+    """
+    Looks a file up in the RunPod Network Volume index.
     RunPod structure: models--user--repo/snapshots/{hash}/{filename}
     """
-    if not os.path.exists(RUNPOD_CACHE_DIR):
+    index = get_cache_index([repo_id]) if index is None else index
+    return index.get(repo_folder(repo_id), {}).get(filename)
+
+# =================================================================
+# DOWNLOAD BACKENDS
+# =================================================================
+# A backend fetches repo_id/filename to exactly `dest_path`, resuming an
+# interrupted transfer where it can. It must only create `dest_path` once
+# the file is complete (download elsewhere, then rename). cleanup() tidies
+# up after a round of fetches and is only called while none are running.
+class HFHubBackend:
+    name = "hf"
+
+    def __init__(self):
+        # (emptied folder, dest_dir) left behind by flattening
+        self._leftovers = set()
+        self._lock = threading.Lock()
+
+    def fetch(self, repo_id, filename, dest_path):
+        dest_dir = os.path.dirname(dest_path)
+        # hf_hub_download keeps partial data under dest_dir/.cache and
+        # resumes it on the next attempt.
+        downloaded_path = hf_hub_download(
+            repo_id=repo_id, 
+            filename=filename, 
+            local_dir=dest_dir
+        )
+
+        # Flatten/Rename if necessary
+        if downloaded_path != dest_path:
+            print(f"   🚚 Flattening/Renaming: {downloaded_path} -> {dest_path}")
+            shutil.move(downloaded_path, dest_path)
+            # Another download may be creating files in the same subfolder
+            # right now, so empty ones are only removed in cleanup()
+            with self._lock:
+                self._leftovers.add((os.path.dirname(downloaded_path), dest_dir))
+
+    def cleanup(self):
+        """Removes the subfolders flattening left empty."""
+        with self._lock:
+            leftovers, self._leftovers = self._leftovers, set()
+        # Deepest first, so a parent is only checked once its children are gone
+        for parent_dir, dest_dir in sorted(leftovers, key=lambda d: -len(d[0])):
+            while parent_dir != dest_dir:
+                try:
+                    if os.listdir(parent_dir):
+                        break
+                    os.rmdir(parent_dir)
+                except OSError:
+                    break
+                parent_dir = os.path.dirname(parent_dir)
+
+class HTTPBackend:
+    """
+    Plain HTTP download from `{base_url}/{repo_id}/resolve/main/{filename}`.
+    That is the Hugging Face URL layout, so it works against the Hub and
+    against any static file server with the same folder structure (e.g.
+    `python -m http.server` as a local stand-in). Partial data is kept in
+    `<dest>.part` and resumed with a Range request.
+    """
+    name = "http"
+    chunk_size = 8 * 1024 * 1024
+
+    def __init__(self, base_url=MODEL_BASE_URL, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        token = token or os.environ.get("HF_TOKEN")
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def fetch(self, repo_id, filename, dest_path):
+        url = f"{self.base_url}/{repo_id}/resolve/main/{filename}"
+        part_path = f"{dest_path}.part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as resp:
+            if resp.status_code == 416 and offset:
+                # Range past the end ("bytes */<size>"). A .part of that size,
+                # or of a size the server does not state, is complete and goes
+                # on to verification; one that is too big is stale.
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                if not total.isdigit() or int(total) == offset:
+                    os.replace(part_path, dest_path)
+                    return
+                print(f"   ↩️  Partial {filename} is larger than the remote file; restarting.")
+                os.remove(part_path)
+                return self.fetch(repo_id, filename, dest_path)
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                print(f"   ↩️  Server ignored resume for {filename}; restarting.")
+                offset = 0
+            elif offset:
+                print(f"   ⏩ Resuming {filename} at {offset / 1e6:.1f} MB")
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+        os.replace(part_path, dest_path)
+
+    def cleanup(self):
+        pass
+
+def get_backend(name=None):
+    name = name or MODEL_BACKEND
+    if name == "http":
+        return HTTPBackend()
+    if name == "hf":
+        return HFHubBackend()
+    raise ValueError(f"Unknown MODEL_BACKEND '{name}'")
+
+# =================================================================
+# VERIFICATION
+# =================================================================
+def load_manifest(path=None):
+    path = path or MODELS_MANIFEST
+    if not path:
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def manifest_entry(manifest, m, final_basename):
+    return manifest.get(final_basename) or manifest.get(f"{m['repo_id']}:{m['filename']}")
+
+def sha256_file(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def verify_file(path, expected):
+    """Returns None if `path` matches the manifest entry, else the reason."""
+    if not expected:
         return None
+    size = os.path.getsize(path)
+    if "size" in expected and size != expected["size"]:
+        return f"size {size} != expected {expected['size']}"
+    if "sha256" in expected and sha256_file(path) != expected["sha256"].lower():
+        return "sha256 mismatch"
+    return None
+
+# =================================================================
+# PROVISIONING ENGINE
+# =================================================================
+def resolve_destination(m):
+    dest_dir = m["target_dir"] if m["target_dir"].startswith("/") else os.path.join(os.getcwd(), m["target_dir"])
+    final_basename = m["local_name"] if m["local_name"] else os.path.basename(m["filename"])
+    return dest_dir, final_basename, os.path.join(dest_dir, final_basename)
 
-    safe_repo = f"models--{repo_id.replace('/', '--')}"
-    repo_path = os.path.join(RUNPOD_CACHE_DIR, safe_repo, "snapshots")
+def provision_model(m, backend, manifest):
+    """Links or downloads one model. Returns its report entry."""
+    repo_id = m["repo_id"]
+    filename = m["filename"]
+    started = time.monotonic()
     
-    if not os.path.exists(repo_path):
-        return None
+    # 1. Resolve Final Destination
+    dest_dir, final_basename, final_dest_path = resolve_destination(m)
+    os.makedirs(dest_dir, exist_ok=True)
+    expected = manifest_entry(manifest, m, final_basename)
+    result = {"repo_id": repo_id, "filename": filename, "path": final_dest_path}
 
-    # Search through all snapshot hashes for the file
-    for snapshot in os.listdir(repo_path):
-        full_path = os.path.join(repo_path, snapshot, filename)
-        if os.path.exists(full_path):
-            # Resolve to the actual blob path to avoid broken relative links
-            return os.path.realpath(full_path)
-    return None
+    def done(outcome, **extra):
+        result.update(outcome=outcome, seconds=round(time.monotonic() - started, 3), **extra)
+        return result
 
-def prepare_models():
-    model_list = get_model_map()
-    if not model_list:
-        return
-
-    print(f"--- 📦 Processing {len(model_list)} models ---")
-
-    for m in model_list:
-        repo_id = m["repo_id"]
-        filename = m["filename"]
-        
-        # 1. Resolve Final Destination
-        dest_dir = m["target_dir"] if m["target_dir"].startswith("/") else os.path.join(os.getcwd(), m["target_dir"])
-        os.makedirs(dest_dir, exist_ok=True)
-        
-        final_basename = m["local_name"] if m["local_name"] else os.path.basename(filename)
-        final_dest_path = os.path.join(dest_dir, final_basename)
-
-        if os.path.exists(final_dest_path):
+    if os.path.lexists(final_dest_path) and not os.path.exists(final_dest_path):
+        # A link into a cache that has since been pruned
+        print(f"⚠️  Removing dangling link {final_dest_path}")
+        os.remove(final_dest_path)
+    elif os.path.exists(final_dest_path):
+        problem = verify_file(final_dest_path, expected)
+        if not problem:
             print(f"✅ Already exists: {final_dest_path}")
-            continue
+            return done("exists")
+        # A file that fails the manifest check is treated as a leftover partial
+        print(f"⚠️  Existing {final_dest_path} failed verification ({problem}); re-fetching.")
+        if os.path.islink(final_dest_path):
+            os.remove(final_dest_path)
+        elif expected and "size" in expected and os.path.getsize(final_dest_path) < expected["size"]:
+            os.replace(final_dest_path, f"{final_dest_path}.part")
+        else:
+            os.remove(final_dest_path)
 
-        # 2. Check RunPod Host Cache First (Instant Start)
-        cached_physical_path = find_in_runpod_cache(repo_id, filename)
-        
-        if cached_physical_path:
-            print(f"🚀 Found in RunPod Cache! Linking: {cached_physical_path}")
-            # We use an absolute symlink. ComfyUI follows it, and it uses 0GB of disk.
-            os.symlink(cached_physical_path, final_dest_path)
-            print(f"   ✅ Instant link created at: {final_dest_path}")
-            continue
+    # 2. Check RunPod Host Cache First (Instant Start)
+    cached_physical_path = find_in_runpod_cache(repo_id, filename)
+    if cached_physical_path and not os.path.exists(cached_physical_path):
+        # Indexed, but the blob has been pruned from the cache since
+        print(f"⚠️  Cached blob {cached_physical_path} is gone; downloading instead.")
+        cached_physical_path = None
+
+    if cached_physical_path and not verify_file(cached_physical_path, expected):
+        print(f"🚀 Found in RunPod Cache! Linking: {cached_physical_path}")
+        # We use an absolute symlink. ComfyUI follows it, and it uses 0GB of disk.
+        os.symlink(cached_physical_path, final_dest_path)
+        print(f"   ✅ Instant link created at: {final_dest_path}")
+        return done("linked", source=cached_physical_path)
+
+    # 3. Fallback to the download backend
+    print(f"⬇️  Not in cache. Downloading {repo_id}/{filename} ({backend.name})...")
+    try:
+        backend.fetch(repo_id, filename, final_dest_path)
+        problem = verify_file(final_dest_path, expected)
+        if problem:
+            os.remove(final_dest_path)
+            raise Exception(f"verification failed: {problem}")
+        print(f"   ✅ Successfully placed at: {final_dest_path}")
+        return done("downloaded", bytes=os.path.getsize(final_dest_path))
 
-        # 3. Fallback to v1.4.0 Download API
-        print(f"⬇️  Not in cache. Downloading {repo_id}/{filename}...")
+    except Exception as e:
+        print(f"❌ Error processing {filename}: {e}")
+        return done("failed", error=str(e))
+
+def write_report(report, path=None):
+    path = path or PROVISION_REPORT
+    try:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"⚠️ Could not write provisioning report: {e}")
+
+def prepare_models(model_list=None, workers=None, backend=None, manifest=None, report_path=None):
+    """
+    Provisions every model concurrently and writes a JSON report of
+    per-model outcomes and timings. Returns the report.
+    """
+    model_list = get_model_map() if model_list is None else model_list
+    if not model_list:
+        return None
+
+    workers = workers or PROVISION_WORKERS
+    backend = backend or get_backend()
+    manifest = load_manifest() if manifest is None else manifest
+    # One scan of the volume up front; workers only do dictionary lookups
+    get_cache_index([model["repo_id"] for model in model_list])
+
+    print(f"--- 📦 Processing {len(model_list)} models ({workers} workers) ---")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda m: provision_model(m, backend, manifest), model_list))
+    backend.cleanup()
+
+    report = {
+        "backend": backend.name,
+        "workers": workers,
+        "seconds": round(time.monotonic() - started, 3),
+        "failed": sum(r["outcome"] == "failed" for r in results),
+        "models": results
+    }
+    write_report(report, report_path)
+    print(f"--- 📦 Done in {report['seconds']}s, {report['failed']} failed. Report: {report_path or PROVISION_REPORT} ---")
+    return report
+
+# =================================================================
+# LAZY, WORKFLOW-DRIVEN MATERIALIZATION
+# =================================================================
+def _local_size(path):
+    # Links into the RunPod cache cost no local disk
+    return 0 if os.path.islink(path) else os.path.getsize(path)
+
+class ModelStore:
+    """
+    Materializes the MODELS entries a workflow references, on demand, and
+    keeps downloaded ones under a disk budget by evicting the least
+    recently used. Models of running jobs are pinned until release().
+    Workflow references to files not listed in MODELS are left alone.
+    """
+
+    def __init__(self, model_list=None, budget_bytes=None, backend=None, manifest=None):
+        model_list = get_model_map() if model_list is None else model_list
+        self.budget = MODEL_DISK_BUDGET_GB * 1024 ** 3 if budget_bytes is None else budget_bytes
+        self.backend = backend or get_backend()
+        self.manifest = load_manifest() if manifest is None else manifest
+        self._by_name = {}
+        for m in model_list:
+            _, final_basename, final_dest_path = resolve_destination(m)
+            self._by_name[final_basename] = (final_dest_path, m)
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._in_use = Counter()
+        self._fetching = 0
+
+        # Seed the LRU with what is already on disk, oldest first
+        present = [path for path, _ in self._by_name.values() if os.path.lexists(path)]
+        present.sort(key=lambda path: os.lstat(path).st_mtime)
+        self._lru = OrderedDict((path, _local_size(path)) for path in present)
+
+    def models_for(self, workflow):
+        """{final path: model entry} for the MODELS a workflow uses."""
+        needed = {}
+        for ref in workflow_model_refs(workflow):
+            known = self._by_name.get(os.path.basename(ref))
+            if known:
+                needed[known[0]] = known[1]
+        return needed
+
+    def acquire(self, workflows):
+        """Ensures every model the workflows use is present; returns the pinned paths."""
+        needed = {}
+        for workflow in workflows:
+            needed.update(self.models_for(workflow))
+        with self._lock:
+            self._in_use.update(list(needed))
         try:
-            downloaded_path = hf_hub_download(
-                repo_id=repo_id, 
-                filename=filename, 
-                local_dir=dest_dir
-            )
-
-            # 4. Flatten/Rename if necessary
-            if downloaded_path != final_dest_path:
-                print(f"   🚚 Flattening/Renaming: {downloaded_path} -> {final_dest_path}")
-                shutil.move(downloaded_path, final_dest_path)
-                
-                # Cleanup empty subdirs
-                parent_dir = os.path.dirname(downloaded_path)
-                while parent_dir != dest_dir:
-                    if not os.listdir(parent_dir):
-                        os.rmdir(parent_dir)
-                        parent_dir = os.path.dirname(parent_dir)
-                    else:
-                        break
-            
-            print(f"   ✅ Successfully placed at: {final_dest_path}")
+            for path, m in needed.items():
+                self._materialize(path, m)
+        except Exception:
+            self.release(list(needed))
+            raise
+        self._evict()
+        return list(needed)
 
-        except Exception as e:
-            print(f"❌ Error processing {filename}: {e}")
+    def release(self, paths):
+        with self._lock:
+            self._in_use.subtract(paths)
+            self._in_use += Counter()
+
+    def _materialize(self, path, m):
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(path, threading.Lock())
+        with fetch_lock:
+            if path not in self._lru or not os.path.lexists(path):
+                expected = manifest_entry(self.manifest, m, os.path.basename(path)) or {}
+                self._evict(reserve=expected.get("size", 0))
+                with self._lock:
+                    self._fetching += 1
+                try:
+                    result = provision_model(m, self.backend, self.manifest)
+                finally:
+                    with self._lock:
+                        self._fetching -= 1
+                        # Holding the lock keeps a new fetch from starting mid-cleanup
+                        if not self._fetching:
+                            self.backend.cleanup()
+                if result["outcome"] == "failed":
+                    raise Exception(f"Could not materialize model {os.path.basename(path)}: {result['error']}")
+            with self._lock:
+                self._lru[path] = _local_size(path)
+                self._lru.move_to_end(path)
+
+    def _evict(self, reserve=0):
+        if not self.budget:
+            return
+        with self._lock:
+            total = sum(self._lru.values())
+            for path in list(self._lru):
+                if total + reserve <= self.budget:
+                    break
+                if self._in_use[path] or not self._lru[path]:
+                    continue
+                size = self._lru.pop(path)
+                try:
+                    os.remove(path)
+                    print(f"🧹 Evicted model {os.path.basename(path)} ({size / 1e9:.1f} GB)")
+                except OSError as e:
+                    print(f"⚠️ Could not evict {path}: {e}")
+                total -= size
 
 if __name__ == "__main__":
-    prepare_models()
+    if PROVISION_MODE == "lazy":
+        print("💤 PROVISION_MODE=lazy: models are fetched per workflow by rp_handler.")
+    else:
+        prepare_models()
@@ -0,0 +1,94 @@
+# =================================================================
+# PRE-FLIGHT WORKFLOW VALIDATION
+# =================================================================
+# Checks an API-format workflow against ComfyUI's /object_info schema
+# before any file is written or anything is queued. Errors are dicts:
+#   {"node_id", "class_type", "type", "message"} (+ "input" when relevant)
+# with type one of: bad_node, invalid_node, unknown_node_class,
+# missing_required_input, bad_link, missing_input_image.
+
+# Used when the schema does not flag a node's upload input (older ComfyUI)
+IMAGE_LOADERS = {"LoadImage": "image", "LoadImageMask": "image"}
+
+def _error(node_id, class_type, error_type, message, input_name=None):
+    error = {"node_id": str(node_id), "class_type": class_type, "type": error_type, "message": message}
+    if input_name is not None:
+        error["input"] = input_name
+    return error
+
+def upload_inputs(schema, class_type):
+    """Input names of a node class that take an uploaded image filename."""
+    names = set()
+    for section in ("required", "optional"):
+        for name, spec in schema.get("input", {}).get(section, {}).items():
+            if isinstance(spec, (list, tuple)) and len(spec) > 1 and isinstance(spec[1], dict):
+                if spec[1].get("image_upload"):
+                    names.add(name)
+    if class_type in IMAGE_LOADERS:
+        names.add(IMAGE_LOADERS[class_type])
+    return names
+
+def validate_workflow(workflow, object_info, input_names):
+    """
+    Returns a list of errors (empty when the workflow looks runnable).
+    `input_names` are the image filenames sent with the job.
+    """
+    if not isinstance(workflow, dict) or not workflow:
+        return [_error(None, None, "invalid_node", "Workflow must be a non-empty object of nodes.")]
+
+    errors = []
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            errors.append(_error(node_id, None, "bad_node", "Node must be an object."))
+            continue
+        if not isinstance(node.get("class_type"), str):
+            errors.append(_error(node_id, None, "invalid_node", "Node has no class_type."))
+            continue
+        class_type = node["class_type"]
+        inputs = node.get("inputs", {})
+        if not isinstance(inputs, dict):
+            errors.append(_error(node_id, class_type, "bad_node", "Node inputs must be an object."))
+            continue
+        schema = object_info.get(class_type)
+        if schema is None:
+            errors.append(_error(
+                node_id, class_type, "unknown_node_class",
+                f"Node type '{class_type}' is not installed on this worker."
+            ))
+            continue
+
+        for name in schema.get("input", {}).get("required", {}):
+            if name not in inputs:
+                errors.append(_error(
+                    node_id, class_type, "missing_required_input", f"Required input '{name}' is missing.", name
+                ))
+
+        for name, value in inputs.items():
+            # Links are [source_node_id, output_index]
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                source_id = str(value[0])
+                source = workflow.get(source_id)
+                if source is None:
+                    errors.append(_error(
+                        node_id, class_type, "bad_link", f"Input '{name}' links to missing node {source_id}.", name
+                    ))
+                    continue
+                if not isinstance(source, dict) or not isinstance(source.get("class_type"), str):
+                    # Reported as a bad node in its own right
+                    continue
+                source_schema = object_info.get(source["class_type"])
+                if source_schema is not None and not 0 <= value[1] < len(source_schema.get("output", [])):
+                    errors.append(_error(
+                        node_id, class_type, "bad_link",
+                        f"Input '{name}' uses output {value[1]} of node {source_id}, which has "
+                        f"{len(source_schema.get('output', []))}.", name
+                    ))
+
+        for name in upload_inputs(schema, class_type):
+            value = inputs.get(name)
+            if isinstance(value, str) and value not in input_names:
+                errors.append(_error(
+                    node_id, class_type, "missing_input_image",
+                    f"Input '{name}' references '{value}', which was not sent with the job.", name
+                ))
+    return errors